@@ -12,6 +12,24 @@ parser.add_argument(
     default='/tmp/public-cache',
     help='Local temp dir for snapshots')
 
+parser.add_argument('--temp-dir-max-mb', type=float, default=0,
+    help='If present, keeps captures in --temp-dir under this many MB, evicting the least '
+         'recently used first. By default captures are kept forever')
+
+parser.add_argument('--in-memory', dest='in_memory', action='store_true', default=False,
+    help='If present, captures are buffered in memory and uploaded straight to S3 instead of '
+         'being written to --temp-dir (which is then only used if --temp-dir-max-mb is set)')
+
+parser.add_argument('--spool-mb', type=float, default=32,
+    help='With --in-memory, captures larger than this spill over to an anonymous temp file')
+
+parser.add_argument('--config-root', default='',
+    help='If present, read configs from this directory (with taco/, crdt/, ... in it) instead of '
+         'configs/ in this repo, e.g. an older checkout to --plan against')
+
+parser.add_argument('--config-cache', default='',
+    help='Path of the compiled config index cache. Defaults to config-index.json in --temp-dir')
+
 parser.add_argument('--states',
     default='',
     help='Comma-separated list of state 2-letter names. If present, will only screenshot those.')
@@ -19,9 +37,177 @@ parser.add_argument('--states',
 parser.add_argument('--phantomjscloud-key', default='',
     help='API key for PhantomJScloud, used for browser image capture')
 
+parser.add_argument('--phantomjscloud-url', default='https://phantomjscloud.com/api/browser/v2/',
+    help='Base URL of the PhantomJScloud browser API; the API key is appended to it')
+
 parser.add_argument('--dry-run', dest='dry_run', action='store_true', default=False,
     help='If present, will only print the resulting PhantomJScloud request and do nothing')
 
+parser.add_argument('--plan', default='',
+    help='If present, write the request every link would make (the PhantomJSCloud payload, or the '
+         'file to download) to this path as sorted JSONL, then exit without capturing anything. '
+         'Compare two plans with scripts/plan_diff.py')
+
+parser.add_argument('--plan-date', default='',
+    help='With --plan, resolve dynamic (eval) URLs for this YYYY-MM-DD date instead of today')
+
+# Args relating to parallel captures
+
+parser.add_argument('--workers', type=int, default=1,
+    help='Number of captures to run in parallel. 1 (the default) runs states and links serially')
+
+parser.add_argument('--max-requests-per-host', type=int, default=2,
+    help='Max in-flight requests to the same target hostname when running in parallel')
+
+parser.add_argument('--max-renders-per-key', type=int, default=4,
+    help='Max in-flight PhantomJScloud renders per API key when running in parallel')
+
+parser.add_argument('--renders-per-second', type=float, default=0,
+    help='If present, caps PhantomJScloud requests per second across all workers')
+
+parser.add_argument('--render-burst', type=int, default=0,
+    help='Max PhantomJScloud requests sent at once after an idle period with --renders-per-second. '
+         'Defaults to the per-second rate')
+
+parser.add_argument('--render-budget-credits', type=float, default=0,
+    help='If present, PhantomJScloud credits this run may spend. When the projected spend is over '
+         'this, or over the credits left on the account, --over-budget-skip links are skipped')
+
+parser.add_argument('--over-budget-skip', default='quinary',
+    help='Comma-separated link names to skip when the run is projected to go over budget')
+
+# Args relating to retries
+
+parser.add_argument('--retry-attempts', type=int, default=4,
+    help='Max attempts per screenshot. Permanent errors (e.g. most 4xx responses) are not retried')
+
+parser.add_argument('--retry-base-delay', type=float, default=2.0,
+    help='Initial backoff in seconds between attempts; doubles on each retry, with jitter')
+
+parser.add_argument('--retry-max-delay', type=float, default=60.0,
+    help='Max backoff in seconds between attempts, also caps any Retry-After from the server')
+
+parser.add_argument('--circuit-breaker-failures', type=int, default=5,
+    help='After this many consecutive failed requests to a site, its remaining links fail '
+         'straight away with a "circuit open" error. 0 disables this')
+
+parser.add_argument('--circuit-breaker-cooldown', type=float, default=300,
+    help='Seconds after a site\'s circuit opens before a single request probes it again')
+
+parser.add_argument('--hedge-renders', dest='hedge_renders', action='store_true', default=False,
+    help='If present, a render still running after --hedge-percentile of its link\'s past '
+         'durations gets a second, identical request alongside it, and the first to succeed is '
+         'kept. Links with too little history are not hedged')
+
+parser.add_argument('--hedge-percentile', type=float, default=90,
+    help='With --hedge-renders, percentile of a link\'s past render durations after which it is '
+         'hedged')
+
+parser.add_argument('--hedge-min-seconds', type=float, default=10,
+    help='With --hedge-renders, renders are never hedged before this many seconds')
+
+parser.add_argument('--max-hedges', type=int, default=10,
+    help='With --hedge-renders, max hedged requests per run, each costing a render')
+
+# Args relating to `file:` downloads
+
+parser.add_argument('--download-timeout', type=float, default=300,
+    help='Max seconds to spend downloading a single file')
+
+parser.add_argument('--max-download-mb', type=float, default=200,
+    help='Max size in MB of a single downloaded file; larger downloads fail without retrying')
+
+parser.add_argument('--date-fallback-days', type=int, default=0,
+    help='Dynamic (eval) URLs are checked for today and this many days before it, all at once, '
+         'and the newest one that exists is captured. Defaults to 0, which only tries today\'s '
+         'URL; scheduled runs use 3')
+
+parser.add_argument('--validator-cache', default='',
+    help='Path to a JSON cache of ETag/Last-Modified/hash per file URL. If present, files are '
+         'fetched with conditional GETs and unchanged files are not re-uploaded')
+
+# Args relating to run manifests and resuming runs
+
+parser.add_argument('--manifest-dir', default='',
+    help='Directory for run manifests. Defaults to runs/ in --temp-dir')
+
+parser.add_argument('--resume', default='',
+    help='Run ID of an interrupted run to resume: only captures that did not succeed are retried')
+
+parser.add_argument('--summarize-run', default='',
+    help='Run ID of an earlier run: resend its failure summary from its manifest, then exit')
+
+# Args relating to capture history
+
+parser.add_argument('--history', default='',
+    help='Path of the history of past capture durations and failures per link, used to start '
+         'the slowest links first. Defaults to history.json in --temp-dir')
+
+parser.add_argument('--adaptive-max-wait', dest='adaptive_max_wait', action='store_true',
+    default=False,
+    help='If present, links whose config sets no maxWait get one derived from how long their '
+         'renders took in past runs, instead of the flat 60s')
+
+parser.add_argument('--catalog', default='',
+    help='Path of the SQLite catalog of every capture (time, status, S3 key, size, hash), queried '
+         'with scripts/capture_catalog.py. Defaults to catalog.sqlite in --temp-dir')
+
+# Args relating to splitting a run across hosts or cron jobs
+
+parser.add_argument('--shard', default='',
+    help='i/N: capture only the i-th of N shards of the run (1 <= i <= N). Every shard splits '
+         'the links the same way, balanced by expected capture time, so all N can run '
+         'independently with the same other args')
+
+parser.add_argument('--shard-history', default='',
+    help='Path of a capture history shared by all shards, used to estimate how long each link '
+         'takes. All shards must see the same file; without it, estimates come from the configs')
+
+parser.add_argument('--shard-results', default='',
+    help='Local directory or s3://bucket/prefix where each shard writes its failures instead of '
+         'sending them to Slack, for --merge-shards to combine')
+
+parser.add_argument('--shard-run-id', default='',
+    help='Name shared by all shards of one run and its --merge-shards step, e.g. core-20210301-14. '
+         'Required with --shard-results or --merge-shards; the scheduler starting the shards '
+         'should pick it, as their start times can differ')
+
+parser.add_argument('--merge-shards', type=int, default=0,
+    help='Number of shards N: combine the failures the N shards wrote to --shard-results into '
+         'one summary per run type, send it to Slack, then exit')
+
+# Args relating to daemon mode
+
+parser.add_argument('--daemon', action='store_true', default=False,
+    help='If present, keep running and capture each run type on its --schedule, reusing HTTP, '
+         'S3 and Slack clients and the compiled configs between runs')
+
+parser.add_argument('--schedule', action='append', default=[],
+    help='With --daemon, when to capture a run type from --run-types (or the single run type '
+         'flag): <run type>=HH:MM[,HH:MM...] in US/Eastern, or <run type>=<n><s|m|h|d> for a '
+         'fixed interval, e.g. core=6h. Repeat for each run type')
+
+parser.add_argument('--config-poll-seconds', type=float, default=30,
+    help='With --daemon, how often to check configs/ for edited YAMLs, which are reloaded '
+         'before the next run')
+
+parser.add_argument('--health-host', default='127.0.0.1',
+    help='With --daemon, address of the health and metrics endpoint')
+
+parser.add_argument('--health-port', type=int, default=8087,
+    help='With --daemon, port of the health (/healthz) and Prometheus metrics (/metrics) '
+         'endpoint; 0 disables it')
+
+# Args relating to run reports
+
+parser.add_argument('--run-report', default='',
+    help='Path of the JSON report of per-capture timings, sizes and statuses written at the end '
+         'of each run. Defaults to run-report.json in --temp-dir')
+
+parser.add_argument('--prometheus-textfile', default='',
+    help='If present, also write the run metrics to this path in the Prometheus text format, '
+         'e.g. for the node_exporter textfile collector (the path should end in .prom)')
+
 # Args relating to S3 setup
 
 parser.add_argument(
@@ -34,11 +220,57 @@ parser.add_argument(
     default='state_screenshots',
     help='Name of subfolder on S3 bucket to upload files to')
 
+parser.add_argument('--s3-endpoint-url', default='',
+    help='If present, talk to this S3-compatible endpoint instead of AWS (e.g. a local stub)')
+
 parser.add_argument('--push-to-s3', dest='push_to_s3', action='store_true', default=False,
     help='Push screenshots to S3')
 
+parser.add_argument('--s3-index', dest='s3_index', action='store_true', default=False,
+    help='If present, uploads are also recorded in the per-folder JSON indexes under _index/ in '
+         'the bucket, which the bucket browser reads instead of listing the bucket. Each folder\'s '
+         'index is updated once, at the end of the run')
+
+parser.add_argument('--dedupe-captures', dest='dedupe_captures', action='store_true',
+    default=False,
+    help='If present, captures identical to the last upload of the same link are not uploaded '
+         'again; they are logged as references to it in the index\'s duplicates file instead')
+
+parser.add_argument('--dedupe-index', default='',
+    help='Path of the index of last uploads used by --dedupe-captures. Defaults to '
+         'capture-index.json in --temp-dir, with duplicates in capture-index-duplicates.jsonl')
+
+parser.add_argument('--perceptual-dedupe-distance', type=int, default=0,
+    help='With --dedupe-captures, PNGs whose perceptual hashes differ in at most this many of 64 '
+         'bits also count as duplicates. Requires Pillow; 0 only skips exact duplicates')
+
+parser.add_argument('--optimize-pngs', dest='optimize_pngs', action='store_true', default=False,
+    help='If present, PNG captures are losslessly re-encoded at maximum compression before upload, '
+         'in a pool of worker processes. Requires Pillow')
+
+parser.add_argument('--optimize-workers', type=int, default=0,
+    help='Processes used by --optimize-pngs. Defaults to the number of CPUs')
+
+parser.add_argument('--webp-quality', type=int, default=0,
+    help='With --optimize-pngs, also upload a WebP copy of each PNG at this quality (1-100, 100 is '
+         'lossless) next to it')
+
+parser.add_argument('--thumbnail-width', type=int, default=0,
+    help='With --optimize-pngs, also upload a thumbnail of the top of each PNG, this many pixels '
+         'wide, named <capture>-thumb.png')
+
+parser.add_argument('--upload-workers', type=int, default=0,
+    help='If present, uploads to S3 run on this many background threads instead of inline '
+         'with each capture, and are retried independently of renders')
+
+parser.add_argument('--upload-queue-size', type=int, default=32,
+    help='Max captures waiting for upload before captures pause')
+
+parser.add_argument('--upload-attempts', type=int, default=4,
+    help='Max attempts per S3 upload when using --upload-workers')
+
 # Determines which screenshots we're aiming to take; these may have different schedules. Only one
-# can be true at a time
+# can be true at a time, or --run-types can list several
 
 group = parser.add_mutually_exclusive_group(required=True)
 
@@ -57,6 +289,11 @@ group.add_argument('--screenshot-vax-urls', dest='vax_urls', action='store_true'
 group.add_argument('--screenshot-variant-urls', dest='variant_urls', action='store_true', default=False,
     help='Screenshot variant data URLs')
 
+group.add_argument('--run-types', default='',
+    help='Comma-separated run types to screenshot in one process, from core, CRDT, LTC, vaccine '
+         'and variants, each optionally followed by :<S3 subfolder> (default --s3-subfolder). '
+         'Identical requests across run types are captured once and uploaded for each')
+
 # Allows the user to specify a primary, secondary, etc. screenshot to take
 # If this argument is not present, all screenshots will be taken
 parser.add_argument('--which-screenshot', default='',
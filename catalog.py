@@ -0,0 +1,186 @@
+""" Local SQLite catalog of captures, for point-in-time lookups without listing S3.
+
+Every capture a run makes (or fails to make) is a row keyed by (run type, state, suffix, capture
+time), with its S3 key, the size and SHA-256 of the object uploaded there (after any PNG
+optimization), duration and error. Rows can also be imported from the
+objects already in a bucket; see scripts/capture_catalog.py.
+"""
+
+from datetime import datetime
+import sqlite3
+import threading
+
+from pytz import timezone
+
+from manifest import DONE
+from s3_index import THUMBNAIL_SUFFIX, WEBP_SUFFIX, parse_capture_filename
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    run_type TEXT,
+    state TEXT NOT NULL,
+    suffix TEXT,
+    captured_at TEXT NOT NULL,
+    captured_epoch REAL NOT NULL,
+    status TEXT NOT NULL,
+    s3_key TEXT,
+    size INTEGER,
+    sha256 TEXT,
+    duration_seconds REAL,
+    attempts INTEGER,
+    error TEXT,
+    run_id TEXT,
+    source TEXT NOT NULL DEFAULT 'run'
+);
+CREATE INDEX IF NOT EXISTS captures_link_time
+    ON captures (state, suffix, run_type, captured_epoch);
+CREATE INDEX IF NOT EXISTS captures_time ON captures (captured_epoch);
+CREATE UNIQUE INDEX IF NOT EXISTS captures_uploaded
+    ON captures (s3_key) WHERE s3_key IS NOT NULL AND status = 'done';
+'''
+
+COLUMNS = [
+    'run_type', 'state', 'suffix', 'captured_at', 'status', 's3_key', 'size', 'sha256',
+    'duration_seconds', 'attempts', 'error', 'run_id', 'source']
+
+
+class CaptureCatalog():
+    """The catalog database at path, created if needed. Safe to use from several threads."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        # WAL lets queries run while a capture run is writing
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def record(self, run_type, state, suffix, status, filename=None, s3_key=None, size=None,
+               sha256=None, duration_seconds=None, attempts=None, error=None, run_id=None):
+        """Records one capture of a link. Its time comes from the capture's filename, or is now if
+        there isn't one (e.g. for failures). s3_key is where it was uploaded, or for a duplicate,
+        the earlier upload it matched.
+        """
+        captured_at, _ = parse_capture_filename(filename or s3_key or '')
+        self.insert([_row(
+            run_type=run_type, state=state, suffix=suffix, captured_at=captured_at,
+            status=status, s3_key=s3_key, size=size, sha256=sha256,
+            duration_seconds=duration_seconds, attempts=attempts,
+            error=str(error) if error is not None else None, run_id=run_id, source='run')])
+
+    def insert(self, rows):
+        """Inserts rows (dicts with COLUMNS and captured_epoch) in one transaction, skipping
+        uploads whose S3 key is already in the catalog. Returns how many were added.
+        """
+        names = COLUMNS + ['captured_epoch']
+        sql = 'INSERT OR IGNORE INTO captures (%s) VALUES (%s)' % (
+            ', '.join(names), ', '.join('?' * len(names)))
+        with self._lock:
+            before = self._db.total_changes
+            self._db.execute('BEGIN')
+            try:
+                self._db.executemany(sql, [[row.get(name) for name in names] for row in rows])
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+            return self._db.total_changes - before
+
+    # rows of captures that have an S3 object to look at, for the given link
+    def _link_query(self, state, suffix, run_type):
+        sql = 'SELECT * FROM captures WHERE state = ? AND suffix = ? AND s3_key IS NOT NULL'
+        params = [state.upper(), suffix]
+        if run_type:
+            sql += ' AND run_type = ?'
+            params.append(run_type)
+        return sql, params
+
+    def latest(self, state, suffix='primary', run_type=None, before=None):
+        """The newest stored capture of a link, optionally as of a datetime, or None."""
+        sql, params = self._link_query(state, suffix, run_type)
+        if before is not None:
+            sql += ' AND captured_epoch <= ?'
+            params.append(before.timestamp())
+        return self._one(sql + ' ORDER BY captured_epoch DESC LIMIT 1', params)
+
+    def nearest(self, state, at, suffix='primary', run_type=None):
+        """The stored capture of a link closest in time to the datetime at, or None."""
+        sql, params = self._link_query(state, suffix, run_type)
+        epoch = at.timestamp()
+        candidates = [
+            self._one(sql + ' AND captured_epoch <= ? ORDER BY captured_epoch DESC LIMIT 1',
+                      params + [epoch]),
+            self._one(sql + ' AND captured_epoch > ? ORDER BY captured_epoch ASC LIMIT 1',
+                      params + [epoch]),
+        ]
+        candidates = [row for row in candidates if row is not None]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda row: abs(row['captured_epoch'] - epoch))
+
+    def export(self, start=None, end=None, states=None, suffix=None, run_type=None,
+               status=None):
+        """Yields every capture matching the filters, oldest first, as dicts of COLUMNS."""
+        clauses, params = [], []
+        if start is not None:
+            clauses.append('captured_epoch >= ?')
+            params.append(start.timestamp())
+        if end is not None:
+            clauses.append('captured_epoch < ?')
+            params.append(end.timestamp())
+        if states:
+            clauses.append('state IN (%s)' % ', '.join('?' * len(states)))
+            params.extend(state.upper() for state in states)
+        for name, value in [('suffix', suffix), ('run_type', run_type), ('status', status)]:
+            if value:
+                clauses.append('%s = ?' % name)
+                params.append(value)
+        sql = 'SELECT %s FROM captures' % ', '.join(COLUMNS)
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY captured_epoch, state, suffix'
+        # a separate connection, so a long export doesn't hold the lock
+        db = sqlite3.connect(self.path)
+        db.row_factory = sqlite3.Row
+        try:
+            for row in db.execute(sql, params):
+                yield dict(row)
+        finally:
+            db.close()
+
+    def _one(self, sql, params):
+        with self._lock:
+            row = self._db.execute(sql, params).fetchone()
+        return dict(row) if row is not None else None
+
+
+def _row(captured_at=None, **values):
+    captured_at = captured_at or datetime.now(timezone('US/Eastern'))
+    values.update(captured_at=captured_at.isoformat(), captured_epoch=captured_at.timestamp())
+    return values
+
+
+# builds a catalog row for an existing S3 object, from a list_objects_v2 entry; run_type is the
+# run type its folder holds, if known. Returns None for files derived from a capture.
+def row_from_s3_object(item, run_type=None):
+    key = item['Key']
+    if key.endswith((WEBP_SUFFIX, THUMBNAIL_SUFFIX)):
+        return None
+    parts = key.split('/')
+    captured_at, suffix = parse_capture_filename(key)
+    if captured_at is None:
+        captured_at = item['LastModified'].astimezone(timezone('US/Eastern'))
+    # <subfolder>/<state>/<file>, or CDC/<file>
+    state = parts[-2] if len(parts) >= 2 else parts[0].split('-')[0]
+    return _row(
+        captured_at=captured_at, run_type=run_type, state=state.upper(), suffix=suffix,
+        status=DONE, s3_key=key, size=item['Size'],
+        # a single-part upload's ETag is its MD5, not a SHA-256, so there's no hash to record
+        sha256=None, source='s3')
@@ -0,0 +1,275 @@
+""" Compiled, validated index of all screenshot configs, with an on-disk cache.
+
+Loads every state YAML under configs/ once, checks it against a small schema, and compiles
+`eval: True` URL expressions into DateTemplate objects that are evaluated without eval().
+"""
+
+import ast
+from datetime import date, timedelta
+from functools import lru_cache
+import json
+import os
+import sys
+
+from loguru import logger
+import yaml
+
+from downloads import write_json_atomically
+
+
+CONFIG_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'configs')
+CONFIG_SUBDIRS = ['taco', 'crdt', 'ltc', 'vax', 'variants']
+
+# bump this whenever the compiled format changes, so stale on-disk caches are ignored
+_CACHE_VERSION = 1
+
+_FILE_TYPES = {'pdf', 'xlsx', 'xls', 'zip', 'csv'}
+
+# before Python 3.8 (environment.yml pins 3.6), literals are parsed into Str and Num nodes, not
+# Constant ones
+_LEGACY_LITERALS = (ast.Str, ast.Num) if sys.version_info < (3, 8) else ()
+
+# link keys we interpret ourselves, and PhantomJSCloud page request fields passed through as is
+_LINK_FIELDS = {
+    'name': str,
+    'url': str,
+    'eval': bool,
+    'file': str,
+    'message': str,
+    'overseerScript': str,
+    'renderSettings': dict,
+    'requestSettings': dict,
+    'renderType': str,
+    'outputAsJson': bool,
+    'content': str,
+    'urlSettings': dict,
+    'scripts': dict,
+    'proxy': (str, dict),
+}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class DateTemplate():
+    """A dynamic URL expression such as `date.today().strftime("...%m%d%Y.pdf")`.
+
+    The expression is parsed once and checked against a whitelist of the date arithmetic and
+    string methods our configs use; resolve() then evaluates it for a given day without eval().
+    """
+
+    _FUNCTIONS = {'str': str, 'int': int}
+    _METHODS = {'strftime', 'lower', 'upper', 'weekday', 'zfill', 'replace', 'isoformat'}
+    _ATTRIBUTES = {'days'}
+    _OPERATORS = {
+        ast.Add: lambda a, b: a + b,
+        ast.Sub: lambda a, b: a - b,
+        ast.Mult: lambda a, b: a * b,
+        ast.Div: lambda a, b: a / b,
+        ast.FloorDiv: lambda a, b: a // b,
+        ast.Mod: lambda a, b: a % b,
+    }
+
+    def __init__(self, expression):
+        self.expression = expression
+        try:
+            self._tree = ast.parse(expression.strip(), mode='eval').body
+        except SyntaxError as e:
+            raise ConfigError(f'Invalid URL expression {expression!r}: {e}')
+        # evaluating once catches anything outside the whitelist at load time
+        result = self.resolve(date(2021, 1, 1))
+        if not isinstance(result, str):
+            raise ConfigError(f'URL expression {expression!r} does not evaluate to a string')
+
+    def __repr__(self):
+        return 'DateTemplate(%r)' % self.expression
+
+    def resolve(self, today=None):
+        return self._evaluate(self._tree, today or date.today())
+
+    # returns the distinct URLs for today and each of the days_back days before it, newest first
+    def resolve_recent(self, days_back, today=None):
+        today = today or date.today()
+        urls = []
+        for days in range(days_back + 1):
+            url = self.resolve(today - timedelta(days=days))
+            if url not in urls:
+                urls.append(url)
+        return urls
+
+    def _evaluate(self, node, today):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (str, int, float)):
+            return node.value
+        if _LEGACY_LITERALS and isinstance(node, _LEGACY_LITERALS):
+            return node.s if isinstance(node, ast.Str) else node.n
+
+        if isinstance(node, ast.BinOp) and type(node.op) in self._OPERATORS:
+            return self._OPERATORS[type(node.op)](
+                self._evaluate(node.left, today), self._evaluate(node.right, today))
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return -self._evaluate(node.operand, today)
+
+        if isinstance(node, ast.Attribute) and node.attr in self._ATTRIBUTES:
+            return getattr(self._evaluate(node.value, today), node.attr)
+
+        if isinstance(node, ast.Call):
+            args = [self._evaluate(arg, today) for arg in node.args]
+            kwargs = {kw.arg: self._evaluate(kw.value, today) for kw in node.keywords}
+            func = node.func
+            if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) \
+                    and func.value.id == 'date' and func.attr == 'today' and not args:
+                return today
+            if isinstance(func, ast.Name) and func.id == 'date':
+                return date(*args)
+            if isinstance(func, ast.Name) and func.id == 'timedelta':
+                return timedelta(*args, **kwargs)
+            if isinstance(func, ast.Name) and func.id in self._FUNCTIONS:
+                return self._FUNCTIONS[func.id](*args, **kwargs)
+            if isinstance(func, ast.Attribute) and func.attr in self._METHODS:
+                return getattr(self._evaluate(func.value, today), func.attr)(*args, **kwargs)
+
+        raise ConfigError(
+            f'Unsupported syntax {ast.dump(node)} in URL expression {self.expression!r}')
+
+
+@lru_cache(maxsize=None)
+def compile_url_template(expression):
+    return DateTemplate(expression)
+
+
+def validate_state_config(config, state):
+    """Checks a parsed state YAML against the config schema, raising ConfigError if invalid."""
+
+    if not isinstance(config, dict):
+        raise ConfigError('config is not a mapping')
+    unknown = set(config) - {'state', 'links'}
+    if unknown:
+        raise ConfigError(f'unknown top-level keys {sorted(unknown)}')
+    if config.get('state') != state:
+        raise ConfigError(f'state is {config.get("state")!r}, expected {state!r}')
+    links = config.get('links')
+    if not isinstance(links, list) or not links:
+        raise ConfigError('links must be a non-empty list')
+
+    names = set()
+    for link in links:
+        if not isinstance(link, dict):
+            raise ConfigError(f'link {link!r} is not a mapping')
+        name = link.get('name')
+        for field in ('name', 'url'):
+            if field not in link:
+                raise ConfigError(f'link {name or link!r} is missing {field}')
+        for field, value in link.items():
+            if field not in _LINK_FIELDS:
+                raise ConfigError(f'link {name} has unknown field {field!r}')
+            if not isinstance(value, _LINK_FIELDS[field]):
+                raise ConfigError(f'link {name} field {field} has unexpected type')
+        if name in names:
+            # existing configs do this (e.g. vax/SC); both links are still captured
+            logger.warning(f'{state} has more than one link named {name}')
+        names.add(name)
+        if 'file' in link and link['file'] not in _FILE_TYPES:
+            raise ConfigError(f'link {name} has unsupported file type {link["file"]!r}')
+        if link.get('eval'):
+            compile_url_template(link['url'])
+
+
+class ConfigIndex():
+    """All state configs for every run type, keyed by config subdirectory and state.
+
+    States whose YAML fails to parse or validate are recorded in `errors` rather than raising,
+    so one bad file only fails that state, as it did before the index existed.
+    """
+
+    def __init__(self, configs, errors=None, root=CONFIG_ROOT, subdirs=CONFIG_SUBDIRS,
+                 fingerprint=None):
+        self.configs = configs  # subdir -> state -> config dict
+        self.errors = errors or {}  # (subdir, state) -> message
+        # where the configs were loaded from, and the YAML files' state at the time
+        self.root = root
+        self.subdirs = subdirs
+        self.fingerprint = fingerprint
+
+    # whether any YAML was added, removed or modified since the index was built
+    def is_stale(self):
+        return self._fingerprint(self.root, self.subdirs) != self.fingerprint
+
+    # returns the config for a state, None if it has none, or raises ConfigError if it is invalid
+    def state_config(self, subdir, state):
+        state = state.upper()
+        if (subdir, state) in self.errors:
+            raise ConfigError(self.errors[(subdir, state)])
+        return self.configs.get(subdir, {}).get(state)
+
+    @classmethod
+    def load(cls, root=CONFIG_ROOT, subdirs=CONFIG_SUBDIRS, cache_path=None):
+        """Builds the index, reusing cache_path if no YAML has changed since it was written."""
+
+        fingerprint = cls._fingerprint(root, subdirs)
+        if cache_path:
+            index = cls._load_cache(cache_path, fingerprint)
+            if index is not None:
+                index.root, index.subdirs = root, subdirs
+                return index
+
+        configs = {}
+        errors = {}
+        for subdir in subdirs:
+            configs[subdir] = {}
+            for filename in sorted(fingerprint.get(subdir, {})):
+                state = filename[:-len('.yaml')].upper()
+                path = os.path.join(root, subdir, filename)
+                try:
+                    with open(path) as f:
+                        config = yaml.safe_load(f)
+                    validate_state_config(config, state)
+                except Exception as e:
+                    logger.error(f'Invalid config {path}: {e}')
+                    errors[(subdir, state)] = f'Invalid config {subdir}/{filename}: {e}'
+                    continue
+                configs[subdir][state] = config
+
+        index = cls(configs, errors, root=root, subdirs=subdirs, fingerprint=fingerprint)
+        if cache_path:
+            # sort_keys=False keeps link fields in YAML order, as they're sent to PhantomJSCloud
+            try:
+                write_json_atomically(cache_path, {
+                    'version': _CACHE_VERSION,
+                    'fingerprint': fingerprint,
+                    'configs': configs,
+                    'errors': [[subdir, state, message]
+                               for (subdir, state), message in errors.items()],
+                }, sort_keys=False)
+            except OSError as e:
+                logger.warning(f'Could not write config index cache {cache_path}: {e}')
+        return index
+
+    # subdir -> filename -> [mtime_ns, size] for every state YAML
+    @staticmethod
+    def _fingerprint(root, subdirs):
+        fingerprint = {}
+        for subdir in subdirs:
+            directory = os.path.join(root, subdir)
+            if not os.path.isdir(directory):
+                continue
+            fingerprint[subdir] = {}
+            for entry in os.scandir(directory):
+                if entry.name.endswith('.yaml'):
+                    stat = entry.stat()
+                    fingerprint[subdir][entry.name] = [stat.st_mtime_ns, stat.st_size]
+        return fingerprint
+
+    @classmethod
+    def _load_cache(cls, cache_path, fingerprint):
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get('version') != _CACHE_VERSION or cached.get('fingerprint') != fingerprint:
+            return None
+        logger.info(f'Using compiled config index from {cache_path}')
+        errors = {(subdir, state): message for subdir, state, message in cached['errors']}
+        return cls(cached['configs'], errors, fingerprint=fingerprint)
@@ -0,0 +1,287 @@
+""" Long-running screenshot daemon: captures each run type on its own schedule in one process.
+
+Clients (HTTP sessions, S3, Slack, the compiled config index) stay warm between runs instead of
+being rebuilt by every cron invocation, edited configs are picked up without a restart, and a
+small HTTP server on localhost reports health and the last runs' metrics:
+
+  GET /healthz   JSON status of the daemon and of each run type's last and next run
+  GET /metrics   Prometheus metrics of the last run of each run type, plus daemon gauges
+
+The scheduled captures run as, e.g.:
+
+  python run-screenshots.py --daemon --run-types core,CRDT,LTC --push-to-s3 \\
+      --schedule core=09:00,16:00 --schedule CRDT=12:00 --schedule LTC=1d --date-fallback-days 3
+"""
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import math
+import re
+import signal
+from socketserver import ThreadingMixIn
+import threading
+import time
+
+from loguru import logger
+from pytz import timezone
+
+from manifest import FAILED
+from metrics import merge_prometheus_texts
+
+
+_TIMEZONE = timezone('US/Eastern')
+_INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+class RunSchedule():
+    """When to capture a run type: at fixed times of day (US/Eastern), or every fixed interval.
+
+    Parsed from `<run type>=HH:MM[,HH:MM...]`, e.g. core=08:00,20:00, or from
+    `<run type>=<number><s|m|h|d>`, e.g. CRDT=6h. Intervals are aligned to the epoch, so the same
+    schedule fires at the same times whenever the daemon was started.
+    """
+
+    def __init__(self, run_type, times=None, interval=None):
+        self.run_type = run_type
+        self.times = sorted(times or [])  # (hour, minute) pairs
+        self.interval = interval  # seconds
+
+    @classmethod
+    def parse(cls, text):
+        run_type, _, spec = text.partition('=')
+        if not run_type or not spec:
+            raise ValueError(
+                f'Invalid schedule {text!r}, expected e.g. core=08:00,20:00 or core=6h')
+        match = re.fullmatch(r'(\d+)([smhd])', spec.strip())
+        if match:
+            interval = int(match.group(1)) * _INTERVAL_UNITS[match.group(2)]
+            if interval <= 0:
+                raise ValueError(f'Invalid schedule {text!r}: the interval must be positive')
+            return cls(run_type.strip(), interval=interval)
+        times = []
+        for entry in spec.split(','):
+            try:
+                hour, minute = (int(part) for part in entry.strip().split(':'))
+            except ValueError:
+                raise ValueError(f'Invalid time {entry!r} in schedule {text!r}, expected HH:MM')
+            if not (0 <= hour < 24 and 0 <= minute < 60):
+                raise ValueError(f'Invalid time {entry!r} in schedule {text!r}')
+            times.append((hour, minute))
+        return cls(run_type.strip(), times=times)
+
+    def __str__(self):
+        if self.interval:
+            return '%s every %ds' % (self.run_type, self.interval)
+        return '%s at %s' % (self.run_type, ','.join('%02d:%02d' % t for t in self.times))
+
+    # the first time this schedule fires strictly after now (an aware datetime)
+    def next_after(self, now):
+        if self.interval:
+            timestamp = (math.floor(now.timestamp() / self.interval) + 1) * self.interval
+            return datetime.fromtimestamp(timestamp, _TIMEZONE)
+        local = now.astimezone(_TIMEZONE)
+        for days in range(2):
+            day = local.date() + timedelta(days=days)
+            for hour, minute in self.times:
+                candidate = _TIMEZONE.localize(
+                    datetime(day.year, day.month, day.day, hour, minute))
+                if candidate > now:
+                    return candidate
+        raise AssertionError('no scheduled time within two days')  # times is never empty
+
+
+class ScreenshotDaemon():
+    """Runs run_fn(run_types) whenever schedules come due, one run at a time.
+
+    Run types due at the same time are captured together in one run, so identical links are
+    captured once. A run that overruns later slots skips them rather than running back to back.
+    Between runs, reload_fn() is called every poll_seconds to pick up config changes; it returns
+    whether anything was reloaded. run_fn returns the run's metrics.RunMetrics.
+    """
+
+    def __init__(self, schedules, run_fn, reload_fn=None, poll_seconds=30,
+                 health_host='127.0.0.1', health_port=0):
+        self.schedules = schedules
+        self.run_fn = run_fn
+        self.reload_fn = reload_fn
+        self.poll_seconds = poll_seconds
+        self.health_host = health_host
+        self.health_port = health_port
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+        self._heartbeat = time.time()
+        self._running = None  # run types of the run in progress
+        self._runs = 0
+        self._failed_runs = 0
+        self._config_reloads = 0
+        self._status = {}  # run type -> dict of last/next run details
+        self._metrics_texts = {}  # run type -> Prometheus text of its last run
+        self._server = None
+
+    def stop(self, *_):
+        logger.info('Stopping the screenshot daemon after the current run')
+        self._stop.set()
+
+    def run_forever(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.stop)
+        if self.health_port:
+            self._start_health_server()
+
+        now = datetime.now(_TIMEZONE)
+        next_runs = {schedule.run_type: schedule.next_after(now) for schedule in self.schedules}
+        for schedule in self.schedules:
+            logger.info(f'Scheduled {schedule}, next run at {next_runs[schedule.run_type]}')
+        try:
+            while not self._stop.is_set():
+                self._heartbeat = time.time()
+                now = datetime.now(_TIMEZONE)
+                due = [schedule.run_type for schedule in self.schedules
+                       if next_runs[schedule.run_type] <= now]
+                if due:
+                    self._reload()
+                    self._run(due)
+                    now = datetime.now(_TIMEZONE)
+                    for schedule in self.schedules:
+                        if schedule.run_type in due or next_runs[schedule.run_type] <= now:
+                            if schedule.run_type not in due:
+                                logger.warning(f'Skipping overrun slot of {schedule}')
+                            next_runs[schedule.run_type] = schedule.next_after(now)
+                    self._set_next_runs(next_runs)
+                    continue
+                self._set_next_runs(next_runs)
+                self._reload()
+                wait = (min(next_runs.values()) - now).total_seconds()
+                self._stop.wait(max(min(wait, self.poll_seconds), 0))
+        finally:
+            if self._server:
+                self._server.shutdown()
+                self._server.server_close()
+
+    def _reload(self):
+        if not self.reload_fn:
+            return
+        try:
+            if self.reload_fn():
+                with self._lock:
+                    self._config_reloads += 1
+        except Exception as e:
+            # keep running with the configs we have
+            logger.error(f'Could not reload configs: {e}')
+
+    def _run(self, run_types):
+        label = '+'.join(run_types)
+        logger.info(f'Starting scheduled {label} run')
+        started = datetime.now(_TIMEZONE)
+        with self._lock:
+            self._running = run_types
+        status = {'last_started': started.isoformat()}
+        metrics = None
+        try:
+            metrics = self.run_fn(run_types)
+            status['last_result'] = 'ok'
+        except Exception as e:
+            # a broken run mustn't stop the schedule
+            logger.exception(f'Scheduled {label} run failed: {e}')
+            status['last_result'] = 'error: %s' % e
+        status['last_finished'] = datetime.now(_TIMEZONE).isoformat()
+
+        with self._lock:
+            self._running = None
+            self._runs += 1
+            if metrics is None:
+                self._failed_runs += 1
+            for run_type in run_types:
+                run_status = self._status.setdefault(run_type, {})
+                run_status.update(status)
+                if metrics is not None:
+                    captures = [record for record in metrics.captures()
+                                if record['run_type'] == run_type]
+                    run_status['captures'] = len(captures)
+                    run_status['failed_captures'] = sum(
+                        1 for record in captures if record['status'] == FAILED)
+                    self._metrics_texts[run_type] = metrics.prometheus_text()
+        self._heartbeat = time.time()
+        logger.info(f'Finished scheduled {label} run')
+
+    def _set_next_runs(self, next_runs):
+        with self._lock:
+            for run_type, when in next_runs.items():
+                self._status.setdefault(run_type, {})['next_run'] = when.isoformat()
+
+    def health(self):
+        """Returns (healthy, details): unhealthy if the scheduling loop stopped polling."""
+        with self._lock:
+            idle_seconds = time.time() - self._heartbeat
+            healthy = self._running is not None or idle_seconds < 3 * self.poll_seconds + 60
+            return healthy, {
+                'status': 'ok' if healthy else 'stalled',
+                'uptime_seconds': round(time.time() - self._started_at, 1),
+                'running': self._running,
+                'runs': self._runs,
+                'failed_runs': self._failed_runs,
+                'config_reloads': self._config_reloads,
+                'run_types': {run_type: dict(status) for run_type, status in self._status.items()},
+            }
+
+    def prometheus_text(self):
+        with self._lock:
+            texts = list(self._metrics_texts.values())
+            gauges = [
+                ('daemon_uptime_seconds', 'Seconds since the daemon started.',
+                 time.time() - self._started_at),
+                ('daemon_running', 'Whether a run is in progress.', int(self._running is not None)),
+                ('daemon_runs', 'Scheduled runs since the daemon started.', self._runs),
+                ('daemon_failed_runs', 'Scheduled runs that raised an error.', self._failed_runs),
+                ('daemon_config_reloads', 'Config reloads since the daemon started.',
+                 self._config_reloads),
+            ]
+        lines = []
+        for name, help_text, value in gauges:
+            lines += ['# HELP screenshots_%s %s' % (name, help_text),
+                      '# TYPE screenshots_%s gauge' % name,
+                      'screenshots_%s %s' % (name, value)]
+        return merge_prometheus_texts(texts + ['\n'.join(lines)])
+
+    def _start_health_server(self):
+        daemon = self
+
+        class Handler(_HealthHandler):
+            screenshot_daemon = daemon
+
+        self._server = _ThreadingHTTPServer((self.health_host, self.health_port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        host, port = self._server.server_address[:2]
+        logger.info(f'Health endpoint at http://{host}:{port}/healthz, metrics at /metrics')
+
+
+# http.server.ThreadingHTTPServer is only in Python 3.7+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _HealthHandler(BaseHTTPRequestHandler):
+    screenshot_daemon = None  # set on the per-server subclass
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/healthz':
+            healthy, details = self.screenshot_daemon.health()
+            self.send(200 if healthy else 503, json.dumps(details).encode(), 'application/json')
+        elif path == '/metrics':
+            self.send(200, self.screenshot_daemon.prometheus_text().encode(),
+                      'text/plain; version=0.0.4')
+        else:
+            self.send(404, b'not found', 'text/plain')
@@ -0,0 +1,123 @@
+""" Content-hash deduplication of captures against the last upload of each link.
+
+Each link's last uploaded capture is remembered by the SHA-256 of the capture as made, before any
+post-processing (and, optionally, a perceptual hash of PNGs). A new capture that matches isn't
+uploaded again; it is logged as a reference to the existing S3 object instead.
+"""
+
+from datetime import datetime
+import json
+import os
+import threading
+
+from loguru import logger
+from pytz import timezone
+
+from downloads import write_json_atomically
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional: without it only exact duplicates are detected
+    Image = None
+
+
+def perceptual_hash(source):
+    """Returns a 64-bit difference hash of an image file or file object as 16 hex digits, or None
+    if Pillow isn't installed or the image can't be read.
+
+    Images that look the same (e.g. a dashboard re-rendered with different antialiasing) get
+    hashes that differ in only a few bits.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(source) as image:
+            pixels = list(image.convert('L').resize((9, 8)).getdata())
+    except Exception as e:
+        logger.warning(f'Could not compute perceptual hash: {e}')
+        return None
+    finally:
+        if hasattr(source, 'seek'):
+            source.seek(0)
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return '%016x' % bits
+
+
+def hamming_distance(hash1, hash2):
+    return bin(int(hash1, 16) ^ int(hash2, 16)).count('1')
+
+
+class CaptureIndex():
+    """Persistent index of the last uploaded capture per (run type, state, suffix).
+
+    Stored as a JSON file; duplicates found are appended to a JSON-lines log next to it, each
+    naming the S3 object the capture would have duplicated. With max_distance > 0 (and Pillow
+    installed), PNGs whose perceptual hashes differ in at most that many bits also count as
+    duplicates.
+    """
+
+    def __init__(self, path, max_distance=0):
+        self.path = path
+        self.duplicates_path = os.path.splitext(path)[0] + '-duplicates.jsonl'
+        self.max_distance = max_distance
+        if max_distance and Image is None:
+            logger.warning('Pillow is not installed: only exact duplicate captures are detected')
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._entries = json.load(f)
+            except ValueError as e:
+                logger.warning(f'Ignoring unreadable capture index {path}: {e}')
+
+    @property
+    def perceptual(self):
+        return bool(self.max_distance) and Image is not None
+
+    @staticmethod
+    def _key(run_type, state, suffix):
+        return '%s/%s/%s' % (run_type, state, suffix)
+
+    # returns the index entry of the link's last upload if this capture duplicates it, else None
+    def duplicate_of(self, run_type, state, suffix, sha256, phash=None):
+        with self._lock:
+            entry = self._entries.get(self._key(run_type, state, suffix))
+        if not entry or not entry.get('s3_key'):
+            return None
+        if entry.get('sha256') == sha256:
+            return entry
+        if self.perceptual and phash and entry.get('phash') and \
+                hamming_distance(phash, entry['phash']) <= self.max_distance:
+            return entry
+        return None
+
+    # remembers an uploaded capture; only call this once the upload has succeeded. sha256 is the
+    # capture's as made, and upload_sha256 that of the object in S3, if post-processing changed it
+    def store(self, run_type, state, suffix, sha256, s3_key, phash=None, upload_sha256=None):
+        with self._lock:
+            self._entries[self._key(run_type, state, suffix)] = {
+                'sha256': sha256,
+                'upload_sha256': upload_sha256 or sha256,
+                'phash': phash,
+                's3_key': s3_key,
+                'captured_at': datetime.now(timezone('US/Eastern')).isoformat(),
+            }
+            write_json_atomically(self.path, self._entries)
+
+    def record_duplicate(self, run_type, state, suffix, filename, entry, sha256):
+        record = {
+            'run_type': run_type,
+            'state': state,
+            'suffix': suffix,
+            'filename': filename,
+            'sha256': sha256,
+            'duplicate_of': entry['s3_key'],
+            'captured_at': datetime.now(timezone('US/Eastern')).isoformat(),
+        }
+        with self._lock:
+            with open(self.duplicates_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
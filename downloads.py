@@ -0,0 +1,267 @@
+""" Streaming, bounded-memory handling of HTTP response bodies: to disk, or to memory."""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from loguru import logger
+import requests
+
+from retries import CaptureError
+
+
+CHUNK_SIZE = 1024 * 1024
+# bodies held in memory spill over to a temp file above this size
+SPOOL_BYTES = 32 * 1024 * 1024
+# file types written by captures; anything else in a cache directory is left alone
+CAPTURE_EXTENSIONS = ('.png', '.pdf', '.xlsx', '.xls', '.zip', '.csv', '.webp')
+
+
+class DownloadStats():
+
+    def __init__(self, nbytes, seconds, sha256=None, validators=None, unchanged=False):
+        # size of the file to upload, which post-processing may change
+        self.nbytes = nbytes
+        self.seconds = seconds
+        # hash of the body as captured, which deduplication and validators compare
+        self.sha256 = sha256
+        # hash of the file to upload; differs from sha256 once post-processing rewrites it
+        self.upload_sha256 = sha256
+        # ETag / Last-Modified / hash to remember for the URL once the capture is done
+        self.validators = validators
+        # True if the file is known to be the same as the last successful capture of the URL
+        self.unchanged = unchanged
+        # the body itself, for captures kept in memory rather than written to disk
+        self.fileobj = None
+        # (name suffix, local path, bytes) of files derived from the capture to upload alongside
+        # it, e.g. by postprocess.PngOptimizer
+        self.derivatives = []
+
+    @property
+    def throughput(self):
+        # bytes per second
+        return self.nbytes / self.seconds if self.seconds > 0 else float(self.nbytes)
+
+    def __str__(self):
+        if self.unchanged:
+            return 'unchanged since last capture'
+        return '%d bytes in %.2fs (%.2f MB/s)' % (
+            self.nbytes, self.seconds, self.throughput / (1024 * 1024))
+
+
+class ValidatorCache():
+    """Persistent per-URL cache of HTTP validators, used for conditional GETs of `file:` links.
+
+    Maps each resolved URL to the ETag, Last-Modified and SHA-256 of the last file successfully
+    captured from it, stored as a JSON file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._entries = json.load(f)
+            except ValueError as e:
+                logger.warning(f'Ignoring unreadable validator cache {path}: {e}')
+
+    # headers for a conditional GET of url, empty if we've never captured it
+    def request_headers(self, url):
+        with self._lock:
+            entry = self._entries.get(url, {})
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def is_unchanged(self, url, sha256):
+        with self._lock:
+            return self._entries.get(url, {}).get('sha256') == sha256
+
+    # returns the validators to store for url after a successful (200) response
+    @staticmethod
+    def validators_from_response(response, sha256):
+        return {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'sha256': sha256,
+        }
+
+    # remembers validators for url; only call this once the capture has been fully handled
+    # (e.g. uploaded), otherwise a later 304 would skip a file we never stored
+    def store(self, url, validators):
+        with self._lock:
+            entry = self._entries.setdefault(url, {})
+            entry.update({k: v for k, v in validators.items() if v is not None})
+            entry['checked_at'] = time.time()
+            write_json_atomically(self.path, self._entries)
+
+
+def write_text_atomically(path, text):
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.%s.' % os.path.basename(path))
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+def write_json_atomically(path, obj, sort_keys=True):
+    write_text_atomically(path, json.dumps(obj, sort_keys=sort_keys))
+
+
+# statuses for which a HEAD request says nothing, so the probe falls back to a 1-byte GET
+_HEAD_UNSUPPORTED_STATUSES = {403, 405, 501}
+
+
+def url_exists(session, url, timeout=30):
+    """Returns whether url can be fetched, using a HEAD request or, if the server doesn't
+    support HEAD, a GET for just its first byte."""
+    try:
+        response = session.head(url, allow_redirects=True, timeout=timeout)
+        if response.status_code in _HEAD_UNSUPPORTED_STATUSES:
+            with session.get(url, headers={'Range': 'bytes=0-0'}, allow_redirects=True,
+                             stream=True, timeout=timeout) as response:
+                pass
+    except requests.RequestException as e:
+        logger.info(f'Probe of {url} failed: {e}')
+        return False
+    return 200 <= response.status_code < 300
+
+
+def stream_response_to_path(response, path, max_bytes=None, timeout=None):
+    """Streams the body of a requests response (opened with stream=True) to path.
+
+    The body is written in chunks to a temp file next to path and renamed into place once
+    complete, so readers never see a partial file and memory use doesn't depend on body size.
+
+    Parameters
+    ----------
+    response : requests.Response
+        Response whose body has not been consumed yet
+
+    path : str
+        Final local path of the file
+
+    max_bytes : int
+        If set, fail once the body is larger than this many bytes
+
+    timeout : float
+        If set, fail if the whole body takes longer than this many seconds to arrive
+
+    Returns
+    -------
+    DownloadStats
+    """
+
+    start = time.monotonic()
+    directory = os.path.dirname(path) or '.'
+    fd, temp_path = tempfile.mkstemp(
+        dir=directory, prefix='.%s.' % os.path.basename(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            nbytes, sha256 = _copy_chunks(response, f, max_bytes, timeout, start)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+    return DownloadStats(nbytes, time.monotonic() - start, sha256=sha256)
+
+
+def stream_response_to_buffer(response, max_bytes=None, timeout=None, spool_bytes=SPOOL_BYTES):
+    """Like stream_response_to_path, but keeps the body in memory instead of writing it to disk.
+
+    Bodies larger than spool_bytes spill over to an anonymous temp file. The returned stats have
+    a `fileobj` attribute positioned at the start of the body; the caller must close it.
+    """
+
+    start = time.monotonic()
+    fileobj = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+    try:
+        nbytes, sha256 = _copy_chunks(response, fileobj, max_bytes, timeout, start)
+    except BaseException:
+        fileobj.close()
+        raise
+    fileobj.seek(0)
+
+    stats = DownloadStats(nbytes, time.monotonic() - start, sha256=sha256)
+    stats.fileobj = fileobj
+    return stats
+
+
+# copies the response body into f chunk by chunk, enforcing the size and time limits; returns
+# (number of bytes, SHA-256 hex digest)
+def _copy_chunks(response, f, max_bytes, timeout, start):
+    content_length = response.headers.get('Content-Length', '')
+    if max_bytes and content_length.isdigit() and int(content_length) > max_bytes:
+        raise CaptureError(
+            f'Refusing to download {response.url}: Content-Length {content_length} is over '
+            f'the {max_bytes} byte limit', permanent=True)
+
+    nbytes = 0
+    digest = hashlib.sha256()
+    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+        nbytes += len(chunk)
+        if max_bytes and nbytes > max_bytes:
+            raise CaptureError(
+                f'Download of {response.url} is over the {max_bytes} byte limit', permanent=True)
+        if timeout and time.monotonic() - start > timeout:
+            raise CaptureError(
+                f'Download of {response.url} timed out after {timeout}s ({nbytes} bytes received)')
+        digest.update(chunk)
+        f.write(chunk)
+    return nbytes, digest.hexdigest()
+
+
+class DiskCache():
+    """Keeps a local directory of captures under a size limit, evicting least recently used files.
+
+    Only captures that were already in the directory at start-up, or were handed to add(), are
+    ever evicted, so captures still waiting to be uploaded are left alone.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._files = {}  # path -> (last used time, size)
+        os.makedirs(directory, exist_ok=True)
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.name.endswith(CAPTURE_EXTENSIONS):
+                stat = entry.stat()
+                self._files[entry.path] = (max(stat.st_atime, stat.st_mtime), stat.st_size)
+        self.evict()
+
+    # registers a finished capture at path, copying it from fileobj first if given
+    def add(self, path, fileobj=None):
+        if fileobj is not None:
+            fileobj.seek(0)
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(fileobj, f, CHUNK_SIZE)
+        with self._lock:
+            self._files[path] = (time.time(), os.path.getsize(path))
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            total = sum(size for _, size in self._files.values())
+            for path in sorted(self._files, key=lambda p: self._files[p][0]):
+                if total <= self.max_bytes:
+                    break
+                total -= self._files.pop(path)[1]
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
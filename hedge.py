@@ -0,0 +1,53 @@
+""" Hedged PhantomJSCloud renders, for links whose renders sometimes stall.
+
+Some dashboards' renders occasionally hang until maxWait, then succeed straight away when retried.
+Once a render has been running for longer than its link usually takes (a percentile of its past
+durations in history.CaptureHistory), an identical request is sent alongside it, and whichever
+succeeds first is kept. Hedges cost a render each, so they are capped per run.
+"""
+
+import threading
+
+
+class HedgePolicy():
+    """When to hedge a render, and how many hedges this run has left.
+
+    A link is hedged once its render has run for the given percentile of its past request
+    durations, or min_seconds if that is longer. Links with too little history are never hedged.
+    """
+
+    def __init__(self, history, percentile=0.9, max_hedges=10, min_seconds=10):
+        self.history = history
+        self.percentile = percentile
+        self.max_hedges = max_hedges
+        self.min_seconds = min_seconds
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.won = 0
+
+    # seconds a render of the link may run before it is hedged, or None to not hedge it
+    def delay(self, run_type, state, suffix):
+        with self._lock:
+            if self.sent >= self.max_hedges:
+                return None
+        seconds = self.history.percentile_seconds(run_type, state, suffix, self.percentile)
+        if seconds is None:
+            return None
+        return max(seconds, self.min_seconds)
+
+    # takes one hedge from the run's allowance; False if there are none left
+    def acquire(self):
+        with self._lock:
+            if self.sent >= self.max_hedges:
+                return False
+            self.sent += 1
+            return True
+
+    def record_win(self):
+        with self._lock:
+            self.won += 1
+
+    def describe(self):
+        with self._lock:
+            return '%d of %d hedged renders sent, %d finished first' % (
+                self.sent, self.max_hedges, self.won)
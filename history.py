@@ -0,0 +1,152 @@
+""" Persistent per-link history of capture durations and outcomes across runs.
+
+Used to schedule the slowest links first, to size each link's PhantomJSCloud maxWait from how
+long its renders have actually taken, and to tell when a render is running long enough to hedge.
+"""
+
+import json
+import threading
+
+from loguru import logger
+
+from downloads import write_json_atomically
+from manifest import COMPLETE_STATUSES, FAILED
+
+
+_CACHE_VERSION = 1
+
+# PhantomJSCloud's default when neither the YAML nor the history says otherwise
+DEFAULT_MAX_WAIT_MS = 60000
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+
+class CaptureHistory():
+    """Recent request durations and outcomes per (run type, state, suffix), stored as JSON.
+
+    For each link it keeps the last max_samples per-request durations of successful captures, and
+    the last max_samples outcomes: 'ok', 'failed', or 'timeout' for a failure that took about as
+    long as the maxWait it was sent with.
+    """
+
+    def __init__(self, path=None, max_samples=20, min_samples=3,
+                 min_max_wait_ms=15000, max_max_wait_ms=240000):
+        self.path = path
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self.min_max_wait_ms = min_max_wait_ms
+        self.max_max_wait_ms = max_max_wait_ms
+        self._lock = threading.Lock()
+        self._links = {}  # 'run type/state/suffix' -> {'durations': [...], 'outcomes': [...]}
+        if path:
+            try:
+                with open(path) as f:
+                    cached = json.load(f)
+                if cached.get('version') == _CACHE_VERSION:
+                    self._links = cached['links']
+            except (OSError, ValueError):
+                pass
+
+    @staticmethod
+    def _key(run_type, state, suffix):
+        return '%s/%s/%s' % (run_type, state, suffix)
+
+    def _link(self, run_type, state, suffix):
+        with self._lock:
+            return self._links.get(self._key(run_type, state, suffix))
+
+    # the given percentile (0-1) of a link's seconds per successful request, or None if it has too
+    # little history
+    def percentile_seconds(self, run_type, state, suffix, fraction):
+        link = self._link(run_type, state, suffix)
+        if not link or len(link['durations']) < self.min_samples:
+            return None
+        return percentile(link['durations'], fraction)
+
+    # typical seconds per request for a link, or None if it has too little history
+    def expected_seconds(self, run_type, state, suffix):
+        return self.percentile_seconds(run_type, state, suffix, 0.5)
+
+    def failure_rate(self, run_type, state, suffix):
+        link = self._link(run_type, state, suffix)
+        if not link or not link['outcomes']:
+            return 0.0
+        return sum(1 for outcome in link['outcomes'] if outcome != 'ok') / len(link['outcomes'])
+
+    # expected cost of capturing a link, counting retries of links that often fail; links with no
+    # history cost default_seconds
+    def expected_cost(self, run_type, state, suffix, default_seconds):
+        seconds = self.expected_seconds(run_type, state, suffix)
+        if seconds is None:
+            seconds = default_seconds
+        return seconds * (1 + self.failure_rate(run_type, state, suffix))
+
+    # median expected seconds over every link with enough history, used for links without any
+    def typical_seconds(self):
+        with self._lock:
+            medians = [
+                percentile(link['durations'], 0.5) for link in self._links.values()
+                if len(link['durations']) >= self.min_samples]
+        return percentile(medians, 0.5) if medians else 0
+
+    def max_wait_ms(self, run_type, state, suffix):
+        """Returns the maxWait to send for a link, or None to keep the default.
+
+        This is 1.5x the link's p95 duration plus 5s of headroom, clamped to
+        [min_max_wait_ms, max_max_wait_ms]. If the link's last outcome was a timeout, it gets at
+        least double the wait it timed out with, so known-slow pages stop timing out.
+        """
+
+        link = self._link(run_type, state, suffix)
+        if not link:
+            return None
+        max_wait = None
+        if len(link['durations']) >= self.min_samples:
+            max_wait = percentile(link['durations'], 0.95) * 1000 * 1.5 + 5000
+        if link['outcomes'] and link['outcomes'][-1] == 'timeout':
+            max_wait = max(max_wait or 0, 2 * link.get('last_max_wait_ms', DEFAULT_MAX_WAIT_MS))
+        if max_wait is None:
+            return None
+        return int(min(max(max_wait, self.min_max_wait_ms), self.max_max_wait_ms))
+
+    def update(self, captures):
+        """Adds the outcomes of a run, given as metrics.RunMetrics.captures() records."""
+
+        with self._lock:
+            for record in captures:
+                if record.get('copy_of'):
+                    continue  # timed under the link it was deduplicated into
+                requests = record.get('renders', 0) + record.get('downloads', 0)
+                if not requests:
+                    continue  # not attempted, e.g. a dry run
+                seconds = (
+                    record.get('render_seconds', 0) + record.get('download_seconds', 0)) / requests
+                link = self._links.setdefault(
+                    self._key(record['run_type'], record['state'], record['suffix']),
+                    {'durations': [], 'outcomes': []})
+                max_wait_ms = record.get('max_wait_ms')
+                if max_wait_ms:
+                    link['last_max_wait_ms'] = max_wait_ms
+
+                if record['status'] in COMPLETE_STATUSES:
+                    link['durations'] = (link['durations'] + [seconds])[-self.max_samples:]
+                    outcome = 'ok'
+                elif record['status'] == FAILED:
+                    timed_out = max_wait_ms and seconds * 1000 >= 0.9 * max_wait_ms
+                    outcome = 'timeout' if timed_out else 'failed'
+                else:
+                    continue
+                link['outcomes'] = (link['outcomes'] + [outcome])[-self.max_samples:]
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            links = dict(self._links)
+        try:
+            write_json_atomically(self.path, {'version': _CACHE_VERSION, 'links': links})
+        except OSError as e:
+            logger.warning(f'Could not write capture history {self.path}: {e}')
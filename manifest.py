@@ -0,0 +1,110 @@
+""" Run manifests: a checkpoint of every capture's status, used to resume interrupted runs."""
+
+from datetime import datetime
+import json
+import os
+import threading
+
+from pytz import timezone
+
+
+PENDING = 'pending'
+DONE = 'done'
+UNCHANGED = 'unchanged'
+DUPLICATE = 'duplicate'  # captured, but identical to the last upload, which it references
+FAILED = 'failed'
+
+COMPLETE_STATUSES = {DONE, UNCHANGED, DUPLICATE}
+
+
+class RunManifest():
+    """Append-only JSON-lines log of capture statuses for one run.
+
+    Each line is a full record (run type, state, suffix, status, S3 key, attempts, error); the
+    last line for a (run type, state, suffix) wins. Lines are flushed as they're written, so the
+    manifest survives the process being killed mid-run.
+    """
+
+    def __init__(self, path, run_id, run_type):
+        self.path = path
+        self.run_id = run_id
+        self.run_type = run_type
+        self._lock = threading.Lock()
+        self._latest = {}  # (run type, state, suffix) -> record
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short when the process died
+                    self._latest[
+                        (record['run_type'], record['state'], record['suffix'])] = record
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'a')
+
+    @classmethod
+    def for_run(cls, directory, run_type, run_id=None):
+        """Opens the manifest for run_id in directory, or starts a new run if run_id is None."""
+        if run_id is None:
+            timestamp = datetime.now(timezone('US/Eastern')).strftime("%Y%m%d-%H%M%S")
+            run_id = '%s-%s' % (run_type, timestamp)
+        return cls(os.path.join(directory, '%s.jsonl' % run_id), run_id, run_type)
+
+    @property
+    def resumed(self):
+        return bool(self._latest)
+
+    # run_type defaults to the manifest's; runs covering several run types pass it explicitly
+    def record(self, state, suffix, status, s3_key=None, attempts=None, error=None,
+               run_type=None):
+        record = {
+            'run_type': run_type or self.run_type,
+            'state': state,
+            'suffix': suffix,
+            'status': status,
+            's3_key': s3_key,
+            'attempts': attempts,
+            'error': str(error) if error is not None else None,
+        }
+        with self._lock:
+            self._latest[(record['run_type'], state, suffix)] = record
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+
+    # returns the last recorded status of a capture, or None if it has none; suffix is None for
+    # the state's config, which fails the whole state if it can't be loaded
+    def status(self, state, suffix, run_type=None):
+        with self._lock:
+            record = self._latest.get((run_type or self.run_type, state, suffix))
+        return record['status'] if record is not None else None
+
+    def is_complete(self, state, suffix, run_type=None):
+        return self.status(state, suffix, run_type=run_type) in COMPLETE_STATUSES
+
+    def records(self):
+        with self._lock:
+            return list(self._latest.values())
+
+    # returns (state, suffix, error message) for every capture of run_type (by default the
+    # manifest's) that failed or never finished. A state whose config couldn't be loaded has the
+    # state as its suffix, as in the errors Screenshotter.screenshot returns.
+    def failures(self, run_type=None):
+        failures = []
+        for record in self.records():
+            if record['run_type'] != (run_type or self.run_type):
+                continue
+            if record['status'] == FAILED:
+                failures.append(
+                    (record['state'], record['suffix'] or record['state'], record['error']))
+            elif record['status'] == PENDING:
+                failures.append(
+                    (record['state'], record['suffix'], 'did not finish before the run stopped'))
+        return failures
+
+    def close(self):
+        with self._lock:
+            self._file.close()
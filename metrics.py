@@ -0,0 +1,239 @@
+""" Per-capture timings and sizes for a run, written out as a JSON report and Prometheus metrics."""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+import threading
+import time
+
+from pytz import timezone
+
+from downloads import write_json_atomically, write_text_atomically
+from manifest import PENDING
+
+
+# summed over attempts: a capture that took 3 attempts shows the time spent on all of them
+_SUMMED_FIELDS = [
+    'resolve_seconds', 'slot_wait_seconds', 'render_seconds', 'download_seconds',
+    'renders', 'credits', 'downloads', 'bytes', 'upload_seconds', 'uploads', 'upload_bytes',
+    'png_bytes_before', 'png_bytes_after', 'derivative_bytes', 'optimize_cpu_seconds',
+    'hedges', 'hedges_won']
+
+
+class CaptureMetrics():
+    """Timings, sizes and outcome of capturing one link (run type, state, suffix).
+
+    Fields:
+      kind: render or file
+      queue_wait_seconds: time between being scheduled and starting, with --workers
+      resolve_seconds: time spent resolving an `eval` URL
+      slot_wait_seconds: time spent waiting on per-host/per-key concurrency limits
+      render_seconds, renders: PhantomJSCloud request time and number of requests
+      credits: PhantomJSCloud credits those requests cost, as reported in their billing info
+      hedges, hedges_won: hedged renders sent alongside a slow render (not counted in renders),
+        and how many of them finished first
+      download_seconds, downloads: `file:` download time and number of requests
+      bytes: size of the captured body, summed over attempts
+      upload_queue_seconds: time waiting in the upload pipeline before the first upload attempt
+      upload_seconds, uploads, upload_bytes: S3 upload time, count and size (one per run type,
+        and per derivative)
+      png_bytes_before, png_bytes_after, derivative_bytes, optimize_cpu_seconds: PNG sizes before
+        and after postprocess.PngOptimizer, the size of its derivatives and the CPU time it took
+      attempts, status, error: as recorded in the run manifest
+      copy_of: for a link deduplicated into another run type's capture, that capture's key
+    """
+
+    def __init__(self, run_type, state, suffix):
+        self.run_type = run_type
+        self.state = state
+        self.suffix = suffix
+        self._lock = threading.Lock()
+        self._queued_at = None
+        self.values = OrderedDict(status=PENDING)
+
+    def set(self, **values):
+        with self._lock:
+            self.values.update(values)
+
+    def setdefault(self, name, value):
+        with self._lock:
+            self.values.setdefault(name, value)
+
+    def add(self, **increments):
+        with self._lock:
+            for name, value in increments.items():
+                self.values[name] = self.values.get(name, 0) + value
+
+    # adds the time spent in the block to the named field, even if it raises
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(**{name: time.perf_counter() - start})
+
+    def mark_queued(self):
+        self._queued_at = time.perf_counter()
+
+    def mark_started(self):
+        if self._queued_at is not None:
+            self.setdefault('queue_wait_seconds', time.perf_counter() - self._queued_at)
+
+    def to_dict(self):
+        with self._lock:
+            record = OrderedDict(run_type=self.run_type, state=self.state, suffix=self.suffix)
+            record.update(self.values)
+        return record
+
+
+class RunMetrics():
+    """Collects CaptureMetrics for every link of a run, which may cover several run types."""
+
+    def __init__(self, run_label):
+        self.run_label = run_label
+        self.started_at = datetime.now(timezone('US/Eastern'))
+        self._start = time.perf_counter()
+        self.duration = None
+        self._lock = threading.Lock()
+        self._captures = OrderedDict()  # (run type, state, suffix) -> CaptureMetrics
+
+    def capture(self, run_type, state, suffix):
+        key = (run_type, state, suffix)
+        with self._lock:
+            metrics = self._captures.get(key)
+            if metrics is None:
+                metrics = CaptureMetrics(run_type, state, suffix)
+                self._captures[key] = metrics
+        return metrics
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+
+    def captures(self):
+        with self._lock:
+            return [metrics.to_dict() for metrics in self._captures.values()]
+
+    # run type -> state -> totals over that state's captures
+    def state_totals(self, captures=None):
+        totals = OrderedDict()
+        for record in captures or self.captures():
+            state_totals = totals.setdefault(record['run_type'], OrderedDict()).setdefault(
+                record['state'], OrderedDict((field, 0) for field in ['captures'] + _SUMMED_FIELDS))
+            state_totals['captures'] += 1
+            state_totals.setdefault('statuses', {})
+            state_totals['statuses'][record['status']] = (
+                state_totals['statuses'].get(record['status'], 0) + 1)
+            for field in _SUMMED_FIELDS:
+                state_totals[field] += record.get(field, 0)
+        return totals
+
+    def report(self, run_id=None):
+        captures = self.captures()
+        statuses = {}
+        for record in captures:
+            statuses[record['status']] = statuses.get(record['status'], 0) + 1
+        totals = OrderedDict(
+            (field, sum(record.get(field, 0) for record in captures)) for field in _SUMMED_FIELDS)
+        if totals['png_bytes_before']:
+            totals['png_compression_ratio'] = totals['png_bytes_after'] / totals['png_bytes_before']
+        return OrderedDict([
+            ('run', self.run_label),
+            ('run_id', run_id),
+            ('started_at', self.started_at.isoformat()),
+            ('duration_seconds', self.duration),
+            ('captures', len(captures)),
+            ('statuses', statuses),
+            ('totals', totals),
+            ('states', self.state_totals(captures)),
+            ('links', captures),
+        ])
+
+    def prometheus_text(self):
+        """Returns the run's metrics in the Prometheus text exposition format.
+
+        Meant for node_exporter's textfile collector: one gauge per run, and per run type and
+        state, so dashboards can show run duration and PhantomJSCloud usage per state.
+        """
+
+        lines = []
+
+        def gauge(name, help_text, samples):
+            lines.append('# HELP screenshots_%s %s' % (name, help_text))
+            lines.append('# TYPE screenshots_%s gauge' % name)
+            for labels, value in samples:
+                label_str = ','.join(
+                    '%s="%s"' % (label, _escape_label(label_value))
+                    for label, label_value in labels.items())
+                lines.append('screenshots_%s{%s} %s' % (name, label_str, _format_value(value)))
+
+        run = {'run': self.run_label}
+        captures = self.captures()
+        gauge('run_duration_seconds', 'Wall time of the last run.', [(run, self.duration or 0)])
+        gauge('run_timestamp_seconds', 'Start time of the last run.',
+              [(run, self.started_at.timestamp())])
+
+        statuses = OrderedDict()
+        for record in captures:
+            key = (record['run_type'], record['status'])
+            statuses[key] = statuses.get(key, 0) + 1
+        gauge('captures', 'Captures in the last run by status.', [
+            (dict(run, run_type=run_type, status=status), count)
+            for (run_type, status), count in statuses.items()])
+
+        totals = self.state_totals(captures)
+        per_state = [
+            ('state_render_seconds', 'render_seconds', 'PhantomJSCloud request time per state.'),
+            ('state_renders', 'renders', 'PhantomJSCloud requests per state.'),
+            ('state_render_credits', 'credits', 'PhantomJSCloud credits spent per state.'),
+            ('state_hedges', 'hedges', 'Hedged PhantomJSCloud requests per state.'),
+            ('state_download_seconds', 'download_seconds', 'File download time per state.'),
+            ('state_bytes', 'bytes', 'Bytes captured per state.'),
+            ('state_upload_seconds', 'upload_seconds', 'S3 upload time per state.'),
+            ('state_upload_bytes', 'upload_bytes', 'Bytes uploaded to S3 per state.'),
+        ]
+        for name, field, help_text in per_state:
+            gauge(name, help_text, [
+                (dict(run, run_type=run_type, state=state), state_totals[field])
+                for run_type, states in totals.items()
+                for state, state_totals in states.items()])
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, report_path=None, textfile_path=None, run_id=None):
+        if report_path:
+            write_json_atomically(report_path, self.report(run_id=run_id), sort_keys=False)
+        if textfile_path:
+            # written atomically, as the textfile collector may read it at any time
+            write_text_atomically(textfile_path, self.prometheus_text())
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def merge_prometheus_texts(texts):
+    """Combines several texts from RunMetrics.prometheus_text (e.g. the last run of each run
+    type) into one exposition, with each metric's HELP and TYPE lines given once. Texts from the
+    same run repeat its samples, which are kept once.
+    """
+
+    families = OrderedDict()  # metric name -> [HELP line, TYPE line, samples...]
+    series = set()
+    name = None
+    for text in texts:
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                name = line.split()[2]
+                families.setdefault(name, [line])
+            elif line.startswith('# TYPE '):
+                if len(families[name]) == 1:
+                    families[name].append(line)
+            elif line and line.rsplit(' ', 1)[0] not in series:
+                series.add(line.rsplit(' ', 1)[0])
+                families[name].append(line)
+    return ''.join('\n'.join(lines) + '\n' for lines in families.values())
@@ -0,0 +1,75 @@
+""" Capture -> upload pipeline: S3 uploads run on their own thread pool, fed by a bounded queue."""
+
+import queue
+import threading
+
+from loguru import logger
+
+from retries import RetryPolicy
+
+
+class UploadPipeline():
+    """Drains a bounded queue of finished captures into S3 using a pool of uploader threads.
+
+    Captures block in submit() while the queue is full, so rendering can't run arbitrarily far
+    ahead of uploading. Uploads are retried with their own policy, so a failed upload never
+    triggers a new render. Call drain() once all captures are submitted.
+    """
+
+    def __init__(self, workers=4, queue_size=32, retry_policy=None):
+        self.retry_policy = retry_policy or RetryPolicy()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._threads = [
+            threading.Thread(target=self._work, name='uploader-%d' % i, daemon=True)
+            for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    # queues upload (a callable doing the actual S3 upload) to run on an uploader thread.
+    # description is used for logging; failures are reported by drain() under key. on_success
+    # is called from the uploader thread once the upload is done, and fileobj (if given) is
+    # closed once the upload has succeeded or given up.
+    def submit(self, upload, description, key, on_success=None, fileobj=None):
+        self._queue.put((upload, description, key, on_success, fileobj))
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._upload(*item)
+            finally:
+                self._queue.task_done()
+
+    def _upload(self, upload, description, key, on_success, fileobj):
+        try:
+            self.retry_policy.call(upload, f'Upload {description}')
+        except Exception as e:
+            with self._lock:
+                self._failures[key] = e
+            return
+        else:
+            if on_success:
+                try:
+                    on_success()
+                except Exception as e:
+                    logger.error(f'Post-upload step for {description} failed: {e}')
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+
+    def drain(self):
+        """Waits for all queued uploads to finish and stops the uploaders.
+
+        Returns a dict of key -> error for uploads that failed every attempt.
+        """
+        logger.info('Waiting for queued uploads to finish')
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        with self._lock:
+            return dict(self._failures)
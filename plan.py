@@ -0,0 +1,126 @@
+""" Request plans: the exact request every link of a run would make, compiled without capturing.
+
+A plan is a JSONL file with one line per (run type, state, link), sorted by that key:
+
+  {"run_type": "core", "state": "NY", "suffix": "primary", "url": ..., "request": {...}}
+  {"run_type": "core", "state": "NY", "suffix": "secondary", "url": ..., "file": "pdf"}
+  {"run_type": "core", "state": "ZZ", "suffix": null, "error": "Error getting config for ZZ: ..."}
+
+"request" is the PhantomJSCloud payload Screenshotter.save_url_image_to_path would post, and file
+links have the file type they would download instead. Plans of two config trees are compared with
+diff_plans (see scripts/plan_diff.py), which streams both files side by side.
+"""
+
+from datetime import date
+import json
+
+
+# sort key of a plan entry; a state's config error sorts before its links
+def entry_key(entry):
+    return (entry['run_type'], entry['state'], entry['suffix'] or '')
+
+
+def compile_plan(screenshotters, states, which_screenshot='', today=None):
+    """Returns the plan entries of every link the screenshotters (run type -> Screenshotter)
+    would capture for states, sorted. Dynamic URLs are resolved for today (a date), without
+    probing for earlier dates as a run with date fallbacks would.
+    """
+    today = today or date.today()
+    entries = []
+    for run_type, screenshotter in screenshotters.items():
+        for state in states:
+            links, errors = screenshotter.load_links(state, which_screenshot)
+            for error in (errors or {}).values():
+                entries.append(
+                    {'run_type': run_type, 'state': state, 'suffix': None, 'error': error})
+            for state_config in links or []:
+                suffix = state_config['name']
+                entry = {'run_type': run_type, 'state': state, 'suffix': suffix}
+                try:
+                    data_url = screenshotter.resolve_url(
+                        state, state_config, probe=False, today=today)
+                except Exception as e:
+                    entry['error'] = 'Could not resolve URL: %s' % e
+                    entries.append(entry)
+                    continue
+                entry['url'] = data_url
+                if state_config.get('file'):
+                    entry['file'] = state_config['file']
+                else:
+                    entry['request'] = screenshotter.render_request(
+                        state, suffix, data_url, state_config)
+                entries.append(entry)
+    return sorted(entries, key=entry_key)
+
+
+def write_plan(entries, path):
+    with open(path, 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+def read_plan(path):
+    """Yields the entries of the plan at path in order, checking that it is sorted."""
+    previous = None
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            key = entry_key(entry)
+            if previous is not None and key < previous:
+                raise ValueError('%s is not a sorted plan: line %d is out of order' % (
+                    path, line_number))
+            previous = key
+            yield entry
+
+
+# the entry with whitespace removed from any overseerScript, for comparing scripts that were
+# only reformatted
+def _without_script_whitespace(entry):
+    script = (entry.get('request') or {}).get('overseerScript')
+    if not script:
+        return entry
+    request = dict(entry['request'], overseerScript=''.join(script.split()))
+    return dict(entry, request=request)
+
+
+def diff_plans(old_path, new_path, ignore_script_whitespace=False):
+    """Yields (change, key, old entry, new entry) for each link that differs between two plans,
+    in plan order: change is '+' for a link only in the new plan, '-' for one only in the old,
+    and '~' for one whose entry changed. Reads both plans one line at a time.
+    """
+    old_entries, new_entries = read_plan(old_path), read_plan(new_path)
+    old, new = next(old_entries, None), next(new_entries, None)
+    while old is not None or new is not None:
+        old_key = entry_key(old) if old is not None else None
+        new_key = entry_key(new) if new is not None else None
+        if new_key is None or (old_key is not None and old_key < new_key):
+            yield '-', old_key, old, None
+            old = next(old_entries, None)
+        elif old_key is None or new_key < old_key:
+            yield '+', new_key, None, new
+            new = next(new_entries, None)
+        else:
+            if ignore_script_whitespace:
+                changed = _without_script_whitespace(old) != _without_script_whitespace(new)
+            else:
+                changed = old != new
+            if changed:
+                yield '~', old_key, old, new
+            old, new = next(old_entries, None), next(new_entries, None)
+
+
+def changed_fields(old, new, prefix=''):
+    """Returns (field, old value, new value) for each field that differs between two entries,
+    descending into nested dicts, with dotted field names.
+    """
+    changes = []
+    for field in sorted(set(old) | set(new)):
+        name = prefix + field
+        old_value, new_value = old.get(field), new.get(field)
+        if isinstance(old_value, dict) and isinstance(new_value, dict):
+            changes.extend(changed_fields(old_value, new_value, prefix=name + '.'))
+        elif old_value != new_value:
+            changes.append((name, old_value, new_value))
+    return changes
@@ -0,0 +1,148 @@
+""" Optional post-processing of PNG captures before upload, run in a process pool.
+
+PNGs are re-encoded losslessly at maximum compression, and optionally get a WebP derivative and a
+small thumbnail of the top of the page. Needs Pillow; without it captures are uploaded as is.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import io
+import os
+import tempfile
+import time
+
+from loguru import logger
+
+from s3_index import THUMBNAIL_SUFFIX, WEBP_SUFFIX
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional
+    Image = None
+
+
+def _optimize(path, data, webp_quality, thumbnail_width):
+    """Runs in a worker process. Re-encodes the PNG at path (or given as data) and makes any
+    derivatives; files are written next to path, and bytes are returned for in-memory data.
+
+    Returns a dict with the original and optimized sizes, the SHA-256 of the optimized PNG (None
+    if it wasn't any smaller), the CPU seconds used, the optimized PNG (None if it wasn't any
+    smaller, or if it was written to path) and the derivatives, as a list of (name suffix, path,
+    bytes).
+    """
+    start = time.process_time()
+    if path is not None:
+        with open(path, 'rb') as f:
+            data = f.read()
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG', optimize=True)
+        optimized = buffer.getvalue()
+
+        encoded = []
+        if webp_quality:
+            buffer = io.BytesIO()
+            image.save(buffer, format='WEBP', quality=webp_quality, lossless=webp_quality >= 100,
+                       method=6)
+            encoded.append((WEBP_SUFFIX, buffer.getvalue()))
+        if thumbnail_width:
+            # the top of the page, as tall as it is wide, scaled down to thumbnail_width
+            thumbnail = image.crop((0, 0, image.width, min(image.height, image.width)))
+            thumbnail.thumbnail((thumbnail_width, thumbnail_width))
+            buffer = io.BytesIO()
+            thumbnail.save(buffer, format='PNG', optimize=True)
+            encoded.append((THUMBNAIL_SUFFIX, buffer.getvalue()))
+
+    if len(optimized) >= len(data):
+        optimized = None  # keep the original
+    optimized_bytes = len(optimized) if optimized is not None else len(data)
+    optimized_sha256 = hashlib.sha256(optimized).hexdigest() if optimized is not None else None
+
+    derivatives = []
+    if path is not None:
+        if optimized is not None:
+            _write_atomically(path, optimized)
+            optimized = None
+        for suffix, derivative in encoded:
+            derivative_path = os.path.splitext(path)[0] + suffix
+            _write_atomically(derivative_path, derivative)
+            derivatives.append((suffix, derivative_path, None))
+    else:
+        derivatives = [(suffix, None, derivative) for suffix, derivative in encoded]
+
+    return {
+        'original_bytes': len(data),
+        'optimized_bytes': optimized_bytes,
+        'optimized_sha256': optimized_sha256,
+        'optimized': optimized,
+        'derivatives': derivatives,
+        'cpu_seconds': time.process_time() - start,
+    }
+
+
+def _write_atomically(path, data):
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.', prefix='.%s.' % os.path.basename(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+class PngOptimizer():
+    """Re-encodes PNG captures in a pool of worker processes, so it can use every core while
+    captures run on threads.
+
+    optimize() blocks the calling capture thread until its PNG is done.
+    """
+
+    def __init__(self, workers=None, webp_quality=0, thumbnail_width=0):
+        self.webp_quality = webp_quality
+        self.thumbnail_width = thumbnail_width
+        self._executor = None
+        if Image is None:
+            logger.warning('Pillow is not installed: PNGs will be uploaded without optimizing')
+            return
+        self._executor = ProcessPoolExecutor(max_workers=workers or None)
+
+    @property
+    def enabled(self):
+        return self._executor is not None
+
+    def optimize(self, stats, path, metrics=None):
+        """Optimizes the PNG capture with the given downloads.DownloadStats, saved at path or held
+        in stats.fileobj, in place. Sets stats.nbytes and stats.upload_sha256 to the new size and
+        hash, and stats.derivatives to any derivatives made; stats.sha256 stays the hash of the
+        capture as made.
+        """
+        if not self.enabled:
+            return
+        data = None
+        if stats.fileobj is not None:
+            stats.fileobj.seek(0)
+            data = stats.fileobj.read()
+            path = None
+        result = self._executor.submit(
+            _optimize, path, data, self.webp_quality, self.thumbnail_width).result()
+
+        if result['optimized'] is not None:
+            stats.fileobj.seek(0)
+            stats.fileobj.truncate()
+            stats.fileobj.write(result['optimized'])
+        stats.nbytes = result['optimized_bytes']
+        if result['optimized_sha256'] is not None:
+            stats.upload_sha256 = result['optimized_sha256']
+        stats.derivatives = result['derivatives']
+        if metrics:
+            metrics.add(
+                png_bytes_before=result['original_bytes'],
+                png_bytes_after=result['optimized_bytes'],
+                derivative_bytes=sum(
+                    os.path.getsize(derivative_path) if derivative_path else len(derivative)
+                    for _, derivative_path, derivative in result['derivatives']),
+                optimize_cpu_seconds=result['cpu_seconds'])
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
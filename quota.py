@@ -0,0 +1,132 @@
+""" Tracking of PhantomJSCloud credit usage, and degrading a run that would go over budget."""
+
+import threading
+
+from loguru import logger
+
+from retries import CaptureError
+
+
+# prefix of every over-budget skip message, so skipped links can be picked out of failures that
+# were reloaded from a manifest as plain strings
+BUDGET_SKIP_PREFIX = 'Skipped to stay within the PhantomJSCloud budget'
+
+# PhantomJSCloud reports billing both as response headers (on every response) and in the
+# meta.billing block of JSON responses (which is what we get back on errors)
+_BILLING_HEADERS = {
+    'pjsc-billing-credit-cost': 'creditCost',
+    'pjsc-billing-daily-subscription-credits-remaining': 'dailySubscriptionCreditsRemaining',
+    'pjsc-billing-prepaid-credits-remaining': 'prepaidCreditsRemaining',
+}
+
+# assumed credits per render until PhantomJSCloud has told us what renders cost
+_DEFAULT_CREDIT_COST = 1.0
+
+
+def billing_from_response(response, response_json=None):
+    """Returns the billing fields of a PhantomJSCloud response as a dict of floats."""
+    billing = {}
+    for header, field in _BILLING_HEADERS.items():
+        value = response.headers.get(header)
+        if value is not None:
+            billing[field] = value
+    meta = (response_json or {}).get('meta')
+    if isinstance(meta, dict) and isinstance(meta.get('billing'), dict):
+        billing.update(meta['billing'])
+
+    parsed = {}
+    for field in _BILLING_HEADERS.values():
+        try:
+            parsed[field] = float(billing[field])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return parsed
+
+
+class RenderQuota():
+    """Credits spent on renders this run, the account's remaining credits, and the run's budget.
+
+    Links report themselves with plan() when they're loaded and with done() once captured or
+    given up on. Before each render, check() projects the run's total spend as what's been spent
+    plus the average cost per render so far times the renders still to go. If that is over the
+    budget, or over what the account has left, links whose suffix is in skip_suffixes are skipped
+    with a permanent error; every other link is still captured.
+    """
+
+    def __init__(self, budget_credits=None, skip_suffixes=(), log_every=25):
+        self.budget_credits = budget_credits
+        self.skip_suffixes = set(skip_suffixes)
+        self.log_every = log_every
+        self._lock = threading.Lock()
+        self.renders = 0
+        self.credits_spent = 0.0
+        self.credits_remaining = None
+        self.skipped = 0
+        self._planned = 0
+        self._done = 0
+
+    def plan(self, links):
+        with self._lock:
+            self._planned += links
+
+    def done(self, links=1):
+        with self._lock:
+            self._done += links
+
+    def average_cost(self):
+        with self._lock:
+            return self.credits_spent / self.renders if self.renders else _DEFAULT_CREDIT_COST
+
+    def projected_remaining(self):
+        with self._lock:
+            pending = max(self._planned - self._done, 0)
+        return pending * self.average_cost()
+
+    def over_budget(self):
+        projected = self.projected_remaining()
+        with self._lock:
+            limits = []
+            if self.budget_credits:
+                limits.append(self.budget_credits - self.credits_spent)
+            if self.credits_remaining is not None:
+                limits.append(self.credits_remaining)
+        return bool(limits) and projected > min(limits)
+
+    # raises a permanent CaptureError if this link should be skipped to stay within budget
+    def check(self, state, suffix):
+        if suffix not in self.skip_suffixes or not self.over_budget():
+            return
+        with self._lock:
+            self.skipped += 1
+        raise CaptureError(
+            '%s: projected spend of %.1f more credits for this run is over budget (%s)' % (
+                BUDGET_SKIP_PREFIX, self.projected_remaining(), self.describe()),
+            permanent=True)
+
+    # records the billing info of a render response; returns the credits it cost
+    def record(self, response, response_json=None):
+        billing = billing_from_response(response, response_json)
+        cost = billing.get('creditCost', 0.0)
+        with self._lock:
+            self.renders += 1
+            self.credits_spent += cost
+            if 'dailySubscriptionCreditsRemaining' in billing \
+                    or 'prepaidCreditsRemaining' in billing:
+                self.credits_remaining = (
+                    billing.get('dailySubscriptionCreditsRemaining', 0)
+                    + billing.get('prepaidCreditsRemaining', 0))
+            renders = self.renders
+        if self.log_every and renders % self.log_every == 0:
+            logger.info(f'PhantomJSCloud usage: {self.describe()}')
+        return cost
+
+    def describe(self):
+        with self._lock:
+            text = '%d renders, %.1f credits spent' % (self.renders, self.credits_spent)
+            if self.credits_remaining is not None:
+                text += ', %.1f credits remaining on the account' % self.credits_remaining
+            if self.budget_credits:
+                text += ', run budget %.1f credits' % self.budget_credits
+            if self.skipped:
+                text += ', %d links skipped' % self.skipped
+        return text
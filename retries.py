@@ -0,0 +1,194 @@
+""" Retry policy for screenshot captures: exponential backoff with jitter, honoring Retry-After."""
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
+import threading
+import time
+
+from loguru import logger
+
+
+# 4xx statuses that are worth retrying; every other 4xx is treated as a permanent config mistake
+_RETRYABLE_CLIENT_STATUSES = {408, 425, 429}
+
+
+class CaptureError(ValueError):
+    """A failed capture, keeping the HTTP status and any Retry-After hint from the response.
+
+    from_target is False for errors of the render service itself (e.g. PhantomJSCloud's quota or
+    its own server errors), which say nothing about the captured site.
+    """
+
+    def __init__(self, message, status_code=None, retry_after=None, permanent=None,
+                 from_target=True):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self._permanent = permanent
+        self.from_target = from_target
+
+    @property
+    def permanent(self):
+        if self._permanent is not None:
+            return self._permanent
+        return is_permanent_status(self.status_code)
+
+
+# whether a failed request with this HTTP status isn't worth retrying
+def is_permanent_status(status_code):
+    return (status_code is not None and 400 <= status_code < 500
+            and status_code not in _RETRYABLE_CLIENT_STATUSES)
+
+
+# prefix of every circuit-open error message, so skipped links can be picked out of failures that
+# were reloaded from a manifest as plain strings
+CIRCUIT_OPEN_PREFIX = 'Circuit open for'
+
+
+class CircuitOpenError(CaptureError):
+    """A capture skipped without a request, because its host failed repeatedly."""
+
+    def __init__(self, host, failures, last_error):
+        super().__init__(
+            '%s %s after %d consecutive failures, skipped (last error: %s)' % (
+                CIRCUIT_OPEN_PREFIX, host, failures, str(last_error)[:300]),
+            permanent=True)
+        self.host = host
+
+
+def parse_retry_after(response):
+    # Retry-After is either a number of seconds or an HTTP date; returns seconds, or None
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def error_from_response(response, message, from_target=True, permanent=None):
+    retry_after = None
+    if response.status_code in (429, 503):
+        retry_after = parse_retry_after(response)
+    return CaptureError(message, status_code=response.status_code, retry_after=retry_after,
+                        permanent=permanent, from_target=from_target)
+
+
+class RetryPolicy():
+    """Decides whether and when to retry a failed capture.
+
+    Delays grow exponentially from base_delay up to max_delay, with jitter so parallel workers
+    don't retry in lockstep. A Retry-After hint from the server takes precedence, capped at
+    max_delay so one throttled link can't stall a run.
+    """
+
+    def __init__(self, attempts=4, base_delay=2.0, max_delay=60.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    # attempt is 1-based: the number of attempts made so far
+    def should_retry(self, err, attempt):
+        if attempt >= self.attempts:
+            return False
+        if isinstance(err, CaptureError) and err.permanent:
+            return False
+        return True
+
+    def delay(self, err, attempt):
+        retry_after = getattr(err, 'retry_after', None)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(backoff / 2, backoff)
+
+    def call(self, fn, description):
+        """Calls fn() until it succeeds or the policy gives up, re-raising the last error."""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return fn()
+            except Exception as e:
+                logger.error(f'{description} failed attempt %d' % attempt)
+                if not self.should_retry(e, attempt):
+                    raise
+                delay = self.delay(e, attempt)
+                logger.info(f'Retrying {description} in {delay:.1f}s')
+                time.sleep(delay)
+
+
+class CircuitBreaker():
+    """Stops sending requests to a host after `threshold` consecutive failed requests to it.
+
+    While a host's circuit is open, before() raises CircuitOpenError straight away. Once
+    `cooldown` seconds have passed, one request is let through as a probe: if it succeeds the
+    circuit closes, otherwise it stays open for another cooldown. Every failure of the site
+    counts, whether it didn't respond or answered with an error. Failures of the render service
+    rather than the site are reported with inconclusive(), which counts neither way. A threshold
+    of 0 or None disables the breaker.
+    """
+
+    def __init__(self, threshold=5, cooldown=300.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._hosts = {}  # host -> {'failures', 'opened_at', 'probing', 'last_error'}
+
+    def _host(self, host):
+        return self._hosts.setdefault(
+            host, {'failures': 0, 'opened_at': None, 'probing': False, 'last_error': None})
+
+    def before(self, host):
+        if not self.threshold:
+            return
+        with self._lock:
+            state = self._host(host)
+            if state['opened_at'] is None:
+                return
+            if not state['probing'] and time.monotonic() - state['opened_at'] >= self.cooldown:
+                logger.info(f'Probing {host} after its circuit cooldown')
+                state['probing'] = True
+                return
+            raise CircuitOpenError(host, state['failures'], state['last_error'])
+
+    def success(self, host):
+        if not self.threshold:
+            return
+        with self._lock:
+            state = self._host(host)
+            if state['opened_at'] is not None:
+                logger.info(f'Closing circuit for {host}')
+            self._hosts[host] = {
+                'failures': 0, 'opened_at': None, 'probing': False, 'last_error': None}
+
+    def failure(self, host, err):
+        if not self.threshold:
+            return
+        with self._lock:
+            state = self._host(host)
+            state['failures'] += 1
+            state['last_error'] = err
+            if state['probing'] or (
+                    state['opened_at'] is None and state['failures'] >= self.threshold):
+                logger.error(
+                    f'Opening circuit for {host} after {state["failures"]} consecutive failures')
+                state['opened_at'] = time.monotonic()
+                state['probing'] = False
+
+    # a request that failed for reasons unrelated to the host; if it was the probe, the next
+    # request probes again
+    def inconclusive(self, host):
+        if not self.threshold:
+            return
+        with self._lock:
+            self._host(host)['probing'] = False
@@ -1,17 +1,29 @@
 """ Main script to run image capture screenshots for state data pages. """
 
-import io
+from collections import OrderedDict
+from datetime import datetime
 import os
 import sys
 
 from loguru import logger
-import pandas as pd
-import requests
-import yaml
 
 from args import parser as screenshots_parser
+from config_index import ConfigIndex
+from dedupe import CaptureIndex
+from downloads import DiskCache, ValidatorCache
+from hedge import HedgePolicy
+from history import CaptureHistory
+from manifest import FAILED, RunManifest
+from metrics import RunMetrics
+from pipeline import UploadPipeline
+from quota import BUDGET_SKIP_PREFIX, RenderQuota
+from retries import CIRCUIT_OPEN_PREFIX, CircuitBreaker, RetryPolicy
+from scheduler import CaptureScheduler, KeyedLimiter, TokenBucket
 from screenshotter import Screenshotter
-from utils import S3Backup, SlackNotifier
+from utils import S3Backup, SlackNotifier, make_http_session, make_transfer_config
+
+# catalog, daemon, plan, postprocess and shard are imported by the code paths that use them, so a
+# run that leaves their flags off doesn't pay for sqlite3, http.server or process pools at start-up
 
 
 _ALL_STATES = [
@@ -20,6 +32,15 @@ _ALL_STATES = [
     'NE', 'NH', 'NJ', 'NM', 'NV', 'NY', 'OH', 'OK', 'OR', 'PA', 'PR', 'RI', 'SC', 'SD', 'TN', 'TX',
     'UT', 'VA', 'VI', 'VT', 'WA', 'WI', 'WV', 'WY', 'US']
 
+# run type -> config subdirectory
+_RUN_TYPE_CONFIG_DIRS = OrderedDict([
+    ('core', 'taco'),
+    ('CRDT', 'crdt'),
+    ('LTC', 'ltc'),
+    ('vaccine', 'vax'),
+    ('variants', 'variants'),
+])
+
 
 def states_from_args(args):
     # if states are user-specified, snapshot only those
@@ -31,19 +52,22 @@ def states_from_args(args):
         return _ALL_STATES
 
 
-def config_dir_from_args(args):
-    if args.core_urls:
-        subdir = 'taco'
-    elif args.crdt_urls:
-        subdir = 'crdt'
-    elif args.ltc_urls:
-        subdir = 'ltc'
-    elif args.vax_urls:
-        subdir = 'vax'
-    elif args.variant_urls:
-        subdir = 'variants'
+def config_dir_for_run_type(run_type):
+    return os.path.join(os.path.dirname(__file__), 'configs', _RUN_TYPE_CONFIG_DIRS[run_type])
+
+
+def retry_policy_from_args(args):
+    return RetryPolicy(
+        attempts=args.retry_attempts, base_delay=args.retry_base_delay,
+        max_delay=args.retry_max_delay)
 
-    return os.path.join(os.path.dirname(__file__), 'configs', subdir)
+
+def config_index_from_args(args):
+    if args.config_root:
+        # the default cache is for configs/; another tree only uses an explicit --config-cache
+        return ConfigIndex.load(root=args.config_root, cache_path=args.config_cache or None)
+    cache_path = args.config_cache or os.path.join(args.temp_dir, 'config-index.json')
+    return ConfigIndex.load(cache_path=cache_path)
 
 
 def slack_notifier_from_args(args):
@@ -67,64 +91,455 @@ def run_type_from_args(args):
     raise ValueError('no run type specified in args: %s' % args)
 
 
+# Returns a list of (run type, S3 subfolder) pairs for this run: just the one run type unless
+# --run-types was given
+def run_types_from_args(args):
+    if not args.run_types:
+        return [(run_type_from_args(args), args.s3_subfolder)]
+
+    run_types = []
+    for entry in args.run_types.split(','):
+        name, _, s3_subfolder = entry.strip().partition(':')
+        matches = [
+            run_type for run_type in _RUN_TYPE_CONFIG_DIRS if run_type.lower() == name.lower()]
+        if not matches:
+            raise ValueError('unknown run type %s, expected one of %s' % (
+                name, ', '.join(_RUN_TYPE_CONFIG_DIRS)))
+        run_types.append((matches[0], s3_subfolder or args.s3_subfolder))
+    return run_types
+
+
+# Label for a run covering one or more run types, e.g. 'core' or 'core+CRDT'
+def run_label(run_types):
+    return '+'.join(run_type for run_type, _ in run_types)
+
+
+# Returns run type -> ordered dict of state -> errors dict (None if the state has no config) for
+# every state in the run. With --workers > 1 or several run types, links are captured in parallel,
+# and identical links across run types are captured once. If uploads are pipelined, this waits
+# for them to drain and folds upload failures into the errors.
+def capture_states(args, screenshotters, upload_pipeline=None):
+    states = states_from_args(args)
+    if args.workers > 1 or len(screenshotters) > 1:
+        scheduler = CaptureScheduler(
+            screenshotters, max(args.workers, 1), dedupe=len(screenshotters) > 1)
+        results = scheduler.run(states, args.which_screenshot, backup_to_s3=args.push_to_s3)
+    else:
+        run_type, screenshotter = next(iter(screenshotters.items()))
+        results = {run_type: OrderedDict(
+            (state, screenshotter.screenshot(
+                state, args.which_screenshot, backup_to_s3=args.push_to_s3))
+            for state in states)}
+
+    if upload_pipeline:
+        for links, err in upload_pipeline.drain().items():
+            for run_type, state, suffix in links:
+                if results[run_type].get(state) is None:
+                    results[run_type][state] = {}
+                results[run_type][state][suffix] = err
+                screenshotters[run_type].capture_metrics(state, {'name': suffix}).set(
+                    status=FAILED, error=str(err))
+                manifest = screenshotters[run_type].manifest
+                if manifest:
+                    manifest.record(state, suffix, FAILED, error=err, run_type=run_type)
+                catalog = screenshotters[run_type].catalog
+                if catalog:
+                    catalog.record(run_type, state, suffix, FAILED, error=err,
+                                   run_id=screenshotters[run_type].run_id)
+
+    return results
+
+
+def capture_index_from_args(args):
+    if not args.dedupe_captures or args.dry_run:
+        return None
+    return CaptureIndex(
+        args.dedupe_index or os.path.join(args.temp_dir, 'capture-index.json'),
+        max_distance=args.perceptual_dedupe_distance)
+
+
+def catalog_from_args(args):
+    if args.dry_run:
+        return None
+    from catalog import CaptureCatalog
+    return CaptureCatalog(args.catalog or os.path.join(args.temp_dir, 'catalog.sqlite'))
+
+
+def png_optimizer_from_args(args):
+    if not args.optimize_pngs or args.dry_run:
+        return None
+    from postprocess import PngOptimizer
+    return PngOptimizer(
+        workers=args.optimize_workers, webp_quality=args.webp_quality,
+        thumbnail_width=args.thumbnail_width)
+
+
+def hedge_policy_from_args(args, history):
+    if not args.hedge_renders or args.dry_run:
+        return None
+    return HedgePolicy(
+        history, percentile=args.hedge_percentile / 100, max_hedges=args.max_hedges,
+        min_seconds=args.hedge_min_seconds)
+
+
+def disk_cache_from_args(args):
+    if not args.temp_dir_max_mb or args.dry_run:
+        return None
+    return DiskCache(args.temp_dir, int(args.temp_dir_max_mb * 1024 * 1024))
+
+
+def upload_pipeline_from_args(args):
+    if not (args.upload_workers and args.push_to_s3) or args.dry_run:
+        return None
+    return UploadPipeline(
+        workers=args.upload_workers, queue_size=args.upload_queue_size,
+        retry_policy=RetryPolicy(
+            attempts=args.upload_attempts, base_delay=args.retry_base_delay,
+            max_delay=args.retry_max_delay))
+
+
 # This is a special-case function: we're screenshotting IHS data separately for now
-def screenshot_IHS(args):
-    s3 = S3Backup(bucket_name=args.s3_bucket, s3_subfolder='IHS')
-    config_dir = config_dir_from_args(args)
+def screenshot_IHS(args, clients):
+    s3 = S3Backup(
+        bucket_name=args.s3_bucket, s3_subfolder='IHS', endpoint_url=args.s3_endpoint_url,
+        index=args.s3_index)
+    config_dir = config_dir_for_run_type('LTC')
     screenshotter = Screenshotter(
         local_dir=args.temp_dir, s3_backup=s3,
         phantomjscloud_key=args.phantomjscloud_key,
-        dry_run=args.dry_run, config_dir=config_dir)
+        phantomjscloud_url=args.phantomjscloud_url,
+        dry_run=args.dry_run, config_dir=config_dir,
+        session=clients['session'],
+        retry_policy=clients['retry_policy'],
+        config_index=clients['config_index'])
     try:
         screenshotter.screenshot('IHS', 'primary', backup_to_s3=args.push_to_s3)
     except ValueError as e:
         logger.error('IHS screenshot failed: %s' % e)
+    s3.flush_index()
 
 
-def main(args_list=None):
-    if args_list is None:
-        args_list = sys.argv[1:]
-    args = screenshots_parser.parse_args(args_list)
-    s3 = S3Backup(bucket_name=args.s3_bucket, s3_subfolder=args.s3_subfolder)
-    config_dir = config_dir_from_args(args)
+def history_from_args(args):
+    return CaptureHistory(args.history or os.path.join(args.temp_dir, 'history.json'))
+
+
+# Returns the manifest for this run (a resumed one if --resume is set), or None on a dry run
+def manifest_from_args(args, run_types):
+    if args.dry_run:
+        return None
+    manifest_dir = args.manifest_dir or os.path.join(args.temp_dir, 'runs')
+    manifest = RunManifest.for_run(manifest_dir, run_label(run_types), run_id=args.resume or None)
+    if args.resume and not manifest.resumed:
+        raise ValueError(f'No manifest found for run {args.resume} in {manifest_dir}')
+    logger.info(f'Run manifest at {manifest.path}; resume this run with --resume {manifest.run_id}')
+    return manifest
+
+
+# Returns the shard.ShardPlan for --shard, or None if the run isn't sharded. The plan covers
+# every link of every state and run type in the run, so all shards compute the same one.
+def shard_plan_from_args(args, screenshotters):
+    if not args.shard:
+        return None
+    from shard import ShardPlan, parse_shard, static_cost
+    index, count = parse_shard(args.shard)
+    history = CaptureHistory(args.shard_history) if args.shard_history else None
+    costs = {}
+    for run_type, screenshotter in screenshotters.items():
+        for state in states_from_args(args):
+            try:
+                full_state_config = screenshotter.get_state_config_from_dir(state)
+            except Exception:
+                costs[(run_type, state, None)] = 1.0  # just the error report
+                continue
+            if full_state_config is None:
+                continue
+            for state_config in full_state_config['links']:
+                suffix = state_config['name']
+                if args.which_screenshot and args.which_screenshot != suffix:
+                    continue
+                cost = static_cost(state_config)
+                if history:
+                    cost = history.expected_cost(run_type, state, suffix, default_seconds=cost)
+                costs[(run_type, state, suffix)] = cost
+    plan = ShardPlan.build(index, count, costs)
+    logger.info(f'Capturing {plan.describe()}')
+    return plan
+
+
+def shard_results_from_args(args, run_types, count):
+    from shard import ShardResults
+    return ShardResults(
+        args.shard_results, args.shard_run_id, count, endpoint_url=args.s3_endpoint_url)
+
+
+# Combines the failures each shard of a run wrote to --shard-results into one summary per run type
+def merge_shards(args, run_types):
+    if not args.shard_results:
+        raise ValueError('--merge-shards needs --shard-results')
+    shard_results = shard_results_from_args(args, run_types, args.merge_shards)
+    merged = shard_results.merge([run_type for run_type, _ in run_types])
     slack_notifier = slack_notifier_from_args(args)
-    run_type = run_type_from_args(args)
-    screenshotter = Screenshotter(
-        local_dir=args.temp_dir, s3_backup=s3,
-        phantomjscloud_key=args.phantomjscloud_key,
-        dry_run=args.dry_run, config_dir=config_dir)
-
-    failed_states = []
-    slack_failure_messages = []
-
-    for state in states_from_args(args):
-        errors = screenshotter.screenshot(
-            state, args.which_screenshot, backup_to_s3=args.push_to_s3)
-        if errors is None:
-            continue
-        for suffix, error in errors.items():
-            logger.error(f'Error in {state} {suffix}: {error}')
-            failed_states.append((state, suffix))
-            if slack_notifier:
-                slack_failure_messages.append(f'Error in {state} {suffix}: {error}')
-
-    if failed_states:
-        failed_states_str = ', '.join([':'.join(x) for x in failed_states])
-        logger.error(f"Errored screenshot states for this {run_type} run: {failed_states_str}")
+    for run_type, _ in run_types:
+        report_failures(run_type, merged.get(run_type, []), slack_notifier)
+
+
+# Writes the run's JSON report, and its Prometheus metrics if --prometheus-textfile is set
+def write_run_report(args, metrics, manifest=None):
+    metrics.finish()
+    report_path = args.run_report or os.path.join(args.temp_dir, 'run-report.json')
+    try:
+        metrics.write(
+            report_path=report_path, textfile_path=args.prometheus_textfile,
+            run_id=manifest.run_id if manifest else None)
+    except OSError as e:
+        logger.error(f'Could not write run report: {e}')
+        return
+    logger.info(f'Run report written to {report_path}')
+
+
+# Logs the (state, suffix, error) failures of a run and sends the summary to Slack, with the
+# detailed messages in a thread
+def report_failures(run_type, failures, slack_notifier):
+    for state, suffix, error in failures:
+        logger.error(f'Error in {state} {suffix}: {error}')
+
+    if failures:
+        failed_states_str = ', '.join(['%s:%s' % (state, suffix) for state, suffix, _ in failures])
+        summary = f"Errored screenshot states for this {run_type} run: {failed_states_str}"
+        # links skipped without a request of their own are called out separately
+        for prefix, reason in [
+                (CIRCUIT_OPEN_PREFIX, 'their site kept failing (circuit open)'),
+                (BUDGET_SKIP_PREFIX, 'the run was over its PhantomJSCloud budget')]:
+            skipped = ['%s:%s' % (state, suffix) for state, suffix, error in failures
+                       if str(error).startswith(prefix)]
+            if skipped:
+                summary += '\nSkipped because %s: %s' % (reason, ', '.join(skipped))
+        logger.error(summary)
         if slack_notifier:
-            slack_response = slack_notifier.notify_slack(
-                f"Errored screenshot states for this {run_type} run: {failed_states_str}")
+            slack_response = slack_notifier.notify_slack(summary)
             # put the corresponding messages into a thread
             thread_ts = slack_response.get('ts')
-            for detailed_message in slack_failure_messages:
-                slack_notifier.notify_slack(detailed_message, thread_ts=thread_ts)
+            for state, suffix, error in failures:
+                slack_notifier.notify_slack(
+                    f'Error in {state} {suffix}: {error}', thread_ts=thread_ts)
 
     else:
         logger.info("All attempted states successfully screenshotted")
 
-    # special-case: screenshot IHS data once a day, so attach it to the LTC run
-    if run_type == 'LTC':
-        screenshot_IHS(args)
+
+# Rebuilds and sends the failure summary of an earlier run from its manifest, without capturing
+def summarize_run(args, run_types):
+    manifest_dir = args.manifest_dir or os.path.join(args.temp_dir, 'runs')
+    manifest = RunManifest.for_run(manifest_dir, run_label(run_types), run_id=args.summarize_run)
+    if not manifest.resumed:
+        raise ValueError(f'No manifest found for run {args.summarize_run} in {manifest_dir}')
+    slack_notifier = slack_notifier_from_args(args)
+    for run_type, _ in run_types:
+        report_failures(run_type, manifest.failures(run_type), slack_notifier)
+    manifest.close()
+
+
+# Returns the clients and state reused across runs: pooled HTTP sessions, the Slack client, the
+# compiled config index, limiters and capture history (the S3 resource is shared by utils). A
+# daemon builds these once; a single run builds them, uses them and exits. S3 and Slack clients
+# are only made once something is uploaded or sent.
+def shared_clients_from_args(args):
+    uploads = args.push_to_s3 and not args.dry_run
+    return dict(
+        transfer_config=make_transfer_config(
+            max_concurrency=max(10, args.upload_workers)) if uploads else None,
+        slack_notifier=slack_notifier_from_args(args),
+        session=make_http_session(pool_size=max(10, args.workers)),
+        host_limiter=KeyedLimiter(args.max_requests_per_host),
+        key_limiter=KeyedLimiter(args.max_renders_per_key),
+        retry_policy=retry_policy_from_args(args),
+        validator_cache=ValidatorCache(args.validator_cache) if args.validator_cache else None,
+        config_index=config_index_from_args(args),
+        history=history_from_args(args),
+        circuit_breaker=CircuitBreaker(
+            threshold=args.circuit_breaker_failures, cooldown=args.circuit_breaker_cooldown),
+        render_limiter=TokenBucket(args.renders_per_second, burst=args.render_burst),
+        capture_index=capture_index_from_args(args),
+        png_optimizer=png_optimizer_from_args(args),
+        catalog=catalog_from_args(args))
+
+
+# Captures the given run types once with the shared clients, reports failures and writes the run
+# report. Returns the run's metrics.RunMetrics.
+def run_captures(args, run_types, clients):
+    upload_pipeline = upload_pipeline_from_args(args)
+    manifest = manifest_from_args(args, run_types)
+    metrics = RunMetrics(run_label(run_types))
+    history = clients['history']
+    render_quota = RenderQuota(
+        budget_credits=args.render_budget_credits,
+        skip_suffixes=[suffix for suffix in args.over_budget_skip.split(',') if suffix])
+    hedge_policy = hedge_policy_from_args(args, history)
+    # everything but the S3 subfolder and config dir is shared between run types
+    shared = dict(
+        local_dir=args.temp_dir,
+        phantomjscloud_key=args.phantomjscloud_key,
+        phantomjscloud_url=args.phantomjscloud_url,
+        dry_run=args.dry_run,
+        host_limiter=clients['host_limiter'],
+        key_limiter=clients['key_limiter'],
+        session=clients['session'],
+        retry_policy=clients['retry_policy'],
+        download_timeout=args.download_timeout,
+        max_download_bytes=int(args.max_download_mb * 1024 * 1024),
+        validator_cache=clients['validator_cache'],
+        upload_pipeline=upload_pipeline,
+        in_memory=args.in_memory,
+        spool_bytes=int(args.spool_mb * 1024 * 1024),
+        disk_cache=disk_cache_from_args(args),
+        config_index=clients['config_index'],
+        manifest=manifest,
+        metrics=metrics,
+        history=history,
+        adaptive_max_wait=args.adaptive_max_wait,
+        circuit_breaker=clients['circuit_breaker'],
+        render_limiter=clients['render_limiter'],
+        render_quota=render_quota,
+        date_fallback_days=args.date_fallback_days,
+        capture_index=clients['capture_index'],
+        png_optimizer=clients['png_optimizer'],
+        catalog=clients['catalog'],
+        hedge_policy=hedge_policy)
+
+    screenshotters = OrderedDict()
+    for run_type, s3_subfolder in run_types:
+        s3 = S3Backup(
+            bucket_name=args.s3_bucket, s3_subfolder=s3_subfolder,
+            transfer_config=clients['transfer_config'], endpoint_url=args.s3_endpoint_url,
+            index=args.s3_index)
+        screenshotters[run_type] = Screenshotter(
+            s3_backup=s3, config_dir=config_dir_for_run_type(run_type), run_type=run_type,
+            **shared)
+
+    shard_plan = shard_plan_from_args(args, screenshotters)
+    for screenshotter in screenshotters.values():
+        screenshotter.shard_plan = shard_plan
+
+    results = capture_states(args, screenshotters, upload_pipeline)
+    for screenshotter in screenshotters.values():
+        screenshotter.s3_backup.flush_index()
+    if not args.dry_run:
+        logger.info(f'PhantomJSCloud usage: {render_quota.describe()}')
+    if hedge_policy:
+        logger.info(f'Hedged renders: {hedge_policy.describe()}')
+    if manifest:
+        manifest.close()
+
+    failures = OrderedDict()
+    for run_type, _ in run_types:
+        failures[run_type] = []
+        for state, errors in results[run_type].items():
+            if errors is None:
+                continue
+            for suffix, error in errors.items():
+                failures[run_type].append((state, suffix, error))
+    if shard_plan and args.shard_results:
+        # --merge-shards sends the summary once every shard is done
+        for run_type, run_failures in failures.items():
+            for state, suffix, error in run_failures:
+                logger.error(f'Error in {state} {suffix}: {error}')
+        shard_results_from_args(args, run_types, shard_plan.count).write(
+            shard_plan.index, failures)
+    else:
+        for run_type, run_failures in failures.items():
+            report_failures(run_type, run_failures, clients['slack_notifier'])
+    write_run_report(args, metrics, manifest)
+    if not args.dry_run:
+        history.update(metrics.captures())
+        history.save()
+
+    # special-case: screenshot IHS data once a day, so attach it to the LTC run (its first shard)
+    if 'LTC' in screenshotters and (shard_plan is None or shard_plan.index == 1):
+        screenshot_IHS(args, clients)
+
+    return metrics
+
+
+# Writes the request plan of every link of the run types to --plan, without any network or S3
+# clients, then exits
+def write_request_plan(args, run_types):
+    from plan import compile_plan, write_plan
+    today = datetime.strptime(args.plan_date, '%Y-%m-%d').date() if args.plan_date else None
+    config_index = config_index_from_args(args)
+    history = history_from_args(args) if args.adaptive_max_wait else None
+    screenshotters = OrderedDict(
+        (run_type, Screenshotter(
+            local_dir=args.temp_dir, s3_backup=None, phantomjscloud_key=args.phantomjscloud_key,
+            config_dir=config_dir_for_run_type(run_type), dry_run=True, run_type=run_type,
+            config_index=config_index, history=history,
+            adaptive_max_wait=args.adaptive_max_wait))
+        for run_type, _ in run_types)
+    entries = compile_plan(
+        screenshotters, states_from_args(args), args.which_screenshot, today=today)
+    write_plan(entries, args.plan)
+    logger.info(f'Wrote the plan of {len(entries)} links to {args.plan}')
+
+
+# Runs forever, capturing each run type on its --schedule with clients kept warm between runs,
+# and reloading the config index whenever a YAML under configs/ changes
+def run_daemon(args, run_types, clients):
+    from daemon import RunSchedule, ScreenshotDaemon
+    subfolders = OrderedDict(run_types)
+    schedules = [RunSchedule.parse(text) for text in args.schedule]
+    if not schedules:
+        raise ValueError('--daemon needs at least one --schedule')
+    for schedule in schedules:
+        if schedule.run_type not in subfolders:
+            raise ValueError('schedule %s is for run type %s, which is not in --run-types' % (
+                schedule, schedule.run_type))
+
+    def run(due_run_types):
+        return run_captures(
+            args, [(run_type, subfolders[run_type]) for run_type in due_run_types], clients)
+
+    def reload_configs():
+        if not clients['config_index'].is_stale():
+            return False
+        logger.info('Configs changed on disk, reloading them')
+        clients['config_index'] = config_index_from_args(args)
+        return True
+
+    daemon = ScreenshotDaemon(
+        schedules, run, reload_fn=reload_configs, poll_seconds=args.config_poll_seconds,
+        health_host=args.health_host, health_port=args.health_port)
+    daemon.run_forever()
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = screenshots_parser.parse_args(args_list)
+    run_types = run_types_from_args(args)
+    # checked up front, so a shard doesn't capture for an hour and then fail to write its results
+    if (args.shard_results or args.merge_shards) and not args.shard_run_id:
+        raise ValueError('--shard-results and --merge-shards need a --shard-run-id shared by all '
+                         'shards of the run, e.g. core-20210301-14')
+    if args.summarize_run:
+        summarize_run(args, run_types)
+        return
+    if args.merge_shards:
+        merge_shards(args, run_types)
+        return
+    if args.plan:
+        write_request_plan(args, run_types)
+        return
+
+    clients = shared_clients_from_args(args)
+    try:
+        if args.daemon:
+            run_daemon(args, run_types, clients)
+        else:
+            run_captures(args, run_types, clients)
+    finally:
+        if clients['png_optimizer']:
+            clients['png_optimizer'].shutdown()
+        if clients['catalog']:
+            clients['catalog'].close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,232 @@
+""" Per-folder JSON indexes of the screenshot archive in S3, for the bucket browser.
+
+Listing a state folder through the S3 REST API takes one request per 1000 keys, which for a year
+of captures means many serial round trips. Instead, every upload is also recorded in small JSON
+objects next to the archive, under _index/ (e.g. for state_screenshots/NY/):
+
+  _index/state_screenshots/NY/days.json       {"version": 1, "days": {"20210301": {"count": 4,
+                                                 "bytes": 1234567}, ...}}
+  _index/state_screenshots/NY/20210301.json   {"version": 1, "entries": [{"key": ..., "time": ...,
+                                                 "suffix": ..., "size": ..., "type": ...}, ...]}
+
+so the browser reads one days.json, then only the daily shards of the page it shows. A run buffers
+its uploads and writes each folder's index once, when it ends. Updates use S3 conditional writes,
+so concurrent writers (shards on other hosts) never lose each other's entries. Older botocore
+releases (before late 2024, including every one for Python 3.6) can't send those, so with them
+updates are plain writes, and a warning says concurrent writers may lose entries.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+import json
+import posixpath
+import random
+import re
+import threading
+import time
+
+from loguru import logger
+from pytz import timezone
+
+
+INDEX_ROOT = '_index'
+# name suffixes of the files postprocess.py derives from a capture, appended to the capture's
+# filename minus its extension
+WEBP_SUFFIX = '.webp'
+THUMBNAIL_SUFFIX = '-thumb.png'
+_VERSION = 1
+# capture filenames end in -YYYYMMDD-HHMMSS, possibly followed by a derivative suffix
+_TIMESTAMP_PATTERN = re.compile(r'^(?P<base>.*?)-(?P<day>\d{8})-(?P<time>\d{6})(?=[.-])')
+_CONFLICT_CODES = {'PreconditionFailed', 'ConditionalRequestConflict', '412', '409'}
+_MAX_ATTEMPTS = 8
+
+
+def parse_capture_filename(filename):
+    """Returns (capture time, link suffix) from a capture's filename, as made by
+    Screenshotter.timestamped_filename, or (None, None) if it has no timestamp.
+    """
+    match = _TIMESTAMP_PATTERN.match(posixpath.basename(filename))
+    if not match:
+        return None, None
+    captured_at = timezone('US/Eastern').localize(
+        datetime.strptime(match.group('day') + match.group('time'), '%Y%m%d%H%M%S'))
+    # <state>-<suffix>-<timestamp>, with the primary suffix left out
+    _, _, suffix = match.group('base').partition('-')
+    return captured_at, suffix or 'primary'
+
+
+def index_entry(key, size, content_type=None, last_modified=None):
+    """Returns (day, entry) for the S3 object at key: the Eastern day it was captured, as
+    YYYYMMDD, and its index entry. The time comes from the capture's filename, or from
+    last_modified (a datetime) if it has no timestamp.
+    """
+    eastern = timezone('US/Eastern')
+    captured_at, suffix = parse_capture_filename(key)
+    if captured_at is None:
+        captured_at = (last_modified or datetime.now(eastern)).astimezone(eastern)
+    return captured_at.strftime('%Y%m%d'), {
+        'key': key,
+        'time': captured_at.isoformat(),
+        'suffix': suffix,
+        'size': size,
+        'type': content_type,
+    }
+
+
+def walk_bucket(client, bucket_name, roots, handle_folder, workers=16):
+    """Lists every folder under roots (folder names ending in /) in parallel, one paginated
+    listing per folder, skipping _index/.
+
+    handle_folder(folder, objects) is called on the listing thread for each folder, with the
+    list_objects_v2 entries of the objects directly in it; yields (folder, its result) as folders
+    are done, in no particular order.
+    """
+    def list_folder(folder):
+        objects = []
+        subfolders = []
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=folder, Delimiter='/'):
+            for common_prefix in page.get('CommonPrefixes', []):
+                if not common_prefix['Prefix'].startswith(INDEX_ROOT + '/'):
+                    subfolders.append(common_prefix['Prefix'])
+            objects.extend(
+                item for item in page.get('Contents', []) if not item['Key'].endswith('/'))
+        return handle_folder(folder, objects), subfolders
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(list_folder, root): root for root in roots}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder = pending.pop(future)
+                result, subfolders = future.result()
+                for subfolder in subfolders:
+                    pending[executor.submit(list_folder, subfolder)] = subfolder
+                yield folder, result
+
+
+def index_prefix(folder):
+    return posixpath.join(INDEX_ROOT, folder.strip('/'))
+
+
+class S3FolderIndex():
+    """Reads and updates the _index/ objects of folders in one bucket.
+
+    s3_client is a boto3 S3 client. Updates to a folder are serialized within this process, and
+    retried on conditional write conflicts with other processes.
+    """
+
+    def __init__(self, s3_client, bucket_name):
+        self.client = s3_client
+        self.bucket_name = bucket_name
+        self.conditional = _supports_conditional_writes(s3_client)
+        if not self.conditional:
+            logger.warning(
+                'This botocore can\'t make conditional S3 writes (IfMatch/IfNoneMatch): index '
+                'updates are plain writes, so index writers running at the same time may lose each '
+                'other\'s entries. Upgrade boto3 to avoid this')
+        self._locks_lock = threading.Lock()
+        self._locks = {}  # folder -> lock
+        self._pending = {}  # folder -> day -> entries added since the last flush
+
+    def _folder_lock(self, folder):
+        with self._locks_lock:
+            return self._locks.setdefault(folder, threading.Lock())
+
+    # records one uploaded object, to be written to its folder's index by the next flush
+    def add(self, key, size, content_type=None):
+        day, entry = index_entry(key, size, content_type)
+        with self._locks_lock:
+            self._pending.setdefault(posixpath.dirname(key), {}).setdefault(day, []).append(entry)
+
+    # writes the entries added since the last flush, one update per folder; never raises, as the
+    # uploads themselves have succeeded
+    def flush(self):
+        with self._locks_lock:
+            pending, self._pending = self._pending, {}
+        for folder, entries_by_day in sorted(pending.items()):
+            try:
+                self.merge(folder, entries_by_day)
+            except Exception as e:
+                logger.warning(f'Could not add {folder} uploads to the S3 index (rebuild it with '
+                               f'scripts/backfill_s3_index.py): {e}')
+        if pending:
+            logger.info(f'Updated the S3 index of {len(pending)} folders')
+
+    def merge(self, folder, entries_by_day):
+        """Adds entries (day -> list of entries) to a folder's index, replacing entries with the
+        same key, and updates its days.json.
+        """
+        prefix = index_prefix(folder)
+        with self._folder_lock(folder):
+            days = {}
+            for day, entries in entries_by_day.items():
+                by_key = {entry['key']: entry for entry in entries}
+                shard = self._update(posixpath.join(prefix, '%s.json' % day), lambda doc: {
+                    'version': _VERSION,
+                    'entries': sorted(
+                        [entry for entry in doc.get('entries', []) if entry['key'] not in by_key]
+                        + list(by_key.values()), key=lambda entry: (entry['time'], entry['key'])),
+                })
+                days[day] = {
+                    'count': len(shard['entries']),
+                    'bytes': sum(entry['size'] or 0 for entry in shard['entries']),
+                }
+            self._update(posixpath.join(prefix, 'days.json'), lambda doc: {
+                'version': _VERSION,
+                'days': _merge_days(doc.get('days', {}), days),
+            })
+
+    # read-modify-write of one JSON object, conditional (if botocore allows) on it not having
+    # changed in between; returns the document written
+    def _update(self, key, modify):
+        for attempt in range(_MAX_ATTEMPTS):
+            doc, etag = self._read(key)
+            updated = modify(doc)
+            conditions = {}
+            if self.conditional:
+                conditions = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+            try:
+                self.client.put_object(
+                    Bucket=self.bucket_name, Key=key,
+                    Body=json.dumps(updated, separators=(',', ':')).encode(),
+                    ContentType='application/json', CacheControl='no-cache', **conditions)
+                return updated
+            except Exception as e:
+                if _error_code(e) not in _CONFLICT_CODES or attempt == _MAX_ATTEMPTS - 1:
+                    raise
+                time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+
+    # returns (document, ETag), or ({}, None) if the object doesn't exist yet
+    def _read(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=key)
+        except Exception as e:
+            if _error_code(e) in ('NoSuchKey', '404'):
+                return {}, None
+            raise
+        return json.loads(response['Body'].read()), response['ETag']
+
+
+# daily shards only grow, so a smaller count is from a writer that read the shard before another
+# writer added to it
+def _merge_days(existing, updates):
+    merged = dict(existing)
+    for day, totals in updates.items():
+        if totals['count'] >= merged.get(day, {}).get('count', 0):
+            merged[day] = totals
+    return dict(sorted(merged.items()))
+
+
+# whether the client's PutObject takes IfMatch and IfNoneMatch; botocore rejects parameters it
+# doesn't know before sending anything
+def _supports_conditional_writes(s3_client):
+    try:
+        members = s3_client.meta.service_model.operation_model('PutObject').input_shape.members
+    except Exception:
+        return False
+    return 'IfMatch' in members and 'IfNoneMatch' in members
+
+
+def _error_code(e):
+    return str(getattr(e, 'response', {}).get('Error', {}).get('Code', ''))
@@ -0,0 +1,155 @@
+""" Concurrent scheduling of screenshot captures across states and links."""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+import time
+
+from loguru import logger
+
+
+class KeyedLimiter():
+    """Caps how many threads may hold a slot for the same key (e.g. a hostname) at once.
+
+    A limit of 0 or None means unlimited.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    @contextmanager
+    def slot(self, key):
+        if not self.limit:
+            yield
+            return
+
+        with self._lock:
+            semaphore = self._semaphores.get(key)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.limit)
+                self._semaphores[key] = semaphore
+
+        with semaphore:
+            yield
+
+
+class TokenBucket():
+    """Client-side rate limit shared by all threads: at most `rate` acquisitions per second on
+    average, with bursts of up to `burst`.
+
+    pause() stops everyone for a while, e.g. when the server says we're over its rate limit. A
+    rate of 0 or None means no rate limit, though pause() still applies.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate or 1))
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif not self.rate:
+                    return
+                else:
+                    self._tokens = min(
+                        self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class CaptureScheduler():
+    """Runs the links of many states, for one or more run types, through a thread pool.
+
+    Per-host and per-key limits are enforced by the Screenshotters' limiters; this class only
+    fans out the work and gathers the per-state errors dicts in state order. With dedupe, links
+    from different run types that would make an identical request are captured once and
+    uploaded for each of them.
+    """
+
+    def __init__(self, screenshotters, workers, dedupe=False):
+        self.screenshotters = screenshotters  # run type -> Screenshotter
+        self.workers = workers
+        self.dedupe = dedupe
+
+    # returns run type -> ordered dict of state -> errors dict (or None if the state has no
+    # config), matching what Screenshotter.screenshot returns for each state
+    def run(self, states, which_screenshot, backup_to_s3=False):
+        results = OrderedDict()
+        groups = OrderedDict()  # request key -> [(run type, screenshotter, state, state_config)]
+        for run_type, screenshotter in self.screenshotters.items():
+            results[run_type] = OrderedDict()
+            for state in states:
+                links, errors = screenshotter.load_links(state, which_screenshot)
+                results[run_type][state] = errors if links is None else {}
+                for state_config in links or []:
+                    key = self._request_key(screenshotter, state, state_config)
+                    groups.setdefault(key, []).append(
+                        (run_type, screenshotter, state, state_config))
+
+        num_links = sum(len(group) for group in groups.values())
+        logger.info(
+            f'Scheduling {len(groups)} captures for {num_links} links on {self.workers} workers')
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+            for group in self._longest_first(list(groups.values())):
+                _, screenshotter, state, state_config = group[0]
+                copies = [(other, other_state, other_config)
+                          for _, other, other_state, other_config in group[1:]]
+                screenshotter.capture_metrics(state, state_config).mark_queued()
+                futures[id(group)] = executor.submit(
+                    screenshotter.screenshot_link, state, state_config, backup_to_s3, copies)
+
+            # collect in state order so errors are reported the same way as a serial run
+            for group in groups.values():
+                err = futures[id(group)].result()
+                if err:
+                    for run_type, _, state, state_config in group:
+                        results[run_type][state][state_config['name']] = err
+
+        return results
+
+    # orders groups by expected duration from the capture history, slowest first, so long renders
+    # don't end up as stragglers at the end of the run; without history the order is unchanged
+    def _longest_first(self, groups):
+        histories = {
+            id(screenshotter.history): screenshotter.history
+            for screenshotter in self.screenshotters.values() if screenshotter.history}
+        if not histories:
+            return groups
+        typical = {key: history.typical_seconds() for key, history in histories.items()}
+
+        def cost(group):
+            run_type, screenshotter, state, state_config = group[0]
+            history = screenshotter.history
+            if not history:
+                return 0
+            return history.expected_cost(
+                run_type, state, state_config['name'], typical[id(history)])
+
+        return sorted(groups, key=cost, reverse=True)
+
+    def _request_key(self, screenshotter, state, state_config):
+        if self.dedupe:
+            try:
+                return screenshotter.dedupe_key(state, state_config)
+            except Exception:
+                pass  # e.g. a URL template that fails to resolve; it will fail on its own
+        return object()
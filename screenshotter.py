@@ -1,27 +1,204 @@
 """ Main class for screenshot logic."""
 
-from datetime import datetime, date, timedelta  # imports needed for evaluating some data URLs
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack
+import copy
+from datetime import datetime
+import io
 import json
 import os
 from pytz import timezone
+import threading
+import time
+from urllib.parse import urlparse
 
 from loguru import logger
-import requests
 import yaml
 
+from config_index import compile_url_template
+from downloads import (SPOOL_BYTES, DownloadStats, ValidatorCache, stream_response_to_buffer,
+                       stream_response_to_path, url_exists)
+from dedupe import perceptual_hash
+from manifest import DONE, DUPLICATE, FAILED, PENDING, UNCHANGED
+from metrics import CaptureMetrics
+from retries import (CaptureError, RetryPolicy, error_from_response, is_permanent_status,
+                     parse_retry_after)
+from utils import make_http_session
+
+
+# PhantomJSCloud statuses for requests it turns down itself (a bad key, no credits left, too many
+# requests), rather than pages it tried to load
+_RENDER_API_STATUSES = {401, 402, 403, 429}
+
+
+def render_failure(response, response_json):
+    """Returns (from_target, permanent) for a failed PhantomJSCloud render: whether the captured
+    site is to blame, and whether retrying is pointless (None to go by the response's status).
+
+    If PhantomJSCloud reports the status the page loaded with, the site failed, and that status
+    decides whether to retry. Other errors PhantomJSCloud answers in JSON are failures to load
+    the page, e.g. timeouts, unless they are its own refusals. Errors without a JSON body come
+    from in front of PhantomJSCloud's API, not from a render.
+    """
+    target_status = response.headers.get('pjsc-content-status-code') or \
+        (response_json.get('content') or {}).get('statusCode')
+    try:
+        target_status = int(target_status) if target_status else None
+    except (TypeError, ValueError):
+        target_status = None
+    if target_status is not None:
+        return True, is_permanent_status(target_status)
+    if response.status_code in _RENDER_API_STATUSES or not response_json:
+        return False, None
+    return True, False
+
 
 class Screenshotter():
 
-    def __init__(self, local_dir, s3_backup, phantomjscloud_key, config_dir=None, dry_run=False):
-        self.phantomjs_url = 'https://phantomjscloud.com/api/browser/v2/%s/' % phantomjscloud_key
+    def __init__(self, local_dir, s3_backup, phantomjscloud_key, config_dir=None, dry_run=False,
+                 host_limiter=None, key_limiter=None, session=None, retry_policy=None,
+                 download_timeout=300, max_download_bytes=None, validator_cache=None,
+                 upload_pipeline=None, in_memory=False, spool_bytes=None, disk_cache=None,
+                 config_index=None, manifest=None, run_type=None, phantomjscloud_url=None,
+                 metrics=None, history=None, adaptive_max_wait=False, circuit_breaker=None,
+                 render_limiter=None, render_quota=None, date_fallback_days=0,
+                 capture_index=None, png_optimizer=None, shard_plan=None, catalog=None,
+                 hedge_policy=None):
+        self.phantomjscloud_key = phantomjscloud_key
+        phantomjscloud_url = phantomjscloud_url or 'https://phantomjscloud.com/api/browser/v2/'
+        self.phantomjs_url = '%s/%s/' % (phantomjscloud_url.rstrip('/'), phantomjscloud_key)
         self.local_dir = local_dir
         self.s3_backup = s3_backup
         self.config_dir = config_dir
+        # optional config_index.ConfigIndex; if set, state configs come from it instead of YAML
+        self.config_index = config_index
         self.dry_run = dry_run
-        
+        # which run this is for (core, CRDT, ...), used to tell links apart across run types
+        self.run_type = run_type
+        # optional manifest.RunManifest recording each link's status, for resuming runs
+        self.manifest = manifest
+        # optional catalog.CaptureCatalog recording every capture, for point-in-time lookups
+        self.catalog = catalog
+        # optional metrics.RunMetrics collecting per-capture timings and sizes for the run report
+        self.metrics = metrics
+        # optional history.CaptureHistory of past durations, used to order links and, with
+        # adaptive_max_wait, to pick each link's maxWait when its YAML doesn't set one
+        self.history = history
+        self.adaptive_max_wait = adaptive_max_wait
+        # optional scheduler.KeyedLimiter instances capping in-flight requests per target
+        # hostname and per PhantomJSCloud key when captures run in parallel
+        self.host_limiter = host_limiter
+        self.key_limiter = key_limiter
+        # optional scheduler.TokenBucket rate limiting PhantomJSCloud renders, shared by all
+        # threads, and quota.RenderQuota tracking their credit cost against the run's budget
+        self.render_limiter = render_limiter
+        self.render_quota = render_quota
+        # one pooled session per Screenshotter so connections are kept alive across links
+        self.session = session or make_http_session()
+        self.retry_policy = retry_policy or RetryPolicy()
+        # optional retries.CircuitBreaker that skips links on hosts that keep failing
+        self.circuit_breaker = circuit_breaker
+        # `eval` URLs are probed for this many days before today, and the newest that exists is used
+        self.date_fallback_days = date_fallback_days
+        # limits for `file:` links, which are streamed straight to disk
+        self.download_timeout = download_timeout
+        self.max_download_bytes = max_download_bytes
+        # optional downloads.ValidatorCache: unchanged `file:` links are neither saved nor uploaded
+        self.validator_cache = validator_cache
+        # optional pipeline.UploadPipeline: if set, S3 uploads are queued rather than done inline
+        self.upload_pipeline = upload_pipeline
+        # in memory mode captures are buffered (spilling to a temp file above spool_bytes) and
+        # uploaded with upload_fileobj; local_dir is then only written to via disk_cache
+        self.in_memory = in_memory
+        self.spool_bytes = spool_bytes or SPOOL_BYTES
+        # optional dedupe.CaptureIndex: captures identical to a link's last upload aren't uploaded
+        self.capture_index = capture_index
+        # optional postprocess.PngOptimizer re-encoding PNG captures before they're uploaded
+        self.png_optimizer = png_optimizer
+        # optional downloads.DiskCache bounding how much of local_dir finished captures can use
+        self.disk_cache = disk_cache
+        # optional shard.ShardPlan: only links owned by this shard of the run are captured
+        self.shard_plan = shard_plan
+        # optional hedge.HedgePolicy: renders running longer than usual get a second, identical
+        # request alongside them, and the first to succeed is kept
+        self.hedge_policy = hedge_policy
+
+    # holds the per-host slot for data_url (and the per-key slot and a rate limit token if this is
+    # a PhantomJSCloud render) for the duration of the block; time spent waiting goes to metrics
+    def network_slot(self, data_url, render, metrics=None):
+        start = time.perf_counter()
+        stack = ExitStack()
+        if self.host_limiter:
+            stack.enter_context(self.host_limiter.slot(urlparse(data_url).hostname))
+        if render and self.key_limiter:
+            stack.enter_context(self.key_limiter.slot(self.phantomjscloud_key))
+        if render and self.render_limiter:
+            self.render_limiter.acquire()
+        if metrics:
+            metrics.add(slot_wait_seconds=time.perf_counter() - start)
+        return stack
+
+    # ID of the run in progress, if it has a manifest
+    @property
+    def run_id(self):
+        return self.manifest.run_id if self.manifest else None
+
+    # the metrics.CaptureMetrics for a link, which is discarded if this run isn't collecting any
+    def capture_metrics(self, state, state_config):
+        if self.metrics:
+            return self.metrics.capture(self.run_type, state, state_config['name'])
+        return CaptureMetrics(self.run_type, state, state_config['name'])
+
+    # writes a streamed response body to path, or to memory if captures are kept in memory
+    def save_body(self, response, path, max_bytes=None, timeout=None):
+        if self.in_memory:
+            return stream_response_to_buffer(
+                response, max_bytes=max_bytes, timeout=timeout, spool_bytes=self.spool_bytes)
+        return stream_response_to_path(response, path, max_bytes=max_bytes, timeout=timeout)
+
+    def discard(self, stats, path):
+        if stats.fileobj is not None:
+            stats.fileobj.close()
+        else:
+            os.remove(path)
+
+    # returns the PhantomJSCloud request payload for capturing data_url with this link config
+    def phantomjs_request(self, data_url, state_config):
+        data = {
+            'url': data_url,
+            'renderType': 'png',
+        }
+
+        if state_config:
+            # update data with state_config minus message; deep copy since configs may be shared
+            state_config_copy = copy.deepcopy(state_config)
+            state_config_copy.pop('message', None)
+            for field in ['url', 'name']:  # we don't want to override the URL in case it's dynamic
+                state_config_copy.pop(field)
+            data.update(state_config_copy)
+
+        # set maxWait if unset
+        if 'requestSettings' in data:
+            if 'maxWait' not in data['requestSettings']:
+                data['requestSettings']['maxWait'] = 60000
+        else:
+            data['requestSettings'] = {'maxWait': 60000}
+
+        return data
+
+    # the payload save_url_image_to_path posts for a link: phantomjs_request plus, with
+    # adaptive_max_wait, a maxWait derived from the link's history
+    def render_request(self, state, suffix, data_url, state_config):
+        data = self.phantomjs_request(data_url, state_config)
+        if self.history and self.adaptive_max_wait and \
+                'maxWait' not in (state_config or {}).get('requestSettings', {}):
+            max_wait = self.history.max_wait_ms(self.run_type, state, suffix)
+            if max_wait:
+                data['requestSettings']['maxWait'] = max_wait
+        return data
 
     # makes a PhantomJSCloud call to data_url and saves the output to specified path
-    def save_url_image_to_path(self, state, data_url, path, state_config, suffix):
+    def save_url_image_to_path(self, state, data_url, path, state_config, suffix, metrics=None):
         """Saves URL image from data_url to the specified path.
 
         Parameters
@@ -33,15 +210,25 @@ class Screenshotter():
             URL of data site to save
 
         path : str
-            Local path to which to save .png screenshot of data_url
+            Local path to which to save .png screenshot of data_url. In memory mode nothing is
+            written here; the body is returned as the stats' fileobj instead
 
         state_config : dict
             This is a dict used for denoting phantomJScloud special casing or file type
 
         suffix : str
             e.g. primary, secondary, etc.
+
+        metrics : metrics.CaptureMetrics, optional
+            If given, request times, counts and sizes are added to it
+
+        Returns
+        -------
+        downloads.DownloadStats for the saved file, or None on a dry run
         """
 
+        metrics = metrics or CaptureMetrics(self.run_type, state, suffix)
+
         # if we need to just download the file, don't use phantomjscloud
         if state_config and state_config.get('file'):
             if self.dry_run:
@@ -53,42 +240,46 @@ class Screenshotter():
 
             # hack: the KY secondary link has a cert problem which fails SSL verification, this
             # lets us still download it
+            verify = True
             if state == 'KY' and suffix == 'secondary':
                 logger.info(f"Skipping SSL verification for KY secondary")
-                response = requests.get(data_url, verify=False)
-            else:
-                response = requests.get(data_url)
-
-            if response.status_code == 200:
-                with open(path, 'wb') as f:
-                    f.write(response.content)
-                return
-            else:
-                logger.error(f'Response status code: {response.status_code}')
-                raise ValueError(f'Could not download data from URL: {data_url}')
+                verify = False
+
+            headers = {}
+            if self.validator_cache:
+                headers = self.validator_cache.request_headers(data_url)
+
+            metrics.add(downloads=1)
+            with self.network_slot(data_url, render=False, metrics=metrics), \
+                    metrics.timed('download_seconds'):
+                with self.session.get(data_url, verify=verify, stream=True, headers=headers,
+                                      timeout=self.download_timeout) as response:
+                    if response.status_code == 304 and headers:
+                        stats = DownloadStats(0, response.elapsed.total_seconds(), unchanged=True)
+                    elif response.status_code != 200:
+                        logger.error(f'Response status code: {response.status_code}')
+                        raise error_from_response(
+                            response, f'Could not download data from URL: {data_url}')
+                    else:
+                        stats = self.save_body(
+                            response, path, max_bytes=self.max_download_bytes,
+                            timeout=self.download_timeout)
+                        if self.validator_cache:
+                            stats.validators = ValidatorCache.validators_from_response(
+                                response, stats.sha256)
+                            if self.validator_cache.is_unchanged(data_url, stats.sha256):
+                                stats.unchanged = True
+                                self.discard(stats, path)
+
+            metrics.add(bytes=stats.nbytes)
+            logger.info(f'Downloaded {state} {suffix}: {stats}')
+            return stats
 
         logger.info(f"Retrieving {data_url}")
-        data = {
-            'url': data_url,
-            'renderType': 'png',
-        }
-
-        if state_config:
-            # update data with state_config minus message
-            state_config_copy = state_config.copy()
-            message = state_config_copy.pop('message', None)
-            for field in ['url', 'name']:  # we don't want to override the URL in case it's dynamic
-                state_config_copy.pop(field)
-            if message:
-                logger.info(message)
-            data.update(state_config_copy)
-
-        # set maxWait if unset
-        if 'requestSettings' in data:
-            if 'maxWait' not in data['requestSettings']:
-                data['requestSettings']['maxWait'] = 60000
-        else:
-            data['requestSettings'] = {'maxWait': 60000}
+        if state_config and state_config.get('message'):
+            logger.info(state_config['message'])
+        data = self.render_request(state, suffix, data_url, state_config)
+        metrics.set(max_wait_ms=data['requestSettings']['maxWait'])
 
         if self.dry_run:
             logger.warning(
@@ -97,21 +288,129 @@ class Screenshotter():
             return
 
         logger.info('Posting request %s...' % data)
-        response = requests.post(self.phantomjs_url, json.dumps(data))
+        metrics.add(renders=1)
+        hedge_delay = None
+        if self.hedge_policy:
+            hedge_delay = self.hedge_policy.delay(self.run_type, state, suffix)
+        if hedge_delay is None:
+            with metrics.timed('render_seconds'):
+                response, stats = self.post_render(data_url, data, path, metrics)
+        else:
+            response, stats = self.hedged_render(
+                state, suffix, data_url, data, path, hedge_delay, metrics)
         logger.info('Done.')
 
         if response.status_code == 200:
-            with open(path, 'wb') as f:
-                f.write(response.content)
+            metrics.add(bytes=stats.nbytes)
+            if self.render_quota:
+                metrics.add(credits=self.render_quota.record(response))
+            return stats
         else:
             logger.error(f'Response status code: {response.status_code}')
-            if 'meta' in response.json():
-                response_metadata = response.json()['meta']
-                raise ValueError(f'Could not retrieve URL {data_url}, got response metadata {response_metadata}')
+            try:
+                response_json = response.json()
+            except ValueError:
+                response_json = {}
+            if self.render_quota:
+                metrics.add(credits=self.render_quota.record(response, response_json))
+            if response.status_code == 429 and self.render_limiter:
+                # over PhantomJSCloud's limits: hold off every render, not just this link's retry
+                self.render_limiter.pause(parse_retry_after(response) or 10)
+            from_target, permanent = render_failure(response, response_json)
+            if 'meta' in response_json:
+                response_metadata = response_json['meta']
+                raise error_from_response(
+                    response,
+                    f'Could not retrieve URL {data_url}, got response metadata {response_metadata}',
+                    from_target=from_target, permanent=permanent)
             else:
-                raise ValueError(
+                raise error_from_response(
+                    response,
                     'Could not retrieve URL %s and response has no metadata. Full response: %s' % (
-                        data_url, response.json()))
+                        data_url, response_json or response.text[:500]),
+                    from_target=from_target, permanent=permanent)
+
+    # posts one render request, saving the body to path if it succeeds; returns (response, stats),
+    # with stats None on failure. If cancelled (a threading.Event) is set by the time a network
+    # slot is free, nothing is sent and this returns (None, None).
+    def post_render(self, data_url, data, path, metrics, cancelled=None):
+        stats = None
+        with self.network_slot(data_url, render=True, metrics=metrics):
+            if cancelled is not None and cancelled.is_set():
+                return None, None
+            with self.session.post(self.phantomjs_url, json.dumps(data), stream=True) as response:
+                if response.status_code == 200:
+                    stats = self.save_body(response, path)
+                else:
+                    # error bodies are small; read them before the connection goes back to the pool
+                    response.content
+        return response, stats
+
+    def hedged_render(self, state, suffix, data_url, data, path, delay, metrics):
+        """Posts a render and, if it's still running after delay seconds and the run has hedges
+        left, an identical one alongside it. Returns (response, stats) of the first to succeed, or
+        of the first request if neither does.
+
+        Each request saves to its own temp path and the winner's is moved to path. A request in
+        flight can't be cancelled, so the other one finishes in the background and is discarded.
+        """
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        cancelled = threading.Event()
+        started = time.perf_counter()
+        paths = {}
+
+        def submit(attempt_path):
+            future = executor.submit(
+                self.post_render, data_url, data, attempt_path, metrics, cancelled=cancelled)
+            paths[future] = attempt_path
+            return future
+
+        primary = submit(path + '.render')
+        winner = None
+        try:
+            if not wait([primary], timeout=delay).done and self.hedge_policy.acquire():
+                logger.info(f'{state} {suffix} render still running after {delay:.1f}s, '
+                            f'sending a hedged request')
+                metrics.add(hedges=1)
+                submit(path + '.hedge')
+            pending = set(paths)
+            while pending and winner is None:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=lambda future: future is not primary):
+                    if not future.exception() and future.result()[1] is not None:
+                        winner = future
+                        break
+        finally:
+            cancelled.set()
+            metrics.add(render_seconds=time.perf_counter() - started)
+            executor.shutdown(wait=False)
+
+        def discard(future):
+            try:
+                response, stats = future.result()
+            except Exception as e:
+                logger.info(f'Discarded {state} {suffix} render failed: {e}')
+                return
+            if response is None:
+                return  # never sent
+            if self.render_quota:
+                metrics.add(credits=self.render_quota.record(response))
+            if stats is not None:
+                self.discard(stats, paths[future])
+
+        result = winner or primary
+        for future in paths:
+            if future is not result:
+                future.add_done_callback(discard)
+        response, stats = result.result()
+        if winner is not None and winner is not primary:
+            logger.info(f'Hedged request for {state} {suffix} finished first')
+            metrics.add(hedges_won=1)
+            self.hedge_policy.record_win()
+        if stats is not None and stats.fileobj is None:
+            os.replace(paths[result], path)
+        return response, stats
 
     def timestamped_filename(self, state, suffix, fileext='png'):
         # basename will be e.g. 'CA' if suffix is 'primary', or 'CA-secondary' if suffix is 'secondary'
@@ -132,7 +431,10 @@ class Screenshotter():
 
 
     def get_state_config_from_dir(self, state):
-        # Return the full parsed state config from file.
+        # Return the full parsed state config, from the compiled index if there is one.
+        if self.config_index is not None:
+            return self.config_index.state_config(os.path.basename(self.config_dir), state)
+
         config_path = os.path.join(self.config_dir, '%s.yaml' % state.upper())
         if not os.path.exists(config_path):
             return None
@@ -144,56 +446,341 @@ class Screenshotter():
         return config
 
 
-    # returns a dictionary of screenshot types to error messages, if any
-    def screenshot(self, state, which_screenshot, backup_to_s3=False):
+    # returns (links, errors) for a state: links is the list of link configs to capture, or None
+    # if there is nothing to capture, in which case errors is what screenshot() should return
+    def load_links(self, state, which_screenshot):
         # extract state config
         try:
             full_state_config = self.get_state_config_from_dir(state)
         except Exception as err:
+            if self.shard_plan and not self.shard_plan.owns(self.run_type, state, None):
+                return None, None  # another shard reports it
             logger.error(f'Error getting config for {state}: {err}')
-            return {state: f'Error getting config for {state}: check config for errors'}
+            error = f'Error getting config for {state}: check config for errors'
+            if self.manifest:
+                # a config error fails the whole state, so it's recorded without a suffix
+                self.manifest.record(state, None, FAILED, error=error, run_type=self.run_type)
+            return None, {state: error}
+
+        # a resumed run whose config error has since been fixed
+        if self.manifest and self.manifest.status(state, None, run_type=self.run_type) == FAILED:
+            self.manifest.record(state, None, DONE, run_type=self.run_type)
 
         if full_state_config is None:
             logger.info(f'No existing config for {state}')
-            return
+            return None, None
+
+        links = [
+            state_config for state_config in full_state_config['links']
+            if not which_screenshot or which_screenshot == state_config['name']]
+        if self.shard_plan:
+            links = [state_config for state_config in links if self.shard_plan.owns(
+                self.run_type, state, state_config['name'])]
+
+        # when resuming a run, skip links that were already captured
+        if self.manifest:
+            remaining = []
+            for state_config in links:
+                suffix = state_config['name']
+                if self.manifest.is_complete(state, suffix, run_type=self.run_type):
+                    logger.info(f'Skipping {state} {suffix}: captured earlier in this run')
+                else:
+                    self.manifest.record(state, suffix, PENDING, run_type=self.run_type)
+                    remaining.append(state_config)
+            links = remaining
+
+        if self.render_quota:
+            self.render_quota.plan(sum(1 for state_config in links if not state_config.get('file')))
+        return links, None
+
+    # returns a dictionary of screenshot types to error messages, if any
+    def screenshot(self, state, which_screenshot, backup_to_s3=False):
+        links, errors = self.load_links(state, which_screenshot)
+        if links is None:
+            return errors
 
         errors = {}  # will map screenshot name to error message if any
 
         # do this for all state screenshots
-        for state_config in full_state_config['links']:
-            suffix = state_config['name']
-            if which_screenshot and which_screenshot != suffix:
-                continue
-
-            # use specified file extension if it exists, otherwise default to .png
-            fileext = state_config['file'] if 'file' in state_config else 'png'
-            timestamped_filename = self.timestamped_filename(state, suffix=suffix, fileext=fileext)
-            local_path = os.path.join(self.local_dir, timestamped_filename)
-            data_url = state_config['url']
-
-            # if dynamic, resolve the data_url first
-            if 'eval' in state_config:
-                logger.info(f'Evaluating {state} {suffix} first: {data_url}')
-                data_url = eval(data_url)
-
-            logger.info(f'Screenshotting {state} {suffix} from {data_url}')
-
-            # try 4 times in case of intermittent issues
-            err = None
-            for i in range(4):
-                try:
-                    self.save_url_image_to_path(
-                        state, data_url, local_path, state_config, suffix)
-                    if backup_to_s3:
-                        logger.info('Push to s3')
-                        self.s3_backup.upload_file(local_path, state)
-                    err = None
-                    break
-                except Exception as e:
-                    logger.error(f'Screenshot {state} {suffix} failed attempt %d' % (i+1))
-                    err = e
-
+        for state_config in links:
+            err = self.screenshot_link(state, state_config, backup_to_s3=backup_to_s3)
             if err:
-                errors[suffix] = err
+                errors[state_config['name']] = err
 
         return errors
+
+    # captures a single link from a state config, returning the last error if all attempts failed
+    def screenshot_link(self, state, state_config, backup_to_s3=False, copies=()):
+        """Captures a single link from a state config, retrying on failure.
+
+        copies is a list of (screenshotter, state, state_config) for identical links from other
+        run types: the capture is made once and uploaded for each of them too. Returns the last
+        error if all attempts failed, otherwise None.
+        """
+        suffix = state_config['name']
+        started = time.perf_counter()
+        metrics = self.capture_metrics(state, state_config)
+        metrics.mark_started()
+        local_path = self.local_path_for(state, state_config)
+        with metrics.timed('resolve_seconds'):
+            data_url = self.resolve_url(state, state_config)
+        targets = [(self, state, state_config)] + list(copies)
+        metrics.set(kind='file' if state_config.get('file') else 'render', url=data_url)
+        for screenshotter, target_state, target_config in targets[1:]:
+            screenshotter.capture_metrics(target_state, target_config).set(
+                copy_of='%s/%s/%s' % self.link_key(state, state_config))
+
+        logger.info(f'Screenshotting {state} {suffix} from {data_url}')
+        attempts = 0
+
+        def capture():
+            nonlocal attempts
+            attempts += 1
+            metrics.set(attempts=attempts)
+            if self.render_quota and not self.dry_run and not state_config.get('file'):
+                self.render_quota.check(state, suffix)
+            stats = self.save_with_circuit_breaker(
+                state, data_url, local_path, state_config, suffix, metrics=metrics)
+            if self.dry_run:
+                for screenshotter, target_state, target_config in targets:
+                    screenshotter.capture_metrics(target_state, target_config).set(
+                        status='dry-run')
+                return
+            fileobj = stats.fileobj
+            handed_off = False
+            uploads = [
+                (screenshotter.s3_backup, target_state,
+                 os.path.basename(screenshotter.local_path_for(target_state, target_config)))
+                for screenshotter, target_state, target_config in targets]
+
+            # targets whose last upload had the same content reference it rather than re-upload
+            duplicates, phash = {}, None
+            if backup_to_s3 and self.capture_index and not stats.unchanged:
+                duplicates, phash = self.find_duplicates(stats, local_path, targets)
+            fresh = [i for i in range(len(targets)) if i not in duplicates]
+            if self.png_optimizer and fresh and not stats.unchanged and \
+                    local_path.endswith('.png'):
+                self.optimize_png(stats, local_path, metrics)
+
+            def finish():
+                if stats.validators and self.validator_cache:
+                    self.validator_cache.store(data_url, stats.validators)
+                if self.disk_cache and not stats.unchanged:
+                    self.disk_cache.add(local_path, fileobj=fileobj)
+                    for name_suffix, derivative_path, data in stats.derivatives:
+                        if derivative_path:
+                            self.disk_cache.add(derivative_path)
+                        else:
+                            self.disk_cache.add(
+                                os.path.splitext(local_path)[0] + name_suffix,
+                                fileobj=io.BytesIO(data))
+                for i, (screenshotter, target_state, target_config) in enumerate(targets):
+                    s3_backup, _, filename = uploads[i]
+                    target_suffix = target_config['name']
+                    s3_key = None
+                    if stats.unchanged:
+                        status = UNCHANGED
+                    elif i in duplicates:
+                        status = DUPLICATE
+                        s3_key = duplicates[i]['s3_key']
+                        self.capture_index.record_duplicate(
+                            screenshotter.run_type, target_state, target_suffix, filename,
+                            duplicates[i], stats.sha256)
+                    else:
+                        status = DONE
+                        if backup_to_s3:
+                            s3_key = s3_backup.get_s3_path(filename, target_state)
+                        if backup_to_s3 and self.capture_index:
+                            self.capture_index.store(
+                                screenshotter.run_type, target_state, target_suffix,
+                                stats.sha256, s3_key, phash=phash,
+                                upload_sha256=stats.upload_sha256)
+                    screenshotter.capture_metrics(target_state, target_config).set(
+                        status=status, attempts=attempts)
+                    if screenshotter.manifest:
+                        screenshotter.manifest.record(
+                            target_state, target_suffix, status, s3_key=s3_key, attempts=attempts,
+                            run_type=screenshotter.run_type)
+                    if screenshotter.catalog:
+                        screenshotter.catalog.record(
+                            screenshotter.run_type, target_state, target_suffix, status,
+                            filename=filename, s3_key=s3_key, size=stats.nbytes,
+                            sha256=stats.upload_sha256,
+                            duration_seconds=time.perf_counter() - started,
+                            attempts=attempts, run_id=screenshotter.run_id)
+
+            fresh_uploads = [uploads[i] for i in fresh]
+            try:
+                if stats.unchanged:
+                    logger.info(f'{state} {suffix} unchanged since its last capture, not uploading')
+                elif backup_to_s3 and not fresh_uploads:
+                    logger.info(f'{state} {suffix} is a duplicate of its last upload, not uploading')
+                elif backup_to_s3 and self.upload_pipeline:
+                    # uploads are retried by the pipeline, independently of this render; it also
+                    # takes over closing the in-memory body
+                    queued_at = time.perf_counter()
+
+                    def upload():
+                        metrics.setdefault('upload_queue_seconds', time.perf_counter() - queued_at)
+                        self.upload(stats, local_path, fresh_uploads, metrics=metrics)
+
+                    self.upload_pipeline.submit(
+                        upload,
+                        f'{state} {suffix}',
+                        key=tuple(targets[i][0].link_key(targets[i][1], targets[i][2])
+                                  for i in fresh),
+                        on_success=finish, fileobj=fileobj)
+                    handed_off = True
+                    return
+                elif backup_to_s3:
+                    logger.info('Push to s3')
+                    self.upload(stats, local_path, fresh_uploads, metrics=metrics)
+                finish()
+            finally:
+                if fileobj is not None and not handed_off:
+                    fileobj.close()
+
+        # retry with backoff in case of intermittent issues, but not on permanent errors
+        try:
+            self.retry_policy.call(capture, f'Screenshot {state} {suffix}')
+        except Exception as e:
+            for screenshotter, target_state, target_config in targets:
+                screenshotter.capture_metrics(target_state, target_config).set(
+                    status=FAILED, attempts=attempts, error=str(e))
+                if screenshotter.manifest:
+                    screenshotter.manifest.record(
+                        target_state, target_config['name'], FAILED, attempts=attempts, error=e,
+                        run_type=screenshotter.run_type)
+                if screenshotter.catalog:
+                    screenshotter.catalog.record(
+                        screenshotter.run_type, target_state, target_config['name'], FAILED,
+                        duration_seconds=time.perf_counter() - started, attempts=attempts,
+                        error=e, run_id=screenshotter.run_id)
+            return e
+        finally:
+            if self.render_quota and not state_config.get('file'):
+                self.render_quota.done(len(targets))
+        return None
+
+    # returns ({target index: capture index entry} for the targets this capture duplicates, and the
+    # capture's perceptual hash if the index uses them)
+    def find_duplicates(self, stats, local_path, targets):
+        phash = None
+        if self.capture_index.perceptual and local_path.endswith('.png'):
+            phash = perceptual_hash(stats.fileobj if stats.fileobj is not None else local_path)
+        duplicates = {}
+        for i, (screenshotter, target_state, target_config) in enumerate(targets):
+            entry = self.capture_index.duplicate_of(
+                screenshotter.run_type, target_state, target_config['name'], stats.sha256,
+                phash=phash)
+            if entry:
+                duplicates[i] = entry
+        return duplicates, phash
+
+    # save_url_image_to_path, unless the data_url's host circuit is open; the outcome of the
+    # request is recorded against the host
+    def save_with_circuit_breaker(self, state, data_url, path, state_config, suffix, metrics=None):
+        if not self.circuit_breaker or self.dry_run:
+            return self.save_url_image_to_path(
+                state, data_url, path, state_config, suffix, metrics=metrics)
+
+        host = urlparse(data_url).hostname
+        self.circuit_breaker.before(host)
+        try:
+            stats = self.save_url_image_to_path(
+                state, data_url, path, state_config, suffix, metrics=metrics)
+        except Exception as e:
+            # only count failures of the target site: a render can also fail in PhantomJSCloud,
+            # or on the way to it, without the site being at fault
+            if isinstance(e, CaptureError):
+                from_target = e.from_target
+            else:
+                from_target = bool(state_config.get('file'))
+            if from_target:
+                self.circuit_breaker.failure(host, e)
+            else:
+                self.circuit_breaker.inconclusive(host)
+            raise
+        self.circuit_breaker.success(host)
+        return stats
+
+    # uploads a capture, and anything derived from it, to each (s3_backup, state, filename) in
+    # uploads
+    def upload(self, stats, local_path, uploads, metrics=None):
+        metrics = metrics or CaptureMetrics(self.run_type, None, None)
+        for s3_backup, state, filename in uploads:
+            with metrics.timed('upload_seconds'):
+                if stats.fileobj is not None:
+                    s3_backup.upload_fileobj(stats.fileobj, filename, state)
+                else:
+                    s3_backup.upload_file(local_path, state, filename=filename)
+            metrics.add(uploads=1, upload_bytes=stats.nbytes)
+
+            for name_suffix, derivative_path, data in stats.derivatives:
+                derivative_filename = os.path.splitext(filename)[0] + name_suffix
+                with metrics.timed('upload_seconds'):
+                    if data is not None:
+                        s3_backup.upload_fileobj(io.BytesIO(data), derivative_filename, state)
+                    else:
+                        s3_backup.upload_file(derivative_path, state, filename=derivative_filename)
+                metrics.add(uploads=1, upload_bytes=len(data) if data is not None
+                            else os.path.getsize(derivative_path))
+
+    # re-encodes a PNG capture in place; on failure the original is uploaded as is
+    def optimize_png(self, stats, local_path, metrics):
+        try:
+            self.png_optimizer.optimize(stats, local_path, metrics=metrics)
+        except Exception as e:
+            logger.warning(f'Could not optimize {local_path}, uploading it as is: {e}')
+
+    # identifies a link across run types: (run type, state, suffix)
+    def link_key(self, state, state_config):
+        return (self.run_type, state, state_config['name'])
+
+    def local_path_for(self, state, state_config):
+        # use specified file extension if it exists, otherwise default to .png
+        fileext = state_config['file'] if 'file' in state_config else 'png'
+        timestamped_filename = self.timestamped_filename(
+            state, suffix=state_config['name'], fileext=fileext)
+        return os.path.join(self.local_dir, timestamped_filename)
+
+    # probe=False resolves dynamic URLs for today (or the given date) without any requests, e.g.
+    # to compare links
+    def resolve_url(self, state, state_config, probe=True, today=None):
+        data_url = state_config['url']
+        # if dynamic, resolve the data_url first
+        if 'eval' in state_config:
+            logger.info(f'Evaluating {state} {state_config["name"]} first: {data_url}')
+            template = compile_url_template(data_url)
+            if probe and self.date_fallback_days and not self.dry_run:
+                return self.newest_existing_url(state, state_config, template)
+            data_url = template.resolve(today)
+        return data_url
+
+    # probes a date template's URLs for today and each of the date_fallback_days before it all at
+    # once, returning the newest that exists, or today's if none do
+    def newest_existing_url(self, state, state_config, template):
+        urls = template.resolve_recent(self.date_fallback_days)
+        if len(urls) == 1:
+            return urls[0]  # the URL doesn't depend on the date
+
+        with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+            found = list(executor.map(lambda url: url_exists(self.session, url), urls))
+        for url, exists in zip(urls, found):
+            if exists:
+                if url != urls[0]:
+                    logger.info(f'{state} {state_config["name"]} is not published at {urls[0]} '
+                                f'yet, using {url}')
+                return url
+        logger.warning(f'None of the last {len(urls)} dated URLs for {state} '
+                       f'{state_config["name"]} exist, trying {urls[0]}')
+        return urls[0]
+
+    # returns a key that is equal for links that would make identical requests, so they can be
+    # captured once and uploaded for each
+    def dedupe_key(self, state, state_config):
+        data_url = self.resolve_url(state, state_config, probe=False)
+        if state_config.get('file'):
+            return ('file', data_url, state_config['file'])
+        request = self.phantomjs_request(data_url, state_config)
+        return ('render', json.dumps(request, sort_keys=True))
@@ -0,0 +1,76 @@
+""" One-time backfill of the bucket browser's per-folder indexes from the objects already in S3.
+
+Walks the given prefixes of the bucket (by default every top-level folder), listing folders in
+parallel, and merges every object it finds into its folder's _index/ objects (see s3_index.py).
+Entries already in an index are kept, so this is safe to re-run, and to run while captures are
+being uploaded.
+
+    python scripts/backfill_s3_index.py --s3-bucket covid-data-archive \\
+        --prefixes state_screenshots/ --workers 32
+"""
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import os
+import sys
+
+from loguru import logger
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from s3_index import S3FolderIndex, index_entry, walk_bucket  # noqa: E402
+from utils import S3Backup, shared_s3_resource  # noqa: E402
+
+
+parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+
+parser.add_argument('--s3-bucket', default='covid-data-archive',
+    help='S3 bucket name')
+
+parser.add_argument('--s3-endpoint-url', default='',
+    help='If present, talk to this S3-compatible endpoint instead of AWS')
+
+parser.add_argument('--prefixes', default='',
+    help='Comma-separated folders to index, e.g. state_screenshots/. Defaults to every top-level '
+         'folder of the bucket')
+
+parser.add_argument('--workers', type=int, default=16,
+    help='Folders listed and indexed in parallel')
+
+parser.add_argument('--dry-run', dest='dry_run', action='store_true', default=False,
+    help='If present, only list and count objects, without writing any index')
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+    client = shared_s3_resource(args.s3_endpoint_url or None).meta.client
+    folder_index = S3FolderIndex(client, args.s3_bucket)
+
+    # runs on the listing threads
+    def index_folder(folder, objects):
+        if not folder or not objects:
+            return 0  # objects at the top of the bucket aren't captures
+        entries_by_day = {}
+        for item in objects:
+            day, entry = index_entry(
+                item['Key'], item['Size'], S3Backup.extra_args_for(item['Key']).get('ContentType'),
+                last_modified=item['LastModified'])
+            entries_by_day.setdefault(day, []).append(entry)
+        if not args.dry_run:
+            folder_index.merge(folder.rstrip('/'), entries_by_day)
+        logger.info(f'{folder}: {len(objects)} objects over {len(entries_by_day)} days')
+        return len(objects)
+
+    roots = ['']
+    if args.prefixes:
+        roots = [prefix.strip().rstrip('/') + '/' for prefix in args.prefixes.split(',')]
+    total = folders = 0
+    for _, count in walk_bucket(client, args.s3_bucket, roots, index_folder, workers=args.workers):
+        total += count
+        folders += 1
+    logger.info(f'{"Counted" if args.dry_run else "Indexed"} {total} objects in {folders} folders')
+
+
+if __name__ == "__main__":
+    main()
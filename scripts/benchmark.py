@@ -0,0 +1,273 @@
+""" Offline benchmark of a full screenshots run against local PhantomJSCloud and S3 stand-ins.
+
+Starts scripts/fake_services.py in a child process, then runs run-screenshots.py's main() in this
+process against the real configs/ tree, with every request (renders, `file:` downloads and S3
+uploads) going to the fakes. Reports captures/sec, p50/p95 latency per link, peak RSS and bytes
+uploaded, so changes to concurrency or retries can be compared on one machine with no network.
+
+Any argument not listed below is passed through to run-screenshots.py, e.g.
+
+    python scripts/benchmark.py --latency-ms 800 --error-rate 0.05 \\
+        --screenshot-core-urls --push-to-s3 --workers 16 --retry-base-delay 0.2
+
+If no run type is given, --screenshot-core-urls --push-to-s3 is used.
+"""
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import importlib.util
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(SCRIPTS_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, SCRIPTS_DIR)
+
+from fake_services import ERROR_SHAPES, FakeServices, FakeServiceSettings  # noqa: E402
+import screenshotter  # noqa: E402
+
+
+BUCKET = 'benchmark'
+RUN_TYPE_ARGS = {
+    '--screenshot-core-urls', '--screenshot-crdt-urls', '--screenshot-ltc-urls',
+    '--screenshot-vax-urls', '--screenshot-variant-urls', '--run-types'}
+
+
+parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+
+parser.add_argument('--latency-ms', type=float, default=500,
+    help='Mean latency of a fake PhantomJSCloud render')
+
+parser.add_argument('--latency-jitter-ms', type=float, default=250,
+    help='Render latency varies uniformly by up to this much either way')
+
+parser.add_argument('--file-latency-ms', type=float, default=50,
+    help='Latency of a fake `file:` download')
+
+parser.add_argument('--error-rate', type=float, default=0.0,
+    help='Fraction of renders and downloads that fail with --error-status')
+
+parser.add_argument('--error-status', type=int, default=503,
+    help='Status code of injected errors')
+
+parser.add_argument('--retry-after', type=int, default=None,
+    help='If present, injected errors carry this Retry-After in seconds')
+
+parser.add_argument('--error-shape', choices=ERROR_SHAPES, default='meta',
+    help='Injected render errors are PhantomJSCloud JSON errors (meta), non-JSON error pages '
+         '(bare) or connections closed without a response (reset)')
+
+parser.add_argument('--error-target-status', type=int, default=None,
+    help='If present, injected render errors report this status code for the captured page')
+
+parser.add_argument('--payload-kb', type=float, default=300,
+    help='Size of each rendered PNG')
+
+parser.add_argument('--file-payload-kb', type=float, default=100,
+    help='Size of each downloaded file')
+
+parser.add_argument('--credit-cost', type=float, default=1.0,
+    help='PhantomJSCloud credits each fake render reports it cost')
+
+parser.add_argument('--credits', type=float, default=100000,
+    help='Prepaid credits the fake PhantomJSCloud account starts with')
+
+parser.add_argument('--report', default='',
+    help='If present, also write the results as JSON to this path')
+
+
+def serve(settings, urls):
+    services = FakeServices(settings)
+    urls.put(services.url)
+    services.serve_forever()
+
+
+def start_fake_services(settings):
+    urls = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(settings, urls), daemon=True)
+    process.start()
+    return process, urls.get(timeout=30)
+
+
+class LocalRedirectAdapter(HTTPAdapter):
+    """Sends every request that isn't already for the fakes to the fake file server instead.
+
+    The original URL is kept in the path, so per-host limits still see the real hostname.
+    """
+
+    def __init__(self, fake_url, **kwargs):
+        self.fake_url = fake_url
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if not request.url.startswith(self.fake_url):
+            request.url = '%s/files/%s' % (self.fake_url, quote(request.url, safe=''))
+        return super().send(request, **kwargs)
+
+
+def redirecting_session_factory(fake_url):
+    def make_http_session(pool_size=10):
+        session = requests.Session()
+        adapter = LocalRedirectAdapter(
+            fake_url, pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+    return make_http_session
+
+
+# wraps Screenshotter.screenshot_link to time every link, end to end including retries
+def record_link_timings(timings):
+    screenshot_link = screenshotter.Screenshotter.screenshot_link
+    lock = threading.Lock()
+
+    def timed_screenshot_link(self, state, state_config, *args, **kwargs):
+        start = time.perf_counter()
+        err = screenshot_link(self, state, state_config, *args, **kwargs)
+        with lock:
+            timings.append({
+                'run_type': self.run_type,
+                'state': state,
+                'suffix': state_config['name'],
+                'seconds': time.perf_counter() - start,
+                'ok': err is None,
+            })
+        return err
+
+    screenshotter.Screenshotter.screenshot_link = timed_screenshot_link
+
+
+def load_run_screenshots():
+    spec = importlib.util.spec_from_file_location(
+        'run_screenshots', os.path.join(REPO_DIR, 'run-screenshots.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_benchmark(args, screenshots_args):
+    settings = FakeServiceSettings(
+        latency_ms=args.latency_ms, latency_jitter_ms=args.latency_jitter_ms,
+        file_latency_ms=args.file_latency_ms, error_rate=args.error_rate,
+        error_status=args.error_status, retry_after=args.retry_after,
+        error_shape=args.error_shape, error_target_status=args.error_target_status,
+        payload_kb=args.payload_kb, file_payload_kb=args.file_payload_kb,
+        credit_cost=args.credit_cost, credits=args.credits)
+    process, fake_url = start_fake_services(settings)
+
+    # dummy credentials for the stub; plain (not aws-chunked) bodies keep its byte counts exact
+    os.environ.update({
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_REQUEST_CHECKSUM_CALCULATION': 'when_required',
+    })
+
+    if not RUN_TYPE_ARGS.intersection(screenshots_args):
+        screenshots_args = ['--screenshot-core-urls', '--push-to-s3'] + screenshots_args
+    temp_dir = None
+    if '--temp-dir' not in screenshots_args:
+        temp_dir = tempfile.TemporaryDirectory(prefix='screenshots-benchmark-')
+        screenshots_args = ['--temp-dir', temp_dir.name] + screenshots_args
+    screenshots_args = screenshots_args + [
+        '--phantomjscloud-key', 'benchmark',
+        '--phantomjscloud-url', '%s/api/browser/v2/' % fake_url,
+        '--s3-endpoint-url', fake_url,
+        '--s3-bucket', BUCKET,
+        '--slack-channel', '', '--slack-api-token', '',
+    ]
+
+    run_screenshots = load_run_screenshots()
+    make_http_session = redirecting_session_factory(fake_url)
+    run_screenshots.make_http_session = make_http_session
+    screenshotter.make_http_session = make_http_session
+    timings = []
+    record_link_timings(timings)
+
+    start = time.perf_counter()
+    try:
+        run_screenshots.main(screenshots_args)
+    finally:
+        elapsed = time.perf_counter() - start
+        fake_stats = requests.get('%s/_stats' % fake_url).json()
+        process.terminate()
+        if temp_dir:
+            temp_dir.cleanup()
+
+    seconds = [timing['seconds'] for timing in timings]
+    succeeded = sum(1 for timing in timings if timing['ok'])
+    return {
+        'args': screenshots_args,
+        'settings': vars(settings),
+        'elapsed_seconds': elapsed,
+        'links': len(timings),
+        'captures_succeeded': succeeded,
+        'captures_failed': len(timings) - succeeded,
+        'captures_per_second': succeeded / elapsed if elapsed else None,
+        'link_seconds_p50': percentile(seconds, 0.5),
+        'link_seconds_p95': percentile(seconds, 0.95),
+        'link_seconds_max': max(seconds) if seconds else None,
+        'peak_rss_mb': peak_rss_mb(),
+        'fake_services': fake_stats,
+        'slowest_links': sorted(timings, key=lambda timing: -timing['seconds'])[:10],
+    }
+
+
+def print_report(report):
+    stats = report['fake_services']
+    print()
+    print('Links:               %d (%d succeeded, %d failed)' % (
+        report['links'], report['captures_succeeded'], report['captures_failed']))
+    print('Elapsed:             %.1fs' % report['elapsed_seconds'])
+    print('Captures/sec:        %.2f' % (report['captures_per_second'] or 0))
+    if report['links']:
+        print('Link latency:        p50 %.2fs, p95 %.2fs, max %.2fs' % (
+            report['link_seconds_p50'], report['link_seconds_p95'], report['link_seconds_max']))
+    print('Peak RSS:            %.1f MB' % report['peak_rss_mb'])
+    print('Renders/downloads:   %d / %d (%d injected errors)' % (
+        stats['renders'], stats['downloads'], stats['injected_errors']))
+    print('Credits spent:       %.1f' % stats['credits_spent'])
+    print('Uploaded:            %d objects, %.1f MB' % (
+        stats['objects_uploaded'], stats['bytes_uploaded'] / (1024 * 1024)))
+    for timing in report['slowest_links'][:5]:
+        print('  slow: %s %s %s %.2fs%s' % (
+            timing['run_type'], timing['state'], timing['suffix'], timing['seconds'],
+            '' if timing['ok'] else ' (failed)'))
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args, screenshots_args = parser.parse_known_args(args_list)
+    report = run_benchmark(args, screenshots_args)
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+""" Queries and fills the SQLite catalog of captures written by run-screenshots.py (--catalog).
+
+    # the newest NY primary capture, or the one closest to a point in time
+    python scripts/capture_catalog.py latest NY
+    python scripts/capture_catalog.py nearest NY --suffix secondary --at 2021-03-01T12:00
+
+    # every failed capture in a week, as CSV
+    python scripts/capture_catalog.py export --start 2021-03-01 --end 2021-03-08 \\
+        --status failed --format csv > failures.csv
+
+    # catalog the captures already in the bucket, listing folders in parallel
+    python scripts/capture_catalog.py import-s3 --prefixes state_screenshots/ \\
+        --run-type-for state_screenshots=core --run-type-for CDC=core
+
+Times without a timezone are US/Eastern, like capture filenames.
+"""
+
+from argparse import ArgumentParser, ArgumentTypeError, RawDescriptionHelpFormatter
+import csv
+from datetime import datetime
+import json
+import os
+import re
+import sys
+
+from loguru import logger
+from pytz import timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import COLUMNS, CaptureCatalog, row_from_s3_object  # noqa: E402
+from s3_index import walk_bucket  # noqa: E402
+from utils import shared_s3_resource  # noqa: E402
+
+
+_INSERT_BATCH = 5000
+_TIME_FORMATS = ['%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f']
+
+
+# parses an ISO 8601 date or time, e.g. 2021-03-01, 2021-03-01T12:00 or 2021-03-01 12:00:00-05:00
+def parse_time(value):
+    text = value.strip().replace(' ', 'T', 1)
+    # strptime's %z only takes +HHMM before Python 3.7
+    offset = re.search(r'(Z|[+-]\d\d:?\d\d)$', text)
+    if offset:
+        text = text[:offset.start()] + (
+            '+0000' if offset.group(1) == 'Z' else offset.group(1).replace(':', ''))
+    for time_format in _TIME_FORMATS:
+        try:
+            parsed = datetime.strptime(text, time_format + ('%z' if offset else ''))
+        except ValueError:
+            continue
+        if parsed.tzinfo is None:
+            parsed = timezone('US/Eastern').localize(parsed)
+        return parsed
+    raise ArgumentTypeError('invalid time %r, expected e.g. 2021-03-01 or 2021-03-01T12:00' % value)
+
+
+parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+
+parser.add_argument('--catalog', default='/tmp/public-cache/catalog.sqlite',
+    help='Path of the catalog database')
+
+subparsers = parser.add_subparsers(dest='command')
+subparsers.required = True  # add_subparsers only takes required= from Python 3.7
+
+for name, description in [
+        ('latest', 'Print the newest stored capture of a link'),
+        ('nearest', 'Print the stored capture of a link closest in time to --at')]:
+    subparser = subparsers.add_parser(name, help=description)
+    subparser.add_argument('state', help='2-letter state name, e.g. NY')
+    subparser.add_argument('--suffix', default='primary',
+        help='Link name from the state\'s config')
+    subparser.add_argument('--run-type', default='',
+        help='If present, only look at captures of this run type')
+    subparser.add_argument('--at', type=parse_time, default=None,
+        help='Point in time. For latest, the newest capture as of then')
+
+export_parser = subparsers.add_parser('export', help='Write matching captures, oldest first')
+export_parser.add_argument('--start', type=parse_time, default=None,
+    help='If present, only captures at or after this time')
+export_parser.add_argument('--end', type=parse_time, default=None,
+    help='If present, only captures before this time')
+export_parser.add_argument('--states', default='',
+    help='Comma-separated 2-letter state names to export')
+export_parser.add_argument('--suffix', default='')
+export_parser.add_argument('--run-type', default='')
+export_parser.add_argument('--status', default='',
+    help='If present, only captures with this status, e.g. done or failed')
+export_parser.add_argument('--format', choices=['csv', 'jsonl'], default='jsonl')
+export_parser.add_argument('--output', default='',
+    help='Path to write to. Defaults to stdout')
+
+import_parser = subparsers.add_parser(
+    'import-s3', help='Add the captures already in an S3 bucket to the catalog')
+import_parser.add_argument('--s3-bucket', default='covid-data-archive')
+import_parser.add_argument('--s3-endpoint-url', default='',
+    help='If present, talk to this S3-compatible endpoint instead of AWS')
+import_parser.add_argument('--prefixes', default='',
+    help='Comma-separated folders to import, e.g. state_screenshots/. Defaults to every top-level '
+         'folder of the bucket')
+import_parser.add_argument('--run-type-for', action='append', default=[],
+    help='<top-level folder>=<run type>, the run type whose captures a folder holds, e.g. '
+         'state_screenshots=core. Repeat for each folder; others get no run type')
+import_parser.add_argument('--workers', type=int, default=16,
+    help='Folders listed in parallel')
+
+
+def print_capture(row):
+    if row is None:
+        logger.error('No matching capture in the catalog')
+        return 1
+    print(json.dumps({name: row[name] for name in COLUMNS}, indent=2))
+    return 0
+
+
+def export(catalog, args):
+    rows = catalog.export(
+        start=args.start, end=args.end,
+        states=[state.strip() for state in args.states.split(',') if state.strip()],
+        suffix=args.suffix or None, run_type=args.run_type or None, status=args.status or None)
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.format == 'csv':
+            writer = csv.DictWriter(out, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                out.write(json.dumps(row) + '\n')
+    finally:
+        if args.output:
+            out.close()
+
+
+def import_s3(catalog, args):
+    run_types = {}
+    for mapping in args.run_type_for:
+        folder, _, run_type = mapping.partition('=')
+        run_types[folder.strip('/')] = run_type
+    client = shared_s3_resource(args.s3_endpoint_url or None).meta.client
+
+    # runs on the listing threads; rows are inserted on this one, as SQLite has a single writer
+    def catalog_rows(folder, objects):
+        run_type = run_types.get(folder.split('/')[0]) or None
+        rows = [row_from_s3_object(item, run_type=run_type) for item in objects]
+        return [row for row in rows if row is not None]
+
+    roots = ['']
+    if args.prefixes:
+        roots = [prefix.strip().rstrip('/') + '/' for prefix in args.prefixes.split(',')]
+    batch = []
+    seen = added = 0
+    for folder, rows in walk_bucket(
+            client, args.s3_bucket, roots, catalog_rows, workers=args.workers):
+        if rows:
+            logger.info(f'{folder}: {len(rows)} captures')
+        seen += len(rows)
+        batch.extend(rows)
+        if len(batch) >= _INSERT_BATCH:
+            added += catalog.insert(batch)
+            batch = []
+    added += catalog.insert(batch)
+    logger.info(f'Found {seen} captures in S3, {added} of them new to the catalog')
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+    catalog = CaptureCatalog(args.catalog)
+    try:
+        if args.command == 'latest':
+            return print_capture(catalog.latest(
+                args.state, suffix=args.suffix, run_type=args.run_type or None, before=args.at))
+        elif args.command == 'nearest':
+            if args.at is None:
+                parser.error('nearest needs --at')
+            return print_capture(catalog.nearest(
+                args.state, args.at, suffix=args.suffix, run_type=args.run_type or None))
+        elif args.command == 'export':
+            export(catalog, args)
+        elif args.command == 'import-s3':
+            import_s3(catalog, args)
+    finally:
+        catalog.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,27 @@
+#!/bin/bash
+#
+# Compares the request every link would make with the configs at a git revision (default HEAD)
+# against the working tree, for all run types, without capturing anything.
+#
+# Usage: compare-config-plans.sh [git revision] [extra run-screenshots.py args, e.g. --states NY]
+
+set -e
+
+REV=${1:-HEAD}
+shift || true
+
+REPO=$(cd "$(dirname "$0")/.." && pwd)
+TMP=$(mktemp -d)
+trap 'rm -rf "$TMP"' EXIT
+
+git -C "$REPO" archive "$REV" configs | tar -x -C "$TMP"
+
+RUN_TYPES=core,CRDT,LTC,vaccine,variants
+DATE=$(date +%Y-%m-%d)
+
+python "$REPO/run-screenshots.py" --run-types $RUN_TYPES --temp-dir "$TMP" --plan-date $DATE \
+    --config-root "$TMP/configs" --plan "$TMP/old.jsonl" "$@"
+python "$REPO/run-screenshots.py" --run-types $RUN_TYPES --temp-dir "$TMP" --plan-date $DATE \
+    --plan "$TMP/new.jsonl" "$@"
+
+python "$REPO/scripts/plan_diff.py" "$TMP/old.jsonl" "$TMP/new.jsonl"
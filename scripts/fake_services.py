@@ -0,0 +1,285 @@
+""" Local stand-ins for PhantomJSCloud, state data sites and S3, for offline benchmarks.
+
+One threaded HTTP server answers all three, routed by path:
+
+  POST /api/browser/v2/<key>/   PhantomJSCloud render: sleeps, then returns an uncompressed PNG
+  GET  /files/<original URL>    a state `file:` link download
+  GET  /_stats                  JSON counters (requests, injected errors, credits, bytes uploaded)
+  anything else                 path-style S3: PutObject and multipart uploads are accepted and
+                                counted, but object bodies are thrown away
+
+Latency, error rate and payload sizes are configurable so concurrency and retry changes can be
+measured without any network access.
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import random
+from socketserver import ThreadingMixIn
+import struct
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import uuid
+import zlib
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def _random_bytes(size, seed=0):
+    return random.Random(seed).getrandbits(8 * size).to_bytes(size, 'little') if size else b''
+
+
+def _png_chunk(kind, data):
+    chunk = kind + data
+    return struct.pack('>I', len(data)) + chunk + struct.pack('>I', zlib.crc32(chunk))
+
+
+# a valid RGB PNG of about size bytes, stored uncompressed as a poorly optimized render would be:
+# flat bands of color with some noise, so re-encoding it can shrink it a lot
+def _fake_png(size, width=1280):
+    height = max(1, size // (width * 3 + 1))
+    noise = _random_bytes(width * 3)
+    rows = []
+    for y in range(height):
+        band = bytes([(y // 40 * 37) % 256, (y // 40 * 91) % 256, 200]) * width
+        row = band if y % 7 else noise
+        rows.append(b'\x00' + row)
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (PNG_SIGNATURE + _png_chunk(b'IHDR', header)
+            + _png_chunk(b'IDAT', zlib.compress(b''.join(rows), 0)) + _png_chunk(b'IEND', b''))
+
+
+# shapes of injected render errors: PhantomJSCloud's JSON error with response metadata, a
+# non-JSON error page (as from a gateway in front of its API), or the connection closed unanswered
+ERROR_SHAPES = ['meta', 'bare', 'reset']
+
+
+class FakeServiceSettings():
+
+    def __init__(self, latency_ms=500, latency_jitter_ms=250, file_latency_ms=50,
+                 error_rate=0.0, error_status=503, retry_after=None, error_shape='meta',
+                 error_target_status=None, payload_kb=300, file_payload_kb=100, credit_cost=1.0,
+                 credits=100000):
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.file_latency_ms = file_latency_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        # what an injected render error looks like, one of ERROR_SHAPES; with
+        # error_target_status, it also reports that status for the page, as PhantomJSCloud does
+        # for pages that loaded with an error
+        self.error_shape = error_shape
+        self.error_target_status = error_target_status
+        self.payload_kb = payload_kb
+        self.file_payload_kb = file_payload_kb
+        # each render response carries PhantomJSCloud-style billing headers
+        self.credit_cost = credit_cost
+        self.credits = credits
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class FakeServices():
+    """Owns the server, the canned payloads and the counters reported at /_stats."""
+
+    def __init__(self, settings, host='127.0.0.1', port=0):
+        self.settings = settings
+        # bodies are generated once, the same on every run: the content doesn't matter, only the
+        # size (and that repeated captures are identical, as unchanged pages are)
+        self.render_body = _fake_png(int(settings.payload_kb * 1024))
+        self.file_body = _random_bytes(int(settings.file_payload_kb * 1024))
+        self._lock = threading.Lock()
+        self.stats = {
+            'renders': 0,
+            'downloads': 0,
+            'injected_errors': 0,
+            'objects_uploaded': 0,
+            'bytes_uploaded': 0,
+            'credits_spent': 0.0,
+        }
+        self._multipart = {}  # upload ID -> bytes received so far
+
+        services = self
+
+        class Handler(_FakeServiceHandler):
+            fake = services
+
+        self.server = _ThreadingHTTPServer((host, port), Handler)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def count(self, **increments):
+        with self._lock:
+            for name, value in increments.items():
+                self.stats[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+    # charges one render and returns its billing headers
+    def bill(self):
+        with self._lock:
+            self.stats['credits_spent'] += self.settings.credit_cost
+            remaining = max(self.settings.credits - self.stats['credits_spent'], 0)
+        return {
+            'pjsc-billing-credit-cost': str(self.settings.credit_cost),
+            'pjsc-billing-prepaid-credits-remaining': str(remaining),
+        }
+
+    def sleep(self, latency_ms, jitter_ms=0):
+        delay = latency_ms + random.uniform(-jitter_ms, jitter_ms)
+        time.sleep(max(delay, 0) / 1000)
+
+    def should_fail(self):
+        return self.settings.error_rate and random.random() < self.settings.error_rate
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _FakeServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the real services allow
+    fake = None  # set on the per-server subclass
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    # trailers (e.g. checksums) end with an empty line
+                    while self.rfile.readline().strip():
+                        pass
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def send(self, status, body=b'', content_type='application/octet-stream', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_json(self, status, obj, headers=None):
+        self.send(status, json.dumps(obj).encode(), 'application/json', headers=headers)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/_stats':
+            self.send_json(200, self.fake.snapshot())
+        elif path.startswith('/files/'):
+            self.download()
+        else:
+            self.send(404, b'<Error><Code>NoSuchKey</Code></Error>', 'application/xml')
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        if parsed.path.startswith('/api/browser/'):
+            self.render()
+        else:
+            self.s3_multipart(parsed)
+
+    def do_PUT(self):
+        parsed = urlparse(self.path)
+        body = self.read_body()
+        query = parse_qs(parsed.query)
+        if 'uploadId' in query:
+            upload_id = query['uploadId'][0]
+            with self.fake._lock:
+                self.fake._multipart[upload_id] = self.fake._multipart.get(upload_id, 0) + len(body)
+        else:
+            self.fake.count(objects_uploaded=1, bytes_uploaded=len(body))
+        self.send(200, headers={'ETag': '"%s"' % uuid.uuid4().hex})
+
+    def render(self):
+        self.read_body()
+        settings = self.fake.settings
+        self.fake.sleep(settings.latency_ms, settings.latency_jitter_ms)
+        if self.fake.should_fail():
+            self.fake.count(injected_errors=1)
+            self.render_error()
+            return
+        self.fake.count(renders=1)
+        self.send(200, self.fake.render_body, 'image/png', headers=self.fake.bill())
+
+    def render_error(self):
+        settings = self.fake.settings
+        if settings.error_shape == 'reset':
+            self.close_connection = True
+            return
+        headers = self.fake.bill()
+        if settings.retry_after is not None:
+            headers['Retry-After'] = str(settings.retry_after)
+        if settings.error_shape == 'bare':
+            self.send(settings.error_status, b'<html>injected benchmark error</html>', 'text/html',
+                      headers=headers)
+            return
+        body = {'meta': {'status': settings.error_status, 'message': 'injected benchmark error'}}
+        if settings.error_target_status is not None:
+            headers['pjsc-content-status-code'] = str(settings.error_target_status)
+            body['content'] = {'statusCode': settings.error_target_status}
+        self.send_json(settings.error_status, body, headers=headers)
+
+    def download(self):
+        settings = self.fake.settings
+        self.fake.sleep(settings.file_latency_ms)
+        if self.fake.should_fail():
+            self.fake.count(injected_errors=1)
+            self.send(settings.error_status, b'injected benchmark error', 'text/plain')
+            return
+        self.fake.count(downloads=1)
+        self.send(200, self.fake.file_body)
+
+    # CreateMultipartUpload (?uploads) and CompleteMultipartUpload (?uploadId=...)
+    def s3_multipart(self, parsed):
+        self.read_body()
+        query = parse_qs(parsed.query, keep_blank_values=True)
+        bucket, _, key = parsed.path.lstrip('/').partition('/')
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            with self.fake._lock:
+                self.fake._multipart[upload_id] = 0
+            body = (
+                '<InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key>'
+                '<UploadId>%s</UploadId></InitiateMultipartUploadResult>' % (bucket, key, upload_id))
+        elif 'uploadId' in query:
+            with self.fake._lock:
+                nbytes = self.fake._multipart.pop(query['uploadId'][0], 0)
+            self.fake.count(objects_uploaded=1, bytes_uploaded=nbytes)
+            body = (
+                '<CompleteMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key>'
+                '<ETag>"%s"</ETag></CompleteMultipartUploadResult>' % (bucket, key, uuid.uuid4().hex))
+        else:
+            self.send(400, b'<Error><Code>InvalidRequest</Code></Error>', 'application/xml')
+            return
+        self.send(200, body.encode(), 'application/xml')
@@ -1,180 +1,234 @@
-import os
-import io
-import pandas as pd
-import requests
-import yaml
-from datetime import date 
-from datetime import timedelta
-
-def load_urls_from_live_info(url):
-
-    content = requests.get(url).content
-    state_info_df = pd.read_csv(io.StringIO(content.decode('utf-8')), keep_default_na=False) # default_na=false so that empty cells -> empty strings
-    
-    state_urls = {}
-    for idx, r in state_info_df.iterrows():
-        state_urls[r["state"]] = {
-            'primary': r["covid19Site"],
-            'secondary': r["covid19SiteSecondary"],
-            'tertiary': r["covid19SiteTertiary"],
-            'quaternary': r["covid19SiteQuaternary"],
-            'quinary': r["covid19SiteQuinary"],
-        }
-
-    return state_urls
-
-
-def load_urls_from_spreadsheet(csv_url):
-
-    urls_df = pd.read_csv(csv_url, keep_default_na=False) # default_na=false so that empty cells -> empty strings
-
-    state_urls = {}
-    for idx, row in urls_df.iterrows():
-        state_urls[row['State']] = {
-            'primary': row['Link 1'],
-            'secondary': row['Link 2'],
-            'tertiary': row['Link 3'],
-        }
+""" Regenerates the per-state YAMLs in configs/<team> from each team's spreadsheet of links, merged
+with the per-link settings of the old configs in the covid-tracking-data repo.
 
-    return state_urls
+Each YAML is rendered in memory and only written if its content changed, so unchanged configs
+keep their mtimes and the diff only shows real changes. Spreadsheets can be given as local CSV
+paths instead of URLs, to run offline:
 
+    python scripts/generate_new_configs.py --states-info-csv info.csv --crdt-csv crdt.csv \\
+        --ltc-csv ltc.csv --teams taco,crdt
+"""
 
-# construct an array containing the URL configs (up to 5) for each state (including the URL, name and existing YAML config)
-# then dump that dictionary to a new YAML file named after the state, in the appropriate directory
-def output_yamls(team, state_urls, config_basename):
-    
-    # reads from the covid-tracking-data repo
-    screenshot_config_path = os.path.join(os.path.dirname(__file__), '../../covid-tracking-data/screenshots/configs', config_basename)
-    with open(screenshot_config_path) as f:
-        existing_config = yaml.safe_load(f)
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import hashlib
+import io
+import os
+import pandas as pd
+import yaml
+from datetime import date  # noqa: F401 (used by eval links)
+from datetime import timedelta  # noqa: F401 (used by eval links)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STATES_INFO_URL = 'https://covidtracking.com/api/states/info.csv'
+CRDT_URL = 'https://docs.google.com/spreadsheets/d/1lfwMmo7q-faKfvh6phxQs9rEJXVnnyISFtiVbq9XJ7U/gviz/tq?tqx=out:csv&sheet=Sheet1'  # noqa: E501
+LTC_URL = 'https://docs.google.com/spreadsheets/d/1kB6lT0n4wJ2l8uP-lIOZyIVWCRJTPWLGf3Q4ZCC6pMQ/gviz/tq?tqx=out:csv&sheet=LTC_Screencap_Links'  # noqa: E501
+
+# link name -> spreadsheet column, in the order links are written
+STATES_INFO_COLUMNS = {
+    'primary': 'covid19Site',
+    'secondary': 'covid19SiteSecondary',
+    'tertiary': 'covid19SiteTertiary',
+    'quaternary': 'covid19SiteQuaternary',
+    'quinary': 'covid19SiteQuinary',
+}
+SPREADSHEET_COLUMNS = {
+    'primary': 'Link 1',
+    'secondary': 'Link 2',
+    'tertiary': 'Link 3',
+}
+
+# links whose URL changes daily, as the Python expression the screenshotter evaluates; per old
+# config basename, (state, link name) -> expression
+EVAL_LINKS = {
+    'core_screenshot_config.yaml': {
+        ('MA', 'primary'): 'date.today().strftime("https://www.mass.gov/doc/covid-19-dashboard-%B-%d-%Y/download").lower()',  # noqa: E501
+        ('MA', 'secondary'): 'date.today().strftime("https://www.mass.gov/doc/weekly-covid-19-public-health-report-%B-%d-%Y/download").lower()',  # noqa: E501
+        ('MT', 'tertiary'): '(date.today() - timedelta(days=1)).strftime("https://dphhs.mt.gov/Portals/85/publichealth/documents/CDEpi/DiseasesAtoZ/2019-nCoV/Status%%20Update%%20Data%%20Report_%m%d%Y.pdf")',  # noqa: E501
+        ('OK', 'secondary'): '(date.today() - timedelta(days=1)).strftime("https://coronavirus.health.ok.gov/sites/g/files/gmc786/f/eo_-_covid-19_report_-_%m-%d-%y.pdf")',  # noqa: E501
+        ('OK', 'tertiary'): '(date.today() - timedelta(days=1)).strftime("https://coronavirus.health.ok.gov/sites/g/files/gmc786/f/%Y.%m.%d_weekly_epi_report.pdf")',  # noqa: E501
+    },
+    'crdt_screenshot_config.yaml': {
+        ('CT', 'primary'): 'date.today().strftime("https://portal.ct.gov/-/media/Coronavirus/CTDPHCOVID19summary%m%d%Y.pdf")',  # noqa: E501
+        ('DC', 'primary'): '(date.today() - timedelta(days=1)).strftime("https://coronavirus.dc.gov/sites/default/files/dc/sites/coronavirus/page_content/attachments/DC-COVID-19-Data-for-%B-%-d-%Y.xlsx")',  # noqa: E501
+        ('MA', 'primary'): 'date.today().strftime("https://www.mass.gov/doc/covid-19-dashboard-%B-%d-%Y/download").lower()',  # noqa: E501
+    },
+}
+
+# loads much faster than the pure Python loader, if PyYAML was built with libyaml
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+
+parser.add_argument('--states-info-csv', default=STATES_INFO_URL,
+    help='URL or local path of the states info CSV, for the taco (core) configs')
+
+parser.add_argument('--crdt-csv', default=CRDT_URL,
+    help='URL or local path of the CRDT links spreadsheet as CSV')
+
+parser.add_argument('--ltc-csv', default=LTC_URL,
+    help='URL or local path of the LTC links spreadsheet as CSV')
+
+parser.add_argument('--old-configs-dir',
+    default=os.path.join(SCRIPT_DIR, '../../covid-tracking-data/screenshots/configs'),
+    help='Directory of the old per-link configs to merge settings from')
+
+parser.add_argument('--configs-dir', default=os.path.join(SCRIPT_DIR, '../configs'),
+    help='Directory of the per-team config directories to write')
+
+parser.add_argument('--teams', default='taco,crdt,ltc',
+    help='Comma-separated teams to regenerate')
+
+parser.add_argument('--dry-run', dest='dry_run', action='store_true', default=False,
+    help='If present, only report which configs would change')
+
+
+# reads a CSV from a URL or a local path, with empty cells as empty strings
+def read_csv(source, columns):
+    if source.startswith(('http://', 'https://')):
+        import requests  # only needed online
+        response = requests.get(source)
+        response.raise_for_status()
+        source = io.StringIO(response.content.decode('utf-8'))
+    return pd.read_csv(source, usecols=columns, dtype=str, keep_default_na=False)
+
+
+# returns state -> ordered dict of link name -> URL (empty if there's none), leaving out states
+# with no links at all
+def load_urls(source, state_column, link_columns):
+    urls_df = read_csv(source, [state_column] + list(link_columns.values()))
+    urls_df = urls_df.rename(columns={
+        column: name for name, column in link_columns.items()}).set_index(state_column)
+    urls_df = urls_df[list(link_columns)]
+    # the last row wins if a state is listed twice
+    urls_df = urls_df[~urls_df.index.duplicated(keep='last')]
+    urls_df = urls_df[(urls_df != '').any(axis=1)]
+    return urls_df.to_dict('index')
+
+
+def load_urls_from_live_info(source):
+    return load_urls(source, 'state', STATES_INFO_COLUMNS)
+
+
+def load_urls_from_spreadsheet(source):
+    return load_urls(source, 'State', SPREADSHEET_COLUMNS)
+
+
+# renders the YAML for one state: its links, each merged with the old config for that link
+def render_state_yaml(state, urls, existing_config, config_basename):
+    eval_links = EVAL_LINKS.get(config_basename, {})
+    outfile = io.StringIO()
+    outfile.write("state: " + state + "\n\n")
+    outfile.write("links: " + "\n")
+
+    for url_name, url_text in urls.items():
+
+        # if there's no URL, that means there was an empty cell in the spreadsheet
+        if not url_text:
+            continue
 
-    # set up the output directory
-    destination_directory =  os.path.join(os.path.dirname(__file__), '../configs', team)
+        existing_state_config = existing_config[url_name].get(state)
+
+        outfile.write("- name: " + url_name + "\n")
+
+        new_url_text = eval_links.get((state, url_name))
+        if new_url_text:
+            outfile.write("  eval: True\n")
+            # make sure the text resolves to what's currently in the sheets
+            evaluated_text = eval(new_url_text)
+            if evaluated_text != url_text:
+                print('Unexpected difference in evaluated link: should be %s but is %s' % (
+                    url_text, evaluated_text))
+            url_text = new_url_text
+
+        outfile.write("  url: " + url_text + "\n")
+
+        if existing_state_config:
+            if "overseerScript" in existing_state_config:
+                outfile.write("  overseerScript: |\n")
+                # strip newlines
+                overseer_script = existing_state_config["overseerScript"].strip()
+                # each statement on its own line
+                for command in overseer_script.split(';'):
+                    command = command.strip()
+                    if '{' in command:
+                        command = command.replace('{', '{\n     ')
+                    if command:
+                        outfile.write("    %s;\n" % command)
+
+            if "renderSettings" in existing_state_config:
+                outfile.write("  renderSettings: \n    " + yaml.dump(
+                    existing_state_config["renderSettings"], default_flow_style=False, indent=6))
+
+            if "requestSettings" in existing_state_config:
+                outfile.write("  requestSettings: \n    " + yaml.dump(
+                    existing_state_config["requestSettings"], default_flow_style=False, indent=6))
+
+            if "file" in existing_state_config:
+                outfile.write("  file: %s\n" % existing_state_config["file"])
+
+            if "message" in existing_state_config:
+                outfile.write("  message: %s\n" % existing_state_config["message"])
+
+        outfile.write("\n")
+
+    return outfile.getvalue()
+
+
+# writes text to path unless the file already has exactly that content; returns whether it (would
+# have) changed
+def write_if_changed(path, text, dry_run=False):
+    data = text.encode('utf-8')
+    try:
+        with open(path, 'rb') as f:
+            if hashlib.sha256(f.read()).digest() == hashlib.sha256(data).digest():
+                return False
+    except FileNotFoundError:
+        pass
+    if not dry_run:
+        with open(path, 'wb') as f:
+            f.write(data)
+    return True
+
+
+# renders the YAML of every state with links, merged with the old config at config_basename, and
+# writes those that changed to configs/<team>
+def output_yamls(team, state_urls, config_basename, args):
+    with open(os.path.join(args.old_configs_dir, config_basename)) as f:
+        existing_config = yaml.load(f, Loader=YamlLoader)
+
+    destination_directory = os.path.join(args.configs_dir, team)
     os.makedirs(destination_directory, exist_ok=True)
 
-    # walk through the states from the spreadsheet
+    changed = []
     for state, urls in state_urls.items():
-
-        # no URLs for this state
-        if not any(len(x) > 0 for x in urls.values()):
-            continue
- 
-        # open a file for the current state, creating the file if it doesn't exist
-        with open(destination_directory + "/" + state + '.yaml', 'w+') as outfile:
-
-            outfile.write("state: " + state + "\n\n")
-            outfile.write("links: " + "\n")
-
-            # walk through the URLs for the state, and merge with config from the old YAMLs
-            new_config_list = []
-            for url_name, url_text in urls.items():
-                
-                # if there's no URL, that means there was an empty cell in the spreadsheet
-                if not url_text:
-                    continue
-
-                existing_state_config = existing_config[url_name].get(state)
-                
-                outfile.write("- name: " + url_name + "\n")
-
-                if config_basename == 'core_screenshot_config.yaml':
-                    # some special case eval files
-                    eval_needed = False
-                    new_url_text = None
-                    if state == 'MA' and url_name == 'primary':
-                        new_url_text = 'date.today().strftime("https://www.mass.gov/doc/covid-19-dashboard-%B-%d-%Y/download").lower()'
-                        eval_needed = True
-                    elif state == 'MA' and url_name == 'secondary':
-                        new_url_text = 'date.today().strftime("https://www.mass.gov/doc/weekly-covid-19-public-health-report-%B-%d-%Y/download").lower()'
-                        eval_needed = True
-                    elif state == 'MT' and url_name == 'tertiary':
-                        new_url_text = '(date.today() - timedelta(days=1)).strftime("https://dphhs.mt.gov/Portals/85/publichealth/documents/CDEpi/DiseasesAtoZ/2019-nCoV/Status%%20Update%%20Data%%20Report_%m%d%Y.pdf")'
-                        eval_needed = True
-                    elif state == 'OK' and url_name == 'secondary':
-                        new_url_text = '(date.today() - timedelta(days=1)).strftime("https://coronavirus.health.ok.gov/sites/g/files/gmc786/f/eo_-_covid-19_report_-_%m-%d-%y.pdf")'
-                        eval_needed = True
-                    elif state == 'OK' and url_name == 'tertiary':
-                        new_url_text = '(date.today() - timedelta(days=1)).strftime("https://coronavirus.health.ok.gov/sites/g/files/gmc786/f/%Y.%m.%d_weekly_epi_report.pdf")'
-                        eval_needed = True
-
-                    if eval_needed:
-                        outfile.write("  eval: True\n")
-                        # make sure the text resolves to what's currently in the sheets
-                        evaluated_text = eval(new_url_text)
-                        if evaluated_text != url_text:
-                            print('Unexpected difference in evaluated link: should be %s but is %s' % (url_text, evaluated_text))
-                        url_text = new_url_text
-
-                elif config_basename == 'crdt_screenshot_config.yaml':
-                    eval_needed = False
-                    new_url_text = None
-                    # more special case eval files
-                    if state == 'CT' and url_name == 'primary':
-                        new_url_text = 'date.today().strftime("https://portal.ct.gov/-/media/Coronavirus/CTDPHCOVID19summary%m%d%Y.pdf")'
-                        eval_needed = True
-
-                    if state == 'DC' and url_name == 'primary':
-                        new_url_text = '(date.today() - timedelta(days=1)).strftime("https://coronavirus.dc.gov/sites/default/files/dc/sites/coronavirus/page_content/attachments/DC-COVID-19-Data-for-%B-%-d-%Y.xlsx")'
-                        eval_needed = True
-
-                    if state == 'MA' and url_name == 'primary':
-                        new_url_text = 'date.today().strftime("https://www.mass.gov/doc/covid-19-dashboard-%B-%d-%Y/download").lower()'
-                        eval_needed = True
-
-                    if eval_needed:
-                        outfile.write("  eval: True\n")
-                        # make sure the text resolves to what's currently in the sheets
-                        evaluated_text = eval(new_url_text)
-                        if evaluated_text != url_text:
-                            print('Unexpected difference in evaluated link: should be %s but is %s' % (url_text, evaluated_text))
-                        url_text = new_url_text
-
-
-                outfile.write("  url: " + url_text + "\n")
-
-                if existing_state_config:
-                    if "overseerScript" in existing_state_config:
-                        outfile.write("  overseerScript: |\n")
-                        # strip newlines
-                        overseer_script = existing_state_config["overseerScript"].strip()
-                        # each statement on its own line
-                        for command in overseer_script.split(';'):
-                            command = command.strip()
-                            if '{' in command:
-                                command = command.replace('{', '{\n     ')
-                            if command:
-                                outfile.write("    %s;\n" % command)
-
-                    if "renderSettings" in existing_state_config:
-                        outfile.write("  renderSettings: \n    " + yaml.dump(
-                            existing_state_config["renderSettings"], default_flow_style=False, indent=6))
-
-                    if "requestSettings" in existing_state_config:
-                        outfile.write("  requestSettings: \n    " + yaml.dump(
-                            existing_state_config["requestSettings"], default_flow_style=False, indent=6))
-
-                    if "file" in existing_state_config:
-                        outfile.write("  file: %s\n" % existing_state_config["file"])
-
-                    if "message" in existing_state_config:
-                        outfile.write("  message: %s\n" % existing_state_config["message"])
-
-                outfile.write("\n")
-    
+        text = render_state_yaml(state, urls, existing_config, config_basename)
+        if write_if_changed(
+                os.path.join(destination_directory, state + '.yaml'), text, args.dry_run):
+            changed.append(state)
+    print('%s: %d of %d configs %s%s' % (
+        team, len(changed), len(state_urls), 'would change' if args.dry_run else 'changed',
+        (' (%s)' % ', '.join(changed)) if changed else ''))
+    return changed
 
 
-def main(args_list=None):
+# team -> (function loading its links, args attribute with its CSV, old config basename)
+TEAMS = {
+    'taco': (load_urls_from_live_info, 'states_info_csv', 'core_screenshot_config.yaml'),
+    'crdt': (load_urls_from_spreadsheet, 'crdt_csv', 'crdt_screenshot_config.yaml'),
+    'ltc': (load_urls_from_spreadsheet, 'ltc_csv', 'ltc_screenshot_config.yaml'),
+}
 
-    state_urls = load_urls_from_live_info('https://covidtracking.com/api/states/info.csv')
-    output_yamls("taco", state_urls, 'core_screenshot_config.yaml')
 
-    state_urls = load_urls_from_spreadsheet('https://docs.google.com/spreadsheets/d/1lfwMmo7q-faKfvh6phxQs9rEJXVnnyISFtiVbq9XJ7U/gviz/tq?tqx=out:csv&sheet=Sheet1')
-    output_yamls("crdt", state_urls, 'crdt_screenshot_config.yaml')
-
-    state_urls = load_urls_from_spreadsheet('https://docs.google.com/spreadsheets/d/1kB6lT0n4wJ2l8uP-lIOZyIVWCRJTPWLGf3Q4ZCC6pMQ/gviz/tq?tqx=out:csv&sheet=LTC_Screencap_Links')
-    output_yamls("ltc", state_urls, 'ltc_screenshot_config.yaml')
+def main(args_list=None):
+    args = parser.parse_args(args_list)
+    for team in [team.strip() for team in args.teams.split(',') if team.strip()]:
+        if team not in TEAMS:
+            parser.error('Unknown team %s, expected one of %s' % (team, ', '.join(TEAMS)))
+        load, source_attr, config_basename = TEAMS[team]
+        output_yamls(team, load(getattr(args, source_attr)), config_basename, args)
 
 
-    
 if __name__ == "__main__":
     main()
@@ -0,0 +1,68 @@
+""" Compares two request plans written by run-screenshots.py --plan, link by link.
+
+    python run-screenshots.py --run-types core,CRDT,LTC,vaccine,variants --plan new.jsonl
+    python scripts/plan_diff.py old.jsonl new.jsonl
+
+Prints each link that was added (+), removed (-) or whose request changed (~), with the fields
+that changed, and exits with status 1 if there are any differences, like diff.
+See scripts/compare-config-plans.sh to compare the configs against a git revision.
+"""
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from plan import changed_fields, diff_plans  # noqa: E402
+
+
+parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+
+parser.add_argument('old_plan', help='Path of the plan to compare against')
+
+parser.add_argument('new_plan', help='Path of the changed plan')
+
+parser.add_argument('--ignore-script-whitespace', action='store_true', default=False,
+    help='If present, overseer scripts that only differ in whitespace count as unchanged')
+
+parser.add_argument('--max-value-chars', type=int, default=200,
+    help='Changed values longer than this are truncated in the output; 0 never truncates')
+
+
+def describe(value, max_chars):
+    text = json.dumps(value)
+    if max_chars and len(text) > max_chars:
+        text = text[:max_chars] + '...'
+    return text
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args = parser.parse_args(args_list)
+
+    counts = {'+': 0, '-': 0, '~': 0}
+    for change, key, old, new in diff_plans(
+            args.old_plan, args.new_plan,
+            ignore_script_whitespace=args.ignore_script_whitespace):
+        counts[change] += 1
+        name = ' '.join(part for part in key if part)
+        if change == '+':
+            print('+ %s: %s' % (name, new.get('url') or new.get('error')))
+        elif change == '-':
+            print('- %s: %s' % (name, old.get('url') or old.get('error')))
+        else:
+            print('~ %s' % name)
+            for field, old_value, new_value in changed_fields(old, new):
+                print('    %s: %s -> %s' % (
+                    field, describe(old_value, args.max_value_chars),
+                    describe(new_value, args.max_value_chars)))
+
+    print('%d added, %d removed, %d changed' % (counts['+'], counts['-'], counts['~']))
+    return 1 if any(counts.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
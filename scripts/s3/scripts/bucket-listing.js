@@ -27,6 +27,17 @@ if (typeof S3B_ROOT_DIR == 'undefined') {
 if (typeof S3B_SORT == 'undefined') {
     var S3B_SORT = 'DEFAULT';
 }
+// Folders with an index under _index/ (kept up to date by the screenshotter, see s3_index.py) are
+// shown from it, a page at a time, instead of listing the bucket 1000 keys per request
+if (typeof S3B_USE_INDEX == 'undefined') {
+    var S3B_USE_INDEX = true;
+}
+if (typeof S3B_INDEX_PAGE_SIZE == 'undefined') {
+    var S3B_INDEX_PAGE_SIZE = 200;
+}
+var S3B_INDEX_ROOT = '_index';
+// daily index shards fetched at once while filling a page
+var S3B_INDEX_FETCH_DAYS = 7;
 if (typeof EXCLUDE_FILE == 'undefined') {
     var EXCLUDE_FILE = [];
 } else if (typeof EXCLUDE_FILE == 'string') {
@@ -84,7 +95,7 @@ if (!Array.prototype.includes) {
     });
 }
 
-jQuery(function($) { getS3Data(); });
+jQuery(function($) { loadFolder(); });
 
 // This will sort your file listing by most recently modified.
 // Flip the comparator to '>' if you want oldest files first.
@@ -107,11 +118,182 @@ function sortFunction(a, b) {
         }
 }
 
+function loadingNotice() {
+    return '<img src="//assets.okfn.org/images/icons/ajaxload-circle.gif" />';
+}
+
+// Shows the folder from its index if it has one, otherwise from the S3 listing
+function loadFolder() {
+    var prefix = getPrefix();
+    if (!S3B_USE_INDEX || !prefix) {
+        getS3Data();
+        return;
+    }
+    $('#listing').html(loadingNotice());
+    $.getJSON(BUCKET_URL + '/' + S3B_INDEX_ROOT + '/' + encodePath(prefix) + 'days.json')
+            .done(function(index) {
+                showIndex(prefix, index);
+            })
+            .fail(function() {
+                getS3Data();
+            });
+}
+
+// state of the index view of a folder
+var indexView = null;
+
+function showIndex(prefix, index) {
+    var days = Object.keys(index.days || {}).sort();
+    if (S3B_SORT != 'OLD2NEW' && S3B_SORT != 'A2Z') {
+        days.reverse();  // newest first
+    }
+    var total = 0;
+    $.each(index.days || {}, function(day, totals) {
+        total += totals.count;
+    });
+    indexView = {
+        prefix: prefix,
+        days: days,
+        nextDay: 0,
+        loading: false,
+        rerender: false,
+        entries: [],
+        suffixes: [],
+        total: total,
+        page: 0,
+        suffix: '',
+        text: ''
+    };
+    buildNavigation({prefix: prefix});
+    $('head').append('<base href="' + (location.href.endsWith('/') ? location.href : location.href + '/') + '">');
+    $('#listing').html(
+            '<div id="index-controls">' +
+            'Link: <select id="index-suffix"><option value="">all</option></select> ' +
+            'Filter: <input id="index-text" type="text" size="30" /> ' +
+            '<button id="index-prev">&laquo; newer</button> ' +
+            '<button id="index-next">older &raquo;</button> ' +
+            '<span id="index-status"></span>' +
+            '</div><div id="index-table"></div>');
+    if (S3B_SORT == 'OLD2NEW' || S3B_SORT == 'A2Z') {
+        $('#index-prev').html('&laquo; older');
+        $('#index-next').html('newer &raquo;');
+    }
+    $('#index-suffix').on('change', function() {
+        indexView.suffix = $(this).val();
+        indexView.page = 0;
+        renderIndexPage();
+    });
+    $('#index-text').on('input', function() {
+        indexView.text = $(this).val().toLowerCase();
+        indexView.page = 0;
+        renderIndexPage();
+    });
+    $('#index-prev').on('click', function() {
+        indexView.page = Math.max(indexView.page - 1, 0);
+        renderIndexPage();
+    });
+    $('#index-next').on('click', function() {
+        indexView.page += 1;
+        renderIndexPage();
+    });
+    renderIndexPage();
+}
+
+function matchingEntries() {
+    return $.grep(indexView.entries, function(entry) {
+        return (!indexView.suffix || entry.suffix === indexView.suffix) &&
+                (!indexView.text || entry.key.toLowerCase().indexOf(indexView.text) !== -1);
+    });
+}
+
+// Fetches daily shards, a few at a time and in order, until there are `needed` matching entries
+// or no days are left, then calls done
+function loadIndexEntries(needed, done) {
+    if (matchingEntries().length >= needed || indexView.nextDay >= indexView.days.length) {
+        done();
+        return;
+    }
+    var days = indexView.days.slice(indexView.nextDay, indexView.nextDay + S3B_INDEX_FETCH_DAYS);
+    indexView.nextDay += days.length;
+    var requests = $.map(days, function(day) {
+        // a missing shard (e.g. removed by hand) is just an empty day
+        var shard = $.Deferred();
+        $.getJSON(BUCKET_URL + '/' + S3B_INDEX_ROOT + '/' + encodePath(indexView.prefix) +
+                day + '.json')
+                .done(function(data) { shard.resolve(data); })
+                .fail(function() { shard.resolve(null); });
+        return shard.promise();
+    });
+    $('#index-status').html(loadingNotice());
+    $.when.apply($, requests)
+            .done(function() {
+                // one shard per day fetched, in order
+                $.each(arguments, function(i, shard) {
+                    var entries = (shard && shard.entries) || [];
+                    if (!(S3B_SORT == 'OLD2NEW' || S3B_SORT == 'A2Z')) {
+                        entries = entries.slice().reverse();
+                    }
+                    $.each(entries, function(j, entry) {
+                        indexView.entries.push(entry);
+                        if (entry.suffix && !indexView.suffixes.includes(entry.suffix)) {
+                            indexView.suffixes.push(entry.suffix);
+                            $('#index-suffix').append($('<option>').val(entry.suffix).text(entry.suffix));
+                        }
+                    });
+                });
+                loadIndexEntries(needed, done);
+            });
+}
+
+function renderIndexPage() {
+    var view = indexView;
+    if (view.loading) {
+        // shards must be added in order: render again once the current fetch is done
+        view.rerender = true;
+        return;
+    }
+    view.loading = true;
+    var start = view.page * S3B_INDEX_PAGE_SIZE;
+    loadIndexEntries(start + S3B_INDEX_PAGE_SIZE + 1, function() {
+        view.loading = false;
+        if (view.rerender) {
+            view.rerender = false;
+            renderIndexPage();
+            return;
+        }
+        var matching = matchingEntries();
+        if (start >= matching.length && view.page > 0) {
+            view.page = Math.max(Math.ceil(matching.length / S3B_INDEX_PAGE_SIZE) - 1, 0);
+            start = view.page * S3B_INDEX_PAGE_SIZE;
+        }
+        var pageEntries = matching.slice(start, start + S3B_INDEX_PAGE_SIZE);
+        var info = {
+            prefix: view.prefix,
+            directories: [],
+            files: $.map(pageEntries, function(entry) {
+                return {
+                    Key: entry.key,
+                    LastModified: entry.time,
+                    Size: bytesToHumanReadable(entry.size),
+                    Type: 'file'
+                };
+            })
+        };
+        var more = view.nextDay < view.days.length || matching.length > start + S3B_INDEX_PAGE_SIZE;
+        $('#index-prev').prop('disabled', view.page == 0);
+        $('#index-next').prop('disabled', !more);
+        $('#index-status').text(
+                (pageEntries.length ? (start + 1) + '-' + (start + pageEntries.length) : '0') +
+                ' of ' + (view.suffix || view.text ? matching.length + (more ? '+' : '') + ' matching, ' : '') +
+                view.total + ' files');
+        $('#index-table').html('<pre>' + prepareTable(info) + '</pre>');
+    });
+}
+
 function getS3Data(marker, info) {
     var s3_rest_url = createS3QueryUrl(marker);
     // set loading notice
-    $('#listing')
-            .html('<img src="//assets.okfn.org/images/icons/ajaxload-circle.gif" />');
+    $('#listing').html(loadingNotice());
     $.get(s3_rest_url)
             .done(function(data) {
                 var xml = $(data);
@@ -205,6 +387,18 @@ function createS3QueryUrl(marker) {
     // buckets but also allow deploying to non-buckets
     //
 
+    var prefix = getPrefix();
+    if (prefix) {
+        s3_rest_url += '&prefix=' + prefix;
+    }
+    if (marker) {
+        s3_rest_url += '&marker=' + marker;
+    }
+    return s3_rest_url;
+}
+
+// Returns the folder being browsed, ending in /, or '' for the root
+function getPrefix() {
     var rx = '.*[?&]prefix=' + S3B_ROOT_DIR + '([^&]+)(&.*)?$';
     var prefix = '';
     if (S3BL_IGNORE_PATH == false) {
@@ -221,12 +415,8 @@ function createS3QueryUrl(marker) {
     if (prefix) {
         // make sure we end in /
         var prefix = prefix.replace(/\/$/, '') + '/';
-        s3_rest_url += '&prefix=' + prefix;
-    }
-    if (marker) {
-        s3_rest_url += '&marker=' + marker;
     }
-    return s3_rest_url;
+    return prefix;
 }
 
 function getInfoFromS3Data(xml) {
@@ -243,6 +433,10 @@ function getInfoFromS3Data(xml) {
     });
     var directories = $.map(xml.find('CommonPrefixes'), function(item) {
         item = $(item);
+        // the index objects are the browser's own, not part of the archive
+        if (item.find('Prefix').text() == S3B_INDEX_ROOT + '/') {
+            return null;
+        }
         // clang-format off
         return {
             Key: item.find('Prefix').text(),
@@ -0,0 +1,178 @@
+""" Start-up benchmark of run-screenshots.py: import time and time to the first request.
+
+Runs a quick dry run (by default `--screenshot-core-urls --states AK --dry-run`) in fresh
+interpreters, and reports the median over --repeat runs of:
+
+  import time          total time spent importing modules, from python -X importtime
+                       (Python 3.7+; reported as unavailable on older interpreters)
+  time to first request  from starting the process until the first capture request is made
+                       (a `Dry run:` line), i.e. everything a config check waits for
+  total                  the whole process
+
+plus the slowest top-level imports. Any argument not listed below is passed through to
+run-screenshots.py. With --max-import-ms or --max-first-request-ms it exits with status 1 when
+the median is over the limit, so CI can keep quick config checks quick:
+
+    python scripts/startup_benchmark.py --max-first-request-ms 1500 --states NY
+"""
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(SCRIPTS_DIR)
+
+RUN_TYPE_ARGS = {
+    '--screenshot-core-urls', '--screenshot-crdt-urls', '--screenshot-ltc-urls',
+    '--screenshot-vax-urls', '--screenshot-variant-urls', '--run-types'}
+FIRST_REQUEST_MARKER = 'Dry run:'
+# -X importtime is new in Python 3.7; older interpreters ignore it and print nothing
+IMPORT_TIMES = sys.version_info >= (3, 7)
+
+
+parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+
+parser.add_argument('--repeat', type=int, default=5,
+    help='Number of runs to take the median of')
+
+parser.add_argument('--top', type=int, default=10,
+    help='Number of slowest top-level imports to list')
+
+parser.add_argument('--max-import-ms', type=float, default=0,
+    help='If present, fail if the median import time is over this many milliseconds')
+
+parser.add_argument('--max-first-request-ms', type=float, default=0,
+    help='If present, fail if the median time to first request is over this many milliseconds')
+
+parser.add_argument('--report', default='',
+    help='If present, write the full results as JSON to this path')
+
+
+# returns {module: (self microseconds, cumulative microseconds)} for top-level imports, i.e. the
+# ones made by run-screenshots.py itself or by site start-up, from -X importtime output
+def parse_import_times(lines):
+    imports = {}
+    for line in lines:
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if name.startswith('  '):
+            continue  # imported by another module, already counted in its cumulative time
+        imports[name.strip()] = (int(self_us), int(cumulative_us))
+    return imports
+
+
+def time_startup(screenshots_args):
+    command = [sys.executable] + (['-X', 'importtime'] if IMPORT_TIMES else []) + [
+        os.path.join(REPO_DIR, 'run-screenshots.py')]
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        command + screenshots_args, cwd=REPO_DIR, env=env, universal_newlines=True,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    first_request = None
+    lines = []
+    for line in process.stdout:
+        if first_request is None and FIRST_REQUEST_MARKER in line:
+            first_request = time.perf_counter() - start
+        lines.append(line)
+    process.wait()
+    total = time.perf_counter() - start
+    if process.returncode:
+        sys.stderr.write(''.join(line for line in lines if not line.startswith('import time:')))
+        raise RuntimeError('run-screenshots.py exited with status %d' % process.returncode)
+
+    imports = parse_import_times(lines)
+    return {
+        'import_ms': (sum(cumulative for _, cumulative in imports.values()) / 1000
+                      if IMPORT_TIMES else None),
+        'first_request_ms': first_request * 1000 if first_request is not None else None,
+        'total_ms': total * 1000,
+        'imports': imports,
+    }
+
+
+def median(values):
+    values = [value for value in values if value is not None]
+    return statistics.median(values) if values else None
+
+
+def run_benchmark(args, screenshots_args):
+    if not RUN_TYPE_ARGS.intersection(screenshots_args):
+        screenshots_args = ['--screenshot-core-urls'] + screenshots_args
+    if '--states' not in screenshots_args:
+        screenshots_args += ['--states', 'AK']
+    if '--dry-run' not in screenshots_args:
+        screenshots_args += ['--dry-run']
+
+    with tempfile.TemporaryDirectory(prefix='startup-benchmark-') as temp_dir:
+        if '--temp-dir' not in screenshots_args:
+            screenshots_args = screenshots_args + ['--temp-dir', temp_dir]
+        runs = [time_startup(screenshots_args) for _ in range(args.repeat)]
+
+    modules = {}
+    for run in runs:
+        for name, (_, cumulative) in run['imports'].items():
+            modules.setdefault(name, []).append(cumulative / 1000)
+    slowest = sorted(
+        ((name, median(times)) for name, times in modules.items()), key=lambda item: -item[1])
+    return {
+        'args': screenshots_args,
+        'repeat': args.repeat,
+        'import_ms': median([run['import_ms'] for run in runs]),
+        'first_request_ms': median([run['first_request_ms'] for run in runs]),
+        'total_ms': median([run['total_ms'] for run in runs]),
+        'slowest_imports_ms': slowest[:args.top],
+    }
+
+
+def print_report(report):
+    print()
+    if report['import_ms'] is None:
+        print('Import time:            unavailable (needs Python 3.7+)')
+    else:
+        print('Import time:            %.0f ms' % report['import_ms'])
+    if report['first_request_ms'] is None:
+        print('Time to first request:  no request made')
+    else:
+        print('Time to first request:  %.0f ms' % report['first_request_ms'])
+    print('Total:                  %.0f ms' % report['total_ms'])
+    print('(medians of %d runs)' % report['repeat'])
+    for name, ms in report['slowest_imports_ms']:
+        print('  import %-24s %6.1f ms' % (name, ms))
+
+
+def main(args_list=None):
+    if args_list is None:
+        args_list = sys.argv[1:]
+    args, screenshots_args = parser.parse_known_args(args_list)
+    if args.max_import_ms and not IMPORT_TIMES:
+        parser.error('--max-import-ms needs Python 3.7+ for -X importtime, this is Python %d.%d'
+                     % sys.version_info[:2])
+    report = run_benchmark(args, screenshots_args)
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    over = []
+    if args.max_import_ms and report['import_ms'] > args.max_import_ms:
+        over.append('import time %.0f ms is over %.0f ms' % (
+            report['import_ms'], args.max_import_ms))
+    if args.max_first_request_ms and (
+            report['first_request_ms'] is None
+            or report['first_request_ms'] > args.max_first_request_ms):
+        over.append('time to first request is over %.0f ms' % args.max_first_request_ms)
+    if over:
+        print('FAILED: %s' % '; '.join(over))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
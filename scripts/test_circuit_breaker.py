@@ -0,0 +1,88 @@
+""" Checks which failed PhantomJSCloud renders the per-host circuit breaker counts against a site.
+
+Captures 5 links of one site through scripts/fake_services.py, with every render failing in one
+of the ways PhantomJSCloud reports errors, and checks how many renders were paid for:
+
+    python scripts/test_circuit_breaker.py    (or: python -m pytest scripts/test_circuit_breaker.py)
+
+With a threshold of 2, a site that fails stops being rendered after 2 requests, while errors of
+PhantomJSCloud itself leave the breaker closed and every link is retried as usual.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPTS_DIR))
+sys.path.insert(0, SCRIPTS_DIR)
+
+from fake_services import FakeServices, FakeServiceSettings  # noqa: E402
+from retries import CircuitBreaker, RetryPolicy  # noqa: E402
+from screenshotter import Screenshotter  # noqa: E402
+
+
+LINKS = 5
+ATTEMPTS = 4
+THRESHOLD = 2
+
+
+class CircuitBreakerRenderTest(unittest.TestCase):
+
+    # captures LINKS links of one site with every render failing as settings say; returns the
+    # number of render requests PhantomJSCloud got
+    def renders_made(self, **settings):
+        fake = FakeServices(FakeServiceSettings(
+            latency_ms=0, latency_jitter_ms=0, error_rate=1.0, **settings)).start()
+        self.addCleanup(fake.stop)
+        local_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(local_dir.cleanup)
+        screenshotter = Screenshotter(
+            local_dir=local_dir.name, s3_backup=None, phantomjscloud_key='test',
+            phantomjscloud_url='%s/api/browser/v2/' % fake.url,
+            retry_policy=RetryPolicy(attempts=ATTEMPTS, base_delay=0.001, max_delay=0.001),
+            circuit_breaker=CircuitBreaker(threshold=THRESHOLD, cooldown=300))
+        for i in range(LINKS):
+            error = screenshotter.screenshot_link(
+                'ZZ', {'name': 'link%d' % i, 'url': 'https://dead.example.com/%d' % i})
+            self.assertIsNotNone(error)
+        return fake.snapshot()['injected_errors']
+
+    # the site's failures open its circuit
+
+    def test_page_load_failure_without_target_status(self):
+        self.assertEqual(self.renders_made(error_status=504), THRESHOLD)
+
+    def test_target_server_error_in_phantomjscloud_4xx(self):
+        self.assertEqual(
+            self.renders_made(error_status=400, error_target_status=503), THRESHOLD)
+
+    def test_target_server_error_in_phantomjscloud_5xx(self):
+        self.assertEqual(
+            self.renders_made(error_status=500, error_target_status=502), THRESHOLD)
+
+    def test_target_client_error(self):
+        # not retried, but still counted against the site
+        self.assertEqual(
+            self.renders_made(error_status=400, error_target_status=404), THRESHOLD)
+
+    # errors of PhantomJSCloud itself don't
+
+    def test_rate_limited(self):
+        self.assertEqual(self.renders_made(error_status=429, retry_after=0), LINKS * ATTEMPTS)
+
+    def test_out_of_credits(self):
+        # not worth retrying, but the site isn't at fault
+        self.assertEqual(self.renders_made(error_status=402), LINKS)
+
+    def test_gateway_error_page(self):
+        self.assertEqual(
+            self.renders_made(error_status=502, error_shape='bare'), LINKS * ATTEMPTS)
+
+    def test_connection_closed(self):
+        self.assertEqual(self.renders_made(error_shape='reset'), LINKS * ATTEMPTS)
+
+
+if __name__ == '__main__':
+    unittest.main()
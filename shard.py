@@ -0,0 +1,153 @@
+""" Deterministic splitting of a run's links across machines, and merging their results.
+
+Every shard computes the same plan from the same inputs (configs, states, run types and an
+optional shared history), so independent hosts or cron jobs agree on who captures what without
+talking to each other. Shards write their failures to a shared location (a local directory or an
+s3:// prefix), and a merge step turns them into the one Slack summary of an unsharded run.
+"""
+
+from datetime import datetime
+import json
+import os
+from urllib.parse import urlparse
+
+from loguru import logger
+from pytz import timezone
+
+from downloads import write_json_atomically
+from utils import shared_s3_resource
+
+
+def parse_shard(text):
+    """Parses 'i/N' (1 <= i <= N) into (i, N)."""
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError(f'Invalid shard {text!r}, expected i/N, e.g. 1/4')
+    if not 1 <= index <= count:
+        raise ValueError(f'Invalid shard {text!r}: i must be between 1 and N')
+    return index, count
+
+
+# rough expected seconds for a link with no history: renders take several times as long as
+# downloads, and longer still with a longer maxWait
+def static_cost(state_config):
+    if state_config.get('file'):
+        return 5.0
+    max_wait = state_config.get('requestSettings', {}).get('maxWait', 60000)
+    return 10.0 + max_wait / 4000
+
+
+class ShardPlan():
+    """Which shard owns each unit of work: a link (run type, state, suffix), or a whole state
+    (run type, state, None) whose config can't be loaded, so its error is reported once.
+    """
+
+    def __init__(self, index, count, assignments, costs):
+        self.index = index
+        self.count = count
+        self._assignments = assignments  # unit -> shard index
+        self._costs = costs  # unit -> cost
+
+    @classmethod
+    def build(cls, index, count, costs):
+        """Assigns units to shards greedily, costliest first, each to the least loaded shard.
+
+        costs maps every unit of the full run to its expected cost. Ties are broken by unit and
+        shard number, so the plan only depends on its inputs.
+        """
+        loads = [0.0] * count
+        assignments = {}
+        for unit in sorted(costs, key=lambda unit: (-costs[unit], _sort_key(unit))):
+            shard = min(range(count), key=lambda shard: (loads[shard], shard))
+            loads[shard] += costs[unit]
+            assignments[unit] = shard + 1
+        return cls(index, count, assignments, costs)
+
+    def owns(self, run_type, state, suffix):
+        return self._assignments.get((run_type, state, suffix), 1) == self.index
+
+    def describe(self):
+        mine = [unit for unit, shard in self._assignments.items() if shard == self.index]
+        return 'shard %d/%d: %d of %d links, estimated cost %.0f of %.0f' % (
+            self.index, self.count, len(mine), len(self._assignments),
+            sum(self._costs[unit] for unit in mine), sum(self._costs.values()))
+
+
+def _sort_key(unit):
+    return tuple('' if part is None else part for part in unit)
+
+
+class ShardResults():
+    """Failures of each shard of a run, kept under a local directory or an s3://bucket/prefix.
+
+    Each shard writes <run id>/shard-<i>-of-<N>.json when it finishes.
+    """
+
+    def __init__(self, location, run_id, count, endpoint_url=None):
+        self.location = location
+        self.run_id = run_id
+        self.count = count
+        self.endpoint_url = endpoint_url
+
+    def _name(self, index):
+        return '%s/shard-%d-of-%d.json' % (self.run_id, index, self.count)
+
+    def write(self, index, failures):
+        """failures maps run type -> list of (state, suffix, error message)."""
+        result = {
+            'run_id': self.run_id,
+            'shard': [index, self.count],
+            'finished_at': datetime.now(timezone('US/Eastern')).isoformat(),
+            'failures': {run_type: [[state, suffix, str(error)] for state, suffix, error in items]
+                         for run_type, items in failures.items()},
+        }
+        name = self._name(index)
+        if self.location.startswith('s3://'):
+            bucket, key = self._s3_key(name)
+            self._s3_client().put_object(
+                Bucket=bucket, Key=key, Body=json.dumps(result).encode(),
+                ContentType='application/json')
+        else:
+            write_json_atomically(os.path.join(self.location, name), result)
+        logger.info(f'Wrote results of shard {index}/{self.count} to {self.location}/{name}')
+
+    def read(self, index):
+        name = self._name(index)
+        try:
+            if self.location.startswith('s3://'):
+                bucket, key = self._s3_key(name)
+                body = self._s3_client().get_object(Bucket=bucket, Key=key)['Body'].read()
+                return json.loads(body)
+            with open(os.path.join(self.location, name)) as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f'Could not read results of shard {index}/{self.count}: {e}')
+            return None
+
+    def merge(self, run_types):
+        """Returns run type -> (state, suffix, error) failures over all shards, in state order.
+
+        A shard that never wrote its results is reported as a failure of every run type.
+        """
+        merged = {run_type: [] for run_type in run_types}
+        for index in range(1, self.count + 1):
+            result = self.read(index)
+            if result is None:
+                for run_type in run_types:
+                    merged[run_type].append(
+                        ('shard %d/%d' % (index, self.count), 'all',
+                         'shard did not report results for run %s' % self.run_id))
+                continue
+            for run_type, items in result['failures'].items():
+                merged.setdefault(run_type, []).extend(tuple(item) for item in items)
+        return {run_type: sorted(items, key=lambda item: (item[0], item[1]))
+                for run_type, items in merged.items()}
+
+    def _s3_client(self):
+        return shared_s3_resource(self.endpoint_url).meta.client
+
+    def _s3_key(self, name):
+        parsed = urlparse(self.location)
+        prefix = parsed.path.strip('/')
+        return parsed.netloc, '%s/%s' % (prefix, name) if prefix else name
@@ -1,20 +1,89 @@
 """ Supporting classes for taking screenshots and saving them to S3."""
 
 import os
+import threading
 
-import boto3
 from loguru import logger
-from slack import WebClient
-from slack.errors import SlackApiError
+import requests
+from requests.adapters import HTTPAdapter
+
+# boto3 and slack are imported when the first client is made: together they take a large part of
+# start-up, and dry runs never need them
+
+
+# Returns a requests session with a keep-alive connection pool, so repeated calls to the same host
+# (PhantomJSCloud in particular) reuse TCP+TLS connections instead of reconnecting every time
+def make_http_session(pool_size=10):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Returns a TransferConfig for uploading many files at once: multipart above 8MB, with parts
+# uploaded concurrently so a single large xlsx/zip doesn't hold up an uploader for long
+def make_transfer_config(max_concurrency=10):
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(
+        multipart_threshold=8 * 1024 * 1024,
+        multipart_chunksize=8 * 1024 * 1024,
+        max_concurrency=max_concurrency,
+        use_threads=True)
+
+
+_s3_resources = {}  # endpoint URL -> boto3 S3 resource
+_s3_resources_lock = threading.Lock()
+
+
+# Returns the process's boto3 S3 resource for endpoint_url (None for AWS), created on first use,
+# so every S3Backup and other S3 user shares one connection pool
+def shared_s3_resource(endpoint_url=None):
+    with _s3_resources_lock:
+        if endpoint_url not in _s3_resources:
+            import boto3
+            _s3_resources[endpoint_url] = boto3.resource('s3', endpoint_url=endpoint_url or None)
+        return _s3_resources[endpoint_url]
 
 
 class S3Backup():
 
-    def __init__(self, bucket_name, s3_subfolder):
-        self.s3 = boto3.resource('s3')
+    def __init__(self, bucket_name, s3_subfolder, transfer_config=None, s3_resource=None,
+                 endpoint_url=None, index=False):
+        # the boto3 resource is s3_resource if given, otherwise the shared one for endpoint_url
+        # (an S3-compatible store instead of AWS), made when the first upload needs it
+        self._s3 = s3_resource
+        self.endpoint_url = endpoint_url
         self.bucket_name = bucket_name
-        self.bucket = self.s3.Bucket(self.bucket_name)
         self.s3_subfolder = s3_subfolder
+        # optional boto3.s3.transfer.TransferConfig, e.g. from make_transfer_config
+        self.transfer_config = transfer_config
+        # if set, every upload is also recorded in its folder's s3_index.S3FolderIndex, written
+        # by flush_index
+        self.index = index
+        self._folder_index = None
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            self._s3 = shared_s3_resource(self.endpoint_url)
+        return self._s3
+
+    @property
+    def bucket(self):
+        return self.s3.Bucket(self.bucket_name)
+
+    @property
+    def folder_index(self):
+        if self._folder_index is None:
+            from s3_index import S3FolderIndex
+            self._folder_index = S3FolderIndex(self.s3.meta.client, self.bucket_name)
+        return self._folder_index
+
+    # writes the index entries of this backup's uploads so far
+    def flush_index(self):
+        if self._folder_index is not None:
+            self._folder_index.flush()
 
     def get_s3_path(self, local_path, state):
         # CDC goes into its own top-level folder to not mess with state_screenshots
@@ -23,31 +92,83 @@ class S3Backup():
         
         return os.path.join(self.s3_subfolder, state, os.path.basename(local_path))
 
-    # uploads file from local path with specified name
-    def upload_file(self, local_path, state):
+    @staticmethod
+    def extra_args_for(filename):
         extra_args = {}
-        if local_path.endswith('.png'):
+        if filename.endswith('.png'):
             extra_args = {'ContentType': 'image/png'}
-        elif local_path.endswith('.pdf'):
+        elif filename.endswith('.pdf'):
             extra_args = {'ContentType': 'application/pdf', 'ContentDisposition': 'inline'}
-        elif local_path.endswith('.xlsx') or local_path.endswith('.xls'):
+        elif filename.endswith('.xlsx') or filename.endswith('.xls'):
             extra_args = {'ContentType': 'application/vnd.ms-excel', 'ContentDisposition': 'inline'}
-        elif local_path.endswith('.zip'):
+        elif filename.endswith('.zip'):
             extra_args = {'ContentType': 'application/zip'}
+        elif filename.endswith('.csv'):
+            extra_args = {'ContentType': 'text/csv', 'ContentDisposition': 'inline'}
+        elif filename.endswith('.webp'):
+            extra_args = {'ContentType': 'image/webp'}
+        return extra_args
 
-        s3_path = self.get_s3_path(local_path, state)
+    # uploads file from local path with specified name, or as filename if given
+    def upload_file(self, local_path, state, filename=None):
+        extra_args = self.extra_args_for(local_path)
+        s3_path = self.get_s3_path(filename or local_path, state)
         logger.info(f'Uploading file at {local_path} to {s3_path}')
-        self.s3.meta.client.upload_file(local_path, self.bucket_name, s3_path, ExtraArgs=extra_args)
+        self.s3.meta.client.upload_file(
+            local_path, self.bucket_name, s3_path,
+            ExtraArgs=extra_args, Config=self.transfer_config)
+        if self.index:
+            self.folder_index.add(
+                s3_path, os.path.getsize(local_path), extra_args.get('ContentType'))
+
+    # uploads an open binary file object as if it were a local file with the given name
+    def upload_fileobj(self, fileobj, filename, state):
+        extra_args = self.extra_args_for(filename)
+        s3_path = self.get_s3_path(filename, state)
+        logger.info(f'Uploading in-memory {filename} to {s3_path}')
+        # SpooledTemporaryFile.seek returns None before Python 3.7, so the size comes from tell()
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+        fileobj.seek(0)  # this may be a retry of an earlier, partly read attempt
+        self.s3.meta.client.upload_fileobj(
+            _KeepOpen(fileobj), self.bucket_name, s3_path, ExtraArgs=extra_args,
+            Config=self.transfer_config)
+        if self.index:
+            self.folder_index.add(s3_path, size, extra_args.get('ContentType'))
+
+
+# s3transfer closes the file objects it uploads; this keeps a capture's buffer open, so it can be
+# uploaded again for another run type or after a failed attempt
+class _KeepOpen():
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+    def close(self):
+        pass
 
 
 class SlackNotifier():
 
     def __init__(self, slack_channel, slack_api_token):
         self.channel = slack_channel
-        self.client = WebClient(token=slack_api_token)
+        self.api_token = slack_api_token
+        self._client = None
+
+    # the Slack client, made on first use: most runs send nothing
+    @property
+    def client(self):
+        if self._client is None:
+            from slack import WebClient
+            self._client = WebClient(token=self.api_token)
+        return self._client
 
     # Returns the SlackResponse object
     def notify_slack(self, message, thread_ts=None):
+        from slack.errors import SlackApiError
         try:
             response = self.client.chat_postMessage(
                 channel=self.channel,